@@ -13,4 +13,15 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'mobidev.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+# needs the apps loaded by get_asgi_application()
+from service.api.events import event_stream  # noqa: E402
+
+
+async def application(scope, receive, send):
+    """Django, except for the server-sent events of /api/events/: a long-lived stream per client is served
+    on the event loop instead of holding a thread"""
+    if scope['type'] == 'http' and scope['path'] == '/api/events/':
+        return await event_stream(scope, receive, send)
+    return await django_application(scope, receive, send)
@@ -10,6 +10,8 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/3.2/ref/settings/
 """
 
+import os
+from importlib.util import find_spec
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -43,6 +45,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'service.middleware.MetricsMiddleware',
+    'service.middleware.ReplicaRoutingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -72,31 +76,149 @@ TEMPLATES = [
 ]
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': [
-        'rest_framework.authentication.TokenAuthentication',
+        'service.api.authentication.CachedTokenAuthentication',
     ],
     'DEFAULT_PERMISSION_CLASSES': [
         'rest_framework.permissions.IsAuthenticated',
     ],
     'DEFAULT_RENDERER_CLASSES': [
-        'rest_framework.renderers.JSONRenderer',
+        'service.api.renderers.ORJSONRenderer',
     ],
     'DEFAULT_PARSER_CLASSES': [
-        'rest_framework.parsers.JSONParser',
-    ]
-
+        'service.api.renderers.ORJSONParser',
+    ],
+    'DEFAULT_THROTTLE_RATES': {
+        'provision': '20/hour',
+    },
 }
+# MessagePack (Accept / Content-Type: application/msgpack) is offered when the msgpack package is installed;
+# it is in requirements.txt, an install without it answers JSON only
+if find_spec('msgpack') is not None:
+    REST_FRAMEWORK['DEFAULT_RENDERER_CLASSES'].append('service.api.renderers.MessagePackRenderer')
+    REST_FRAMEWORK['DEFAULT_PARSER_CLASSES'].append('service.api.renderers.MessagePackParser')
+# Upper bound of employees + offices + vehicles in one /api/provision/ document (superusers only)
+TENANT_PROVISION_MAX_ROWS = 100000
+# Deletes of offices and employees (service.deletions): rows per batch/transaction and seconds without
+# progress after which a running deletion is resumed
+DELETION_BATCH_SIZE = 500
+DELETION_STALE_SECONDS = 60
+# Background jobs (service.jobs), run by `manage.py run_jobs`. At most JOB_TENANT_CONCURRENCY jobs of a
+# company run at once; a failed attempt waits JOB_RETRY_BACKOFF seconds, doubled every attempt; a running
+# job without a heartbeat for JOB_STALE_SECONDS is requeued. JOBS_EAGER runs jobs in the web process
+# right after the request's transaction commits (no worker needed, for development and tests)
+JOB_TENANT_CONCURRENCY = 1
+JOB_RETRY_BACKOFF = 5
+JOB_POLL_INTERVAL = 1.0
+JOB_HEARTBEAT_INTERVAL = 10
+JOB_STALE_SECONDS = 60
+JOBS_EAGER = False
+# Largest body of an ?async=1 import, kept in the database in 1 MB chunks until its job ran
+JOB_UPLOAD_MAX_BYTES = 200 * 1024 * 1024
+# Seconds the file of an ?async=1 vehicle export stays downloadable; dropped on the company's next export
+JOB_EXPORT_KEEP_SECONDS = 24 * 3600
+# /api/sync/ (service.changelog): default page size, and days a deletion stays in the change log
+# (`manage.py compact_changes`); clients that did not sync for longer start over
+SYNC_PAGE_SIZE = 500
+SYNC_TOMBSTONE_DAYS = 30
+# Server-sent events of /api/events/ (service.events), served by the ASGI application only. EVENTS_BROKER
+# feeds the subscribers of a process: the default reads the change log every EVENTS_POLL_INTERVAL seconds
+# while anyone is subscribed. A subscriber EVENTS_QUEUE_SIZE events behind is told to resync; an idle
+# stream gets a comment every EVENTS_KEEPALIVE seconds so proxies keep it open, and its token is checked
+# again as often. Browsers open the stream with ?ticket= from /api/events/ticket/, valid EVENTS_TICKET_MAX_AGE seconds
+EVENTS_BROKER = 'service.events.ChangeLogBroker'
+EVENTS_POLL_INTERVAL = 1.0
+EVENTS_QUEUE_SIZE = 1000
+EVENTS_KEEPALIVE = 15
+EVENTS_TICKET_MAX_AGE = 30
+# Page size of the list endpoints paginated with service.api.pagination.KeysetPagination
+# (vehicles, the driver's vehicle profile, employees, offices, jobs, deletions); the other endpoints
+# answer a plain list
+API_PAGE_SIZE = 100
+# Upper bound for the ?page_size= query parameter of those endpoints
+API_MAX_PAGE_SIZE = 1000
+# A request running the same SQL this many times is reported as a suspected N+1 on /metrics
+METRICS_N_PLUS_ONE_THRESHOLD = 10
+# /metrics answers scrapers from these addresses, requests with `Authorization: Bearer <METRICS_TOKEN>`
+# and logged-in superusers; everyone else gets 403
+METRICS_ALLOWED_IPS = ['127.0.0.1', '::1']
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+# Password hashing runs off the request thread, see service.hashers.
+# Workers default to half of the CPUs, pending jobs to 8 per worker; past that logins get 429
+# and so does a call without a slot or a result after PASSWORD_HASHING_TIMEOUT seconds
+PASSWORD_HASHING_SERVICE = 'service.hashers.ProcessPoolHashingService'
+PASSWORD_HASHING_WORKERS = None
+PASSWORD_HASHING_MAX_PENDING = None
+PASSWORD_HASHING_TIMEOUT = 30
+# token -> user cache of CachedTokenAuthentication; TOKEN_CACHE_BACKEND is an optional CACHES alias shared by processes.
+# Set it when running several processes: a token revoked in one of them is then refused by the others after
+# TOKEN_CACHE_LOCAL_TTL seconds instead of TOKEN_CACHE_TTL
+TOKEN_CACHE_MAX_SIZE = 10000
+TOKEN_CACHE_TTL = 300
+TOKEN_CACHE_LOCAL_TTL = 1
+TOKEN_CACHE_BACKEND = None
+
 WSGI_APPLICATION = 'mobidev.wsgi.application'
 
 # Database
 # https://docs.djangoproject.com/en/3.2/ref/settings/#databases
 
+# service.backends.sqlite3 is Django's sqlite3 backend plus the PRAGMAs of
+# service.backends.sqlite3.base.DEFAULT_PRAGMAS (override them in OPTIONS['pragmas']),
+# BEGIN IMMEDIATE transactions and SELECT 1 health checks of persistent connections.
+# MOBIDEV_SQLITE_JOURNAL_MODE=wal turns on WAL for a deployed database (readers and the writer do not block
+# each other); it is kept in the file, the checked-in db.sqlite1 stays in the rollback journal mode.
 DATABASES = {
     'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
+        'ENGINE': 'service.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite1',
+        'CONN_MAX_AGE': 600,
+        'OPTIONS': {
+            'timeout': 20,
+            'pragmas': {'journal_mode': os.environ.get('MOBIDEV_SQLITE_JOURNAL_MODE')},
+            'transaction_mode': 'IMMEDIATE',
+            'health_checks': True,
+        },
     }
 }
 
+# Read replicas: aliases of DATABASES that serve the reads of GET requests (service.routers.ReplicaRouter).
+# MOBIDEV_SQLITE_REPLICA=/path/to/replica.sqlite3 adds a local SQLite replica, kept in sync with
+# `manage.py sync_replicas --interval 1`.
+DATABASE_ROUTERS = ['service.routers.ReplicaRouter']
+DATABASE_REPLICAS = []
+if os.environ.get('MOBIDEV_SQLITE_REPLICA'):
+    DATABASES['replica'] = {
+        **DATABASES['default'],
+        'NAME': os.environ['MOBIDEV_SQLITE_REPLICA'],
+        'TEST': {'MIRROR': 'default'},
+    }
+    DATABASE_REPLICAS.append('replica')
+# Replicas further behind the primary than this (seconds, from their heartbeat) are not read from
+REPLICA_MAX_LAG = 30
+# After a write, the client reads from the primary for this many seconds (signed replica_pin cookie)
+REPLICA_STICKY_SECONDS = 5
+# How often a process re-reads the heartbeat of a replica (seconds)
+REPLICA_CHECK_INTERVAL = 1.0
+
+# Caches
+# https://docs.djangoproject.com/en/3.2/topics/cache/
+# 'responses' keeps cached API responses (service.api.caching). The per-company versions that invalidate
+# them are in the database, so a per-process backend stays correct with several processes; a shared one
+# (memcached/redis) only saves them from computing the same pages.
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'responses': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'responses',
+        'TIMEOUT': 300,
+        'OPTIONS': {'MAX_ENTRIES': 10000},
+    },
+}
+RESPONSE_CACHE_BACKEND = 'responses'
+
 # Password validation
 # https://docs.djangoproject.com/en/3.2/ref/settings/#auth-password-validators
 
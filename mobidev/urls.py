@@ -20,11 +20,14 @@ from rest_framework import routers
 
 from service.api.resourse import AuthToken, EmployeeViewSet, CompanyViewSet, ProfileViewSet, OfficeViewSet, \
     DetailOfficeViewSet, EmployeeUpViewsSet, AssignEmployeeToOfficeViewSet, EmployeeOfficeDetailViewSet, VehicleViewSet, \
-    VehicleChangeViewSet, VehicleProfileViewSet, CompanyCreateViewSet
+    VehicleChangeViewSet, VehicleProfileViewSet, CompanyCreateViewSet, FleetStatsViewSet, SearchViewSet, \
+    DeletionViewSet, JobViewSet, SyncViewSet, ProvisionViewSet, EventTicketViewSet
+from service.views import metrics
 
 
 router = routers.SimpleRouter()
 router.register(r'auth', CompanyCreateViewSet, basename='auth')
+router.register(r'provision', ProvisionViewSet, basename='provision')
 router.register(r'employee', EmployeeViewSet, basename='employee')
 router.register(r'employee_up', EmployeeUpViewsSet, basename='employee_up')
 router.register(r'company', CompanyViewSet, basename='company')
@@ -36,10 +39,17 @@ router.register(r'employee_office_detail', EmployeeOfficeDetailViewSet, basename
 router.register(r'vehicle', VehicleViewSet, basename='vehicle')
 router.register(r'vehicle_change', VehicleChangeViewSet, basename='vehicle_change')
 router.register(r'vehicle_profile', VehicleProfileViewSet, basename='vehicle_profile')
+router.register(r'fleet_stats', FleetStatsViewSet, basename='fleet_stats')
+router.register(r'search', SearchViewSet, basename='search')
+router.register(r'deletions', DeletionViewSet, basename='deletions')
+router.register(r'jobs', JobViewSet, basename='jobs')
+router.register(r'sync', SyncViewSet, basename='sync')
+router.register(r'events/ticket', EventTicketViewSet, basename='events_ticket')
 
 urlpatterns = [
     path('api/', include(router.urls)),
     path('api-auth/', include('rest_framework.urls')),
     path('api-token-auth/', AuthToken.as_view()),
     path('admin/', admin.site.urls),
+    path('metrics', metrics, name='metrics'),
 ]
@@ -0,0 +1,88 @@
+import copy
+
+from django.conf import settings
+from django.core.cache import caches
+from rest_framework import exceptions
+from rest_framework.authentication import TokenAuthentication
+from rest_framework.authtoken.models import Token
+
+from service.cache import LRUCache
+from service.routers import PRIMARY
+
+
+class TokenCache:
+    """token key -> (user, token) with user.company already loaded.
+    The in-process LRU is always used, the shared Django cache (TOKEN_CACHE_BACKEND alias) only if configured.
+    Revocation signals clear the shared cache and the LRU of their own process. So with a shared cache the
+    LRU keeps an entry only TOKEN_CACHE_LOCAL_TTL seconds, the longest another process accepts a revoked
+    token; without one, entries live TOKEN_CACHE_TTL seconds and other processes only drop them then."""
+    prefix = 'auth-token:'
+
+    def __init__(self):
+        self.local = LRUCache(max_size=getattr(settings, 'TOKEN_CACHE_MAX_SIZE', 10000))
+
+    @property
+    def backend_alias(self):
+        return getattr(settings, 'TOKEN_CACHE_BACKEND', None)
+
+    @property
+    def shared(self):
+        return caches[self.backend_alias] if self.backend_alias else None
+
+    @property
+    def local_ttl(self):
+        if self.backend_alias:
+            return getattr(settings, 'TOKEN_CACHE_LOCAL_TTL', 1)
+        return getattr(settings, 'TOKEN_CACHE_TTL', 300)
+
+    def get(self, key):
+        entry = self.local.get(key)
+        if entry is None and self.shared is not None:
+            entry = self.shared.get(self.prefix + key)
+            if entry is not None:
+                self.local.set(key, entry, self.local_ttl)
+        if entry is None:
+            return None
+        # every request gets its own copy, so a view changing request.user never touches the cache
+        user, token = entry
+        return copy.copy(user), token
+
+    def set(self, token):
+        token.user.company  # load the company once, here
+        entry = (token.user, token)
+        self.local.set(token.key, entry, self.local_ttl)
+        if self.shared is not None:
+            self.shared.set(self.prefix + token.key, entry, getattr(settings, 'TOKEN_CACHE_TTL', 300))
+
+    def delete_many(self, keys):
+        keys = list(keys)
+        self.local.delete_many(keys)
+        if self.shared is not None:
+            self.shared.delete_many([self.prefix + key for key in keys])
+
+    def clear(self):
+        self.local.clear()
+
+
+token_cache = TokenCache()
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    """TokenAuthentication that remembers token -> (user, company) between requests.
+    A hit costs no query, a miss costs one joined query instead of two."""
+
+    def authenticate_credentials(self, key):
+        entry = token_cache.get(key)
+        if entry is None:
+            try:
+                # a token issued a moment ago may not have reached a read replica yet
+                token = Token.objects.using(PRIMARY).select_related('user', 'user__company').get(key=key)
+            except Token.DoesNotExist:
+                raise exceptions.AuthenticationFailed('Invalid token.')
+            token_cache.set(token)
+            entry = copy.copy(token.user), token
+
+        user, token = entry
+        if not user.is_active:
+            raise exceptions.AuthenticationFailed('User inactive or deleted.')
+        return user, token
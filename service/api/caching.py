@@ -0,0 +1,124 @@
+import hashlib
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.db.models import F
+from rest_framework.response import Response
+
+from service.models import TenantVersion
+from service.routers import PRIMARY
+
+
+class ResponseCache:
+    """Response data cached per (company, endpoint, url, version).
+    Every write to a company's data bumps its version, so old entries are never read again
+    and simply expire; invalidation costs one UPDATE whatever the number of cached pages.
+    The versions are TenantVersion rows of the primary database, shared by all the processes, so the
+    cached entries themselves may stay in a per-process backend."""
+    response_prefix = 'response:'
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {'hits': 0, 'misses': 0, 'invalidations': 0}
+
+    @property
+    def backend(self):
+        return caches[getattr(settings, 'RESPONSE_CACHE_BACKEND', 'default')]
+
+    def get_version(self, company_id):
+        return self.get_state(company_id)[0]
+
+    def get_state(self, company_id):
+        """(version, last modified unix time) of a company, read from the primary: a replica may not have
+        the last bump yet"""
+        versions = TenantVersion.objects.using(PRIMARY)
+        state = versions.filter(pk=company_id or 0).values_list('version', 'modified').first()
+        if state is None:
+            version = versions.get_or_create(pk=company_id or 0, defaults=self.initial_state())[0]
+            state = version.version, version.modified
+        return state
+
+    def bump(self, company_id):
+        versions = TenantVersion.objects.using(PRIMARY)
+        modified = int(time.time())
+        if not versions.filter(pk=company_id or 0).update(version=F('version') + 1, modified=modified):
+            _, created = versions.get_or_create(pk=company_id or 0, defaults=self.initial_state())
+            if not created:
+                versions.filter(pk=company_id or 0).update(version=F('version') + 1, modified=modified)
+        self._count('invalidations')
+
+    @staticmethod
+    def initial_state():
+        # entries a backend kept from before the row existed must not match the first version
+        return {'version': time.time_ns(), 'modified': int(time.time())}
+
+    def make_key(self, company_id, version, endpoint, url, user_id=None):
+        digest = hashlib.md5(url.encode('utf-8')).hexdigest()
+        return f'{self.response_prefix}{company_id}:{endpoint}:{user_id or ""}:{digest}:{version}'
+
+    def get(self, key):
+        data = self.backend.get(key)
+        self._count('misses' if data is None else 'hits')
+        return data
+
+    def set(self, key, data):
+        self.backend.set(key, data)
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counters)
+
+    def _count(self, name):
+        with self._lock:
+            self.counters[name] += 1
+
+
+response_cache = ResponseCache()
+
+
+def tenant_state(request):
+    """get_state() of the requesting user's company, read once per request"""
+    request = getattr(request, '_request', request)
+    state = getattr(request, '_tenant_state', None)
+    if state is None:
+        state = request._tenant_state = response_cache.get_state(request.user.company_id)
+    return state
+
+
+def bump_tenant_version(company_id):
+    """Invalidate the cached responses of a company once the current transaction commits: the
+    last-modified time is then never older than the data it describes (see ConditionalMixin).
+    Users without a company share the None version."""
+    transaction.on_commit(lambda: response_cache.bump(company_id))
+
+
+class CachedResponseMixin:
+    """Serve list/retrieve of a viewset from response_cache.
+    Set cache_per_user when the queryset depends on request.user and not only on the company."""
+    cache_per_user = False
+
+    def list(self, request, *args, **kwargs):
+        return self.cached(super().list, request, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        return self.cached(super().retrieve, request, *args, **kwargs)
+
+    def cached(self, handler, request, *args, **kwargs):
+        user = request.user
+        key = response_cache.make_key(
+            user.company_id,
+            tenant_state(request)[0],
+            f'{self.basename}-{self.action}',
+            request.build_absolute_uri(),
+            user.id if self.cache_per_user else None,
+        )
+        data = response_cache.get(key)
+        if data is not None:
+            return Response(data)
+        response = handler(request, *args, **kwargs)
+        if response.status_code == 200:
+            response_cache.set(key, response.data)
+        return response
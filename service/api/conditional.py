@@ -0,0 +1,73 @@
+import hashlib
+import time
+
+from django.utils.http import http_date, parse_http_date_safe, parse_etags, quote_etag
+from rest_framework import status
+from rest_framework.exceptions import APIException
+from rest_framework.response import Response
+
+from service.api.caching import response_cache, tenant_state
+
+
+class PreconditionFailed(APIException):
+    status_code = status.HTTP_412_PRECONDITION_FAILED
+    default_detail = 'The resource was changed by someone else, reload it and try again.'
+    default_code = 'precondition_failed'
+
+
+def row_etag(instance):
+    """Strong ETag of one row, from its column values - no serialization involved"""
+    values = tuple(getattr(instance, field.attname) for field in instance._meta.concrete_fields)
+    return quote_etag(hashlib.md5(repr(values).encode('utf-8')).hexdigest())
+
+
+class ConditionalMixin:
+    """ETag/Last-Modified for GET and If-Match for writes.
+    GET validators come from the company's change marker in response_cache (bumped by every write
+    to the tenant), so If-None-Match/If-Modified-Since answer 304 before the queryset is touched."""
+
+    def list(self, request, *args, **kwargs):
+        return self.conditional(super().list, request, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        return self.conditional(super().retrieve, request, *args, **kwargs)
+
+    def tenant_etag(self, version):
+        user = self.request.user
+        raw = f'{user.company_id}:{user.id}:{version}:{self.request.accepted_renderer.format}'
+        return quote_etag(hashlib.md5(raw.encode('utf-8')).hexdigest())
+
+    def conditional(self, handler, request, *args, **kwargs):
+        version, last_modified = tenant_state(request)
+        etag = self.tenant_etag(version)
+
+        if_none_match = request.headers.get('If-None-Match')
+        if_modified_since = parse_http_date_safe(request.headers.get('If-Modified-Since') or '')
+        now = int(time.time())
+        if if_none_match is not None:
+            not_modified = if_none_match.strip() == '*' or etag in parse_etags(if_none_match)
+        else:
+            # HTTP dates have whole seconds, so Last-Modified is only sent once the second of the last change
+            # is over: any later change falls in a later second. Dates of the current second prove nothing.
+            not_modified = if_modified_since is not None and last_modified <= if_modified_since < now
+
+        response = Response(status=status.HTTP_304_NOT_MODIFIED) if not_modified else handler(request, *args, **kwargs)
+        if response.status_code in (status.HTTP_200_OK, status.HTTP_304_NOT_MODIFIED):
+            response['ETag'] = etag
+            if last_modified < now:
+                response['Last-Modified'] = http_date(last_modified)
+        return response
+
+    def check_if_match(self, instance):
+        """Optimistic concurrency for writes: If-Match must carry the row ETag or the current GET ETag"""
+        if_match = self.request.headers.get('If-Match')
+        if if_match is None or if_match.strip() == '*':
+            return
+        etags = parse_etags(if_match)
+        version = response_cache.get_version(self.request.user.company_id)
+        if row_etag(instance) not in etags and self.tenant_etag(version) not in etags:
+            raise PreconditionFailed()
+
+    def perform_update(self, serializer):
+        self.check_if_match(serializer.instance)
+        super().perform_update(serializer)
@@ -0,0 +1,30 @@
+from rest_framework import serializers, status
+from rest_framework.response import Response
+
+from service import deletions
+from service.api.fieldsets import DynamicFieldsMixin, query_flag
+from service.models import Deletion
+
+
+class DeletionSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
+    class Meta:
+        model = Deletion
+        fields = ('id', 'target', 'target_id', 'archive', 'status', 'planned', 'deleted', 'error',
+                  'created_at', 'updated_at', 'finished_at')
+        read_only_fields = fields
+
+
+class BackgroundDeleteMixin:
+    """DELETE removes the object with its dependents through service.deletions: 204 when it is small enough
+    to be gone at once, otherwise 202 with the Deletion to follow at /api/deletions/<id>/.
+    ?archive=1 copies the removed rows to ArchivedRow first. Needs ConditionalMixin for If-Match."""
+    deletion_target = None
+
+    def destroy(self, request, *args, **kwargs):
+        instance = self.get_object()
+        self.check_if_match(instance)
+        deletion = deletions.schedule(self.deletion_target, instance, archive=query_flag(request, 'archive'))
+        if deletion.status == Deletion.DONE:
+            return Response(status=status.HTTP_204_NO_CONTENT)
+        return Response(DeletionSerializer(deletion, context=self.get_serializer_context()).data,
+                        status=status.HTTP_202_ACCEPTED)
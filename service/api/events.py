@@ -0,0 +1,144 @@
+import asyncio
+import hashlib
+from urllib.parse import parse_qs
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core import signing
+from django.utils.crypto import constant_time_compare
+from rest_framework import exceptions
+from rest_framework.authtoken.models import Token
+
+from service.api.authentication import CachedTokenAuthentication
+from service.api.renderers import ORJSONRenderer
+from service.events import RESYNC, get_broker
+from service.routers import PRIMARY
+
+TICKET_SALT = 'service.api.events.ticket'
+
+
+def token_digest(key):
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+def issue_ticket(token):
+    """A stream ticket for ?ticket= (EventSource cannot send headers): signed, good for EVENTS_TICKET_MAX_AGE
+    seconds, and naming the token by its digest, so what access logs keep of the URL soon opens nothing"""
+    return signing.dumps({'user': token.user_id, 'token': token_digest(token.key)}, salt=TICKET_SALT)
+
+
+def redeem_ticket(ticket):
+    """The key of the token a ticket was issued for, AuthenticationFailed once it expired or the token changed"""
+    try:
+        value = signing.loads(ticket, salt=TICKET_SALT, max_age=getattr(settings, 'EVENTS_TICKET_MAX_AGE', 30))
+    except signing.BadSignature:
+        raise exceptions.AuthenticationFailed('Invalid or expired ticket.')
+    key = Token.objects.using(PRIMARY).filter(user_id=value['user']).values_list('key', flat=True).first()
+    if key is None or not constant_time_compare(token_digest(key), value['token']):
+        raise exceptions.AuthenticationFailed('Invalid or expired ticket.')
+    return key
+
+
+def token_of(scope):
+    """The key of an `Authorization: Token <key>` header, else the one of a ?ticket="""
+    for name, value in scope['headers']:
+        if name == b'authorization':
+            parts = value.decode('latin-1').split()
+            if len(parts) == 2 and parts[0].lower() == 'token':
+                return parts[1]
+    ticket = parse_qs(scope.get('query_string', b'').decode('latin-1')).get('ticket', [None])[0]
+    return redeem_ticket(ticket) if ticket else None
+
+
+def authenticate(key):
+    """The admin the token belongs to; AuthenticationFailed / PermissionDenied like the REST endpoints"""
+    if not key:
+        raise exceptions.NotAuthenticated()
+    user, _ = CachedTokenAuthentication().authenticate_credentials(key)
+    if not user.is_staff:
+        raise exceptions.PermissionDenied()
+    return user
+
+
+def authorize(scope):
+    """(admin, token key) of the stream"""
+    key = token_of(scope)
+    return authenticate(key), key
+
+
+async def still_authorized(key, user):
+    """Checked again every EVENTS_KEEPALIVE seconds, through the token cache: a stream ends once its token
+    is revoked, its user is no longer an active admin or has moved to another company"""
+    try:
+        current = await sync_to_async(authenticate)(key)
+    except exceptions.APIException:
+        return False
+    return current.company_id == user.company_id
+
+
+async def respond(send, status, detail):
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', b'application/json')],
+    })
+    await send({'type': 'http.response.body', 'body': ORJSONRenderer().render({'detail': detail})})
+
+
+async def disconnected(receive):
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+
+async def event_stream(scope, receive, send):
+    """ASGI application of /api/events/: server-sent events about the offices and vehicles of the admin's
+    company (service.events). Authenticate with the token header, or with a ticket of /api/events/ticket/
+    from a browser. Open the stream, then catch up with /api/sync/ from the last cursor; after a 'resync'
+    event or a dropped connection, reconnect and do the same from the last event id received."""
+    if scope['method'] != 'GET':
+        return await respond(send, 405, f'Method "{scope["method"]}" not allowed.')
+    try:
+        user, key = await sync_to_async(authorize)(scope)
+    except exceptions.APIException as exc:
+        return await respond(send, exc.status_code, str(exc.detail))
+
+    broker = get_broker()
+    subscription = await broker.subscribe(user.company_id)
+    keepalive = getattr(settings, 'EVENTS_KEEPALIVE', 15)
+    loop = asyncio.get_running_loop()
+    checked_at = loop.time()
+    gone = asyncio.ensure_future(disconnected(receive))
+    try:
+        await send({
+            'type': 'http.response.start',
+            'status': 200,
+            'headers': [
+                (b'content-type', b'text/event-stream'),
+                (b'cache-control', b'no-cache'),
+                (b'x-accel-buffering', b'no'),
+            ],
+        })
+        await send({'type': 'http.response.body', 'body': b'retry: 3000\n\n', 'more_body': True})
+        while True:
+            event = asyncio.ensure_future(subscription.queue.get())
+            done, _ = await asyncio.wait({event, gone}, timeout=keepalive, return_when=asyncio.FIRST_COMPLETED)
+            if gone in done:
+                event.cancel()
+                return
+            if event not in done:
+                event.cancel()
+            if loop.time() - checked_at >= keepalive:
+                if not await still_authorized(key, user):
+                    await send({'type': 'http.response.body', 'body': b''})
+                    return
+                checked_at = loop.time()
+            if event not in done:
+                await send({'type': 'http.response.body', 'body': b': keepalive\n\n', 'more_body': True})
+                continue
+            body = event.result()
+            await send({'type': 'http.response.body', 'body': body, 'more_body': body is not RESYNC})
+            if body is RESYNC:
+                return
+    finally:
+        broker.unsubscribe(subscription)
+        gone.cancel()
@@ -0,0 +1,106 @@
+import csv
+import json
+
+from django.http import StreamingHttpResponse
+from rest_framework.renderers import BaseRenderer
+
+from service.api.imports import chunked
+
+VEHICLE_EXPORT_FIELDS = (
+    'id', 'licence_plate', 'name', 'model', 'year_of_manufacture',
+    'office_id', 'office__office_name', 'office__address', 'office__country', 'office__city', 'office__region',
+    'driver_id', 'driver__first_name', 'driver__last_name', 'driver__email',
+)
+
+
+class NDJSONRenderer(BaseRenderer):
+    """Only renders error responses of streaming endpoints, the rows themselves are written by stream_ndjson()"""
+    media_type = 'application/x-ndjson'
+    format = 'ndjson'
+    charset = 'utf-8'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        return (json.dumps(data) + '\n').encode(self.charset)
+
+
+class CSVRenderer(BaseRenderer):
+    """Only renders error responses of streaming endpoints, the rows themselves are written by stream_csv()"""
+    media_type = 'text/csv'
+    format = 'csv'
+    charset = 'utf-8'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        if not isinstance(data, dict):
+            data = {'detail': data}
+        buffer = Echo()
+        writer = csv.writer(buffer)
+        lines = [writer.writerow(data.keys()), writer.writerow(data.values())]
+        return ''.join(lines).encode(self.charset)
+
+
+class Echo:
+    """File-like object for csv.writer that hands the written line back instead of storing it"""
+
+    def write(self, value):
+        return value
+
+
+def nest_vehicle(row):
+    """Turn a flat values() row into the vehicle with office and driver inlined"""
+    office_id, driver_id = row['office_id'], row['driver_id']
+    return {
+        'id': row['id'],
+        'licence_plate': row['licence_plate'],
+        'name': row['name'],
+        'model': row['model'],
+        'year_of_manufacture': row['year_of_manufacture'],
+        'office': None if office_id is None else {
+            'id': office_id,
+            'office_name': row['office__office_name'],
+            'address': row['office__address'],
+            'country': row['office__country'],
+            'city': row['office__city'],
+            'region': row['office__region'],
+        },
+        'driver': None if driver_id is None else {
+            'id': driver_id,
+            'first_name': row['driver__first_name'],
+            'last_name': row['driver__last_name'],
+            'email': row['driver__email'],
+        },
+    }
+
+
+def stream_ndjson(rows, batch_size):
+    for batch in chunked(rows, batch_size):
+        yield ''.join(json.dumps(nest_vehicle(row)) + '\n' for row in batch)
+
+
+def stream_csv(rows, batch_size):
+    writer = csv.writer(Echo())
+    yield writer.writerow(VEHICLE_EXPORT_FIELDS)
+    for batch in chunked(rows, batch_size):
+        yield ''.join(writer.writerow([row[field] for field in VEHICLE_EXPORT_FIELDS]) for row in batch)
+
+
+def vehicle_export(queryset, export_format, chunk_size=2000):
+    """The vehicles of the queryset with office and driver joined in the same query, as (content type,
+    iterator of str pieces). Rows come from a server-side iterator as plain dicts, so memory does not grow
+    with the fleet."""
+    rows = queryset.order_by('id').values(*VEHICLE_EXPORT_FIELDS).iterator(chunk_size=chunk_size)
+    if export_format == CSVRenderer.format:
+        return 'text/csv; charset=utf-8', stream_csv(rows, chunk_size)
+    return 'application/x-ndjson', stream_ndjson(rows, chunk_size)
+
+
+def vehicle_export_response(queryset, export_format, chunk_size=2000):
+    """Stream the vehicles of the queryset, see vehicle_export()"""
+    content_type, pieces = vehicle_export(queryset, export_format, chunk_size)
+    response = StreamingHttpResponse(pieces, content_type=content_type)
+    if export_format == CSVRenderer.format:
+        response['Content-Disposition'] = 'attachment; filename="vehicles.csv"'
+    return response
@@ -0,0 +1,68 @@
+from rest_framework import serializers
+from rest_framework.permissions import SAFE_METHODS
+
+
+def query_list(request, name):
+    """?name=a,b&name=c -> ['a', 'b', 'c']"""
+    values = []
+    for value in request.query_params.getlist(name):
+        values += [item.strip() for item in value.split(',') if item.strip()]
+    return values
+
+
+def query_flag(request, name):
+    """?name=1 / true / yes"""
+    return request.query_params.get(name, '').lower() in ('1', 'true', 'yes')
+
+
+def reads_query_string(request):
+    return request is not None and request.method in SAFE_METHODS
+
+
+def requested_expansions(request, expandable_fields):
+    if not reads_query_string(request):
+        return []
+    return [name for name in query_list(request, 'expand') if name in expandable_fields]
+
+
+class DynamicFieldsMixin:
+    """Serializer mixin: on GET, ?fields=id,name keeps only these fields and ?expand=office replaces
+    the office id with the object, serialized by expandable_fields['office'].
+    Only the top-level serializer (or the child of a top-level list) reads the query string,
+    expanded objects always come out with their own full set of fields."""
+    expandable_fields = {}
+
+    def get_fields(self):
+        fields = super().get_fields()
+        request = self.context.get('request')
+        if not reads_query_string(request) or not self.is_top_level():
+            return fields
+        for name in requested_expansions(request, self.expandable_fields):
+            if name in fields:
+                fields[name] = self.expandable_fields[name](read_only=True)
+        only = query_list(request, 'fields')
+        if only:
+            fields = {name: field for name, field in fields.items() if name in only}
+        return fields
+
+    def is_top_level(self):
+        parent = self.parent
+        return parent is None or (isinstance(parent, serializers.ListSerializer) and parent.parent is None)
+
+
+class ExpandMixin:
+    """Viewset mixin: relations expanded with ?expand= are joined (select_related) or prefetched
+    in the same queryset, so an expanded page costs as many queries as a plain one"""
+
+    def filter_queryset(self, queryset):
+        queryset = super().filter_queryset(queryset)
+        expandable_fields = getattr(self.get_serializer_class(), 'expandable_fields', {})
+        joined, prefetched = [], []
+        for name in requested_expansions(self.request, expandable_fields):
+            field = queryset.model._meta.get_field(name)
+            (prefetched if field.many_to_many or field.one_to_many else joined).append(name)
+        if joined:
+            queryset = queryset.select_related(*joined)
+        if prefetched:
+            queryset = queryset.prefetch_related(*prefetched)
+        return queryset
@@ -0,0 +1,348 @@
+import codecs
+import csv
+import io
+import json
+from abc import ABC, abstractmethod
+from itertools import islice
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Max
+from rest_framework import serializers, status
+from rest_framework.exceptions import APIException
+
+from service.api.caching import bump_tenant_version
+from service import changelog, rollups, search
+from service.hashers import make_passwords
+from service.models import MyUser, Office, Upload, UploadChunk, Vehicle
+
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+NDJSON_CONTENT_TYPES = ('application/x-ndjson', 'application/ndjson', 'application/jsonl')
+CSV_CONTENT_TYPES = ('text/csv',)
+
+
+class RowError(Exception):
+    pass
+
+
+def iter_ndjson(stream):
+    """Yield (row number, dict) for every non-empty line of a NDJSON body"""
+    for number, line in enumerate(stream, start=1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError as exc:
+            yield number, RowError(f'Invalid JSON: {exc}')
+            continue
+        if not isinstance(row, dict):
+            yield number, RowError('Expected a JSON object')
+            continue
+        yield number, row
+
+
+def iter_csv(stream):
+    """Yield (row number, dict) for every data row of a CSV body with a header line. The body must be UTF-8:
+    a row that does not decode is reported and ends the body, the decoder cannot find the next row after it."""
+    reader = csv.DictReader(codecs.iterdecode(stream, 'utf-8'))
+    number = 0
+    try:
+        for number, row in enumerate(reader, start=1):
+            yield number, {key: (value if value != '' else None) for key, value in row.items()}
+    except UnicodeDecodeError as exc:
+        yield number + 1, RowError(f'Invalid UTF-8: {exc}')
+
+
+def iter_list(rows):
+    """Yield (row number, dict) for an already parsed JSON array"""
+    for number, row in enumerate(rows, start=1):
+        if not isinstance(row, dict):
+            yield number, RowError('Expected a JSON object')
+            continue
+        yield number, row
+
+
+def iter_rows(stream, content_type):
+    if stream is None:
+        return iter(())
+    if content_type in CSV_CONTENT_TYPES:
+        return iter_csv(stream)
+    return iter_ndjson(stream)
+
+
+class UploadTooLarge(APIException):
+    status_code = status.HTTP_413_REQUEST_ENTITY_TOO_LARGE
+    default_detail = 'The body is larger than a background import takes.'
+    default_code = 'upload_too_large'
+
+
+def body_payload(request, content_type):
+    """A NDJSON/CSV body kept for an import run in the background. The request stream is copied to
+    UploadChunk rows UPLOAD_CHUNK_SIZE bytes at a time, so the body is not bound by
+    DATA_UPLOAD_MAX_MEMORY_SIZE but by JOB_UPLOAD_MAX_BYTES; the job payload only holds the Upload id."""
+    limit = getattr(settings, 'JOB_UPLOAD_MAX_BYTES', 200 * 1024 * 1024)
+    try:
+        length = int(request.META.get('CONTENT_LENGTH') or 0)
+    except ValueError:
+        length = 0
+    if length > limit:
+        raise UploadTooLarge()
+    upload = Upload.objects.create(company_id=request.user.company_id, content_type=content_type)
+    try:
+        stream, number = request.stream, 0
+        while stream is not None:
+            data = stream.read(UPLOAD_CHUNK_SIZE)
+            if not data:
+                break
+            upload.size += len(data)
+            if upload.size > limit:
+                raise UploadTooLarge()
+            UploadChunk.objects.create(upload=upload, number=number, data=data)
+            number += 1
+        upload.save(update_fields=['size'])
+    except BaseException:
+        upload.delete()
+        raise
+    return {'content_type': content_type, 'upload': upload.pk}
+
+
+def write_upload(upload, pieces):
+    """Store the str/bytes pieces (a background export) in the chunks of an Upload, UPLOAD_CHUNK_SIZE bytes
+    at a time"""
+    buffer, number = bytearray(), 0
+    for piece in pieces:
+        data = piece.encode('utf-8') if isinstance(piece, str) else piece
+        buffer += data
+        upload.size += len(data)
+        while len(buffer) >= UPLOAD_CHUNK_SIZE:
+            UploadChunk.objects.create(upload=upload, number=number, data=bytes(buffer[:UPLOAD_CHUNK_SIZE]))
+            del buffer[:UPLOAD_CHUNK_SIZE]
+            number += 1
+    if buffer:
+        UploadChunk.objects.create(upload=upload, number=number, data=bytes(buffer))
+    upload.save(update_fields=['size'])
+
+
+def iter_upload(upload_id):
+    """The chunks of an Upload as bytes, one query and one chunk in memory at a time"""
+    number = 0
+    while True:
+        chunk = (UploadChunk.objects.filter(upload_id=upload_id, number=number)
+                 .values_list('data', flat=True).first())
+        if chunk is None:
+            return
+        yield bytes(chunk)
+        number += 1
+
+
+class UploadReader(io.RawIOBase):
+    """The chunks of an Upload as a binary stream, one chunk in memory at a time"""
+
+    def __init__(self, upload_id):
+        super().__init__()
+        self.upload_id = upload_id
+        self.number = 0
+        self.chunk = b''
+        self.offset = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while self.offset >= len(self.chunk):
+            chunk = (UploadChunk.objects.filter(upload_id=self.upload_id, number=self.number)
+                     .values_list('data', flat=True).first())
+            if chunk is None:
+                return 0
+            self.chunk, self.offset, self.number = bytes(chunk), 0, self.number + 1
+        size = min(len(buffer), len(self.chunk) - self.offset)
+        buffer[:size] = self.chunk[self.offset:self.offset + size]
+        self.offset += size
+        return size
+
+
+def payload_rows(payload):
+    if 'upload' in payload:
+        return iter_rows(io.BufferedReader(UploadReader(payload['upload'])), payload['content_type'])
+    # jobs queued before uploads were stored in chunks carry the body itself
+    return iter_rows(io.BytesIO(payload['body'].encode('utf-8')), payload['content_type'])
+
+
+def chunked(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+class VehicleImportSerializer(serializers.ModelSerializer):
+    """Row validation for the bulk import. Office and driver are plain ids here,
+    they are resolved for the whole chunk at once by VehicleImporter."""
+    office = serializers.IntegerField(required=False, allow_null=True, default=None)
+    driver = serializers.IntegerField(required=False, allow_null=True, default=None)
+
+    class Meta:
+        model = Vehicle
+        fields = ('licence_plate', 'name', 'model', 'year_of_manufacture', 'office', 'driver')
+
+
+class EmployeeImportSerializer(serializers.ModelSerializer):
+    """Row validation for the bulk employee import. Email uniqueness is checked per chunk by EmployeeImporter."""
+    password = serializers.CharField(write_only=True, required=True)
+    confirm_password = serializers.CharField(write_only=True, required=True)
+    email = serializers.EmailField(label="Email", required=True)
+
+    class Meta:
+        model = MyUser
+        fields = ('first_name', 'last_name', 'email', 'password', 'confirm_password')
+
+    def validate(self, data):
+        if data['password'] != data['confirm_password']:
+            raise serializers.ValidationError('Passwords don`t match')
+        return data
+
+
+def last_pk(model):
+    """Highest id of a table; read in the transaction of a bulk_create before it, the ids over it are the
+    inserted rows (SQLite bulk inserts return no ids)"""
+    return model.objects.aggregate(last=Max('pk'))['last'] or 0
+
+
+class BulkImporter(ABC):
+    """Validate and insert rows chunk by chunk, so memory only depends on chunk_size.
+    Subclasses implement import_chunk() with set-based lookups and one bulk insert per chunk."""
+    serializer_class = None
+    chunk_size = 1000
+    max_errors = 1000
+
+    def __init__(self, company, chunk_size=None, max_errors=None):
+        self.company = company
+        self.chunk_size = chunk_size or self.chunk_size
+        self.max_errors = max_errors or self.max_errors
+        self.created = 0
+        self.error_count = 0
+        self.errors = []
+
+    def run(self, rows):
+        for chunk in chunked(rows, self.chunk_size):
+            self.import_chunk(self.validate_chunk(chunk))
+        # bulk_create sends no post_save, so the cached responses are dropped here
+        if self.created:
+            bump_tenant_version(self.company.pk if self.company else None)
+        return self.report()
+
+    def report(self):
+        return {
+            'created': self.created,
+            'error_count': self.error_count,
+            'errors': self.errors,
+        }
+
+    def add_error(self, number, detail):
+        self.error_count += 1
+        if len(self.errors) < self.max_errors:
+            self.errors.append({'row': number, 'errors': detail})
+
+    def validate_chunk(self, chunk):
+        """Per-row validation without DB access, returns [(row number, validated data)]"""
+        valid = []
+        for number, row in chunk:
+            if isinstance(row, RowError):
+                self.add_error(number, [str(row)])
+                continue
+            serializer = self.serializer_class(data=row)
+            if serializer.is_valid():
+                valid.append((number, serializer.validated_data))
+            else:
+                self.add_error(number, serializer.errors)
+        return valid
+
+    @abstractmethod
+    def import_chunk(self, valid):
+        """Insert the validated rows [(row number, data)] of a chunk, add_error() for the rejected ones"""
+
+
+class VehicleImporter(BulkImporter):
+    """Each chunk costs two lookups (offices, drivers) and one bulk insert inside a transaction."""
+    serializer_class = VehicleImportSerializer
+
+    def import_chunk(self, valid):
+        office_ids = {data['office'] for _, data in valid if data['office'] is not None}
+        driver_ids = {data['driver'] for _, data in valid if data['driver'] is not None}
+        # office id -> id of the employee assigned to it
+        offices = dict(Office.objects.filter(company=self.company, id__in=office_ids).values_list('id', 'employee'))
+        drivers = set(MyUser.objects.filter(company=self.company, id__in=driver_ids).values_list('id', flat=True))
+
+        vehicles = []
+        for number, data in valid:
+            office, driver = data.pop('office'), data.pop('driver')
+            if office is not None and office not in offices:
+                self.add_error(number, {'office': [f'Invalid pk "{office}" - object does not exist.']})
+            elif driver is not None and driver not in drivers:
+                self.add_error(number, {'driver': [f'Invalid pk "{driver}" - object does not exist.']})
+            elif office is not None and driver is not None and offices[office] != driver:
+                self.add_error(number, {'non_field_errors': ['The Employee work in another office']})
+            else:
+                vehicles.append(Vehicle(company=self.company, office_id=office, driver_id=driver, **data))
+
+        if not vehicles:
+            return
+        with transaction.atomic():
+            after = last_pk(Vehicle)
+            Vehicle.objects.bulk_create(vehicles, batch_size=self.chunk_size)
+            rollups.add_vehicles(vehicles)
+            search.index_inserted('vehicle', after)
+            changelog.record_inserted('vehicle', after)
+        self.created += len(vehicles)
+
+
+class EmployeeImporter(BulkImporter):
+    """Each chunk costs one email__in lookup, one parallel hashing pass and one bulk insert."""
+    serializer_class = EmployeeImportSerializer
+    chunk_size = 500
+
+    def import_chunk(self, valid):
+        emails = [data['email'] for _, data in valid]
+        taken = set(MyUser.objects.filter(email__in=emails).values_list('email', flat=True))
+
+        accepted = []
+        for number, data in valid:
+            email = data['email']
+            if email in taken:
+                self.add_taken(number, email)
+                continue
+            taken.add(email)
+            data.pop('confirm_password')
+            accepted.append((number, data))
+
+        hashes = make_passwords(data.pop('password') for _, data in accepted)
+        users = [
+            (number, MyUser(company=self.company, password=hashed, **data))
+            for (number, data), hashed in zip(accepted, hashes)
+        ]
+        while users:
+            try:
+                with transaction.atomic():
+                    after = last_pk(MyUser)
+                    MyUser.objects.bulk_create([user for _, user in users], batch_size=self.chunk_size)
+                    search.index_inserted('employee', after)
+                    changelog.record_inserted('employee', after)
+            except IntegrityError:
+                # another request registered some of the emails after the lookup: report them and insert the rest
+                taken = set(MyUser.objects.filter(email__in=[user.email for _, user in users])
+                            .values_list('email', flat=True))
+                if not taken:
+                    raise
+                for number, user in users:
+                    if user.email in taken:
+                        self.add_taken(number, user.email)
+                users = [(number, user) for number, user in users if user.email not in taken]
+                continue
+            self.created += len(users)
+            return
+
+    def add_taken(self, number, email):
+        self.add_error(number, {'non_field_errors': [f'This {email} has already registration']})
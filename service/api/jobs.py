@@ -0,0 +1,25 @@
+from django.urls import reverse
+from rest_framework import serializers, status
+from rest_framework.response import Response
+
+from service.api.fieldsets import DynamicFieldsMixin, query_flag
+from service.models import Job
+
+
+class JobSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
+    class Meta:
+        model = Job
+        fields = ('id', 'kind', 'status', 'priority', 'attempts', 'max_attempts', 'result', 'error',
+                  'created_at', 'started_at', 'finished_at')
+        read_only_fields = fields
+
+
+def wants_async(request):
+    """?async=1 or a `Prefer: respond-async` header (RFC 7240)"""
+    return query_flag(request, 'async') or 'respond-async' in request.headers.get('Prefer', '').lower()
+
+
+def accepted(request, job):
+    """202 with the queued job; Location is its status URL"""
+    location = request.build_absolute_uri(reverse('jobs-detail', args=[job.pk]))
+    return Response(JobSerializer(job).data, status=status.HTTP_202_ACCEPTED, headers={'Location': location})
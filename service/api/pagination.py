@@ -0,0 +1,114 @@
+from base64 import b64decode, b64encode
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.exceptions import FieldDoesNotExist
+from django.db.models import F, Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination, _positive_int
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+
+class KeysetPagination(BasePagination):
+    """Cursor pagination ordered on (company, id).
+    The cursor holds the key of the last row of the page, so every page is one indexed range scan
+    no matter how deep the client goes. Models without a company field are ordered on id only."""
+    page_size = getattr(settings, 'API_PAGE_SIZE', 100)
+    page_size_query_param = 'page_size'
+    max_page_size = getattr(settings, 'API_MAX_PAGE_SIZE', 1000)
+    cursor_query_param = 'cursor'
+    invalid_cursor_message = 'Invalid cursor'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        self.has_company = self.model_has_company(queryset.model)
+
+        cursor = self.decode_cursor(request)
+        if cursor is not None:
+            queryset = queryset.filter(self.after_cursor(*cursor))
+        queryset = queryset.order_by(*self.get_ordering())
+
+        results = list(queryset[:self.page_size + 1])
+        self.has_next = len(results) > self.page_size
+        self.page = results[:self.page_size]
+        return self.page
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([
+            ('next', self.get_next_link()),
+            ('results', data),
+        ]))
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'properties': {
+                'next': {'type': 'string', 'nullable': True},
+                'results': schema,
+            },
+        }
+
+    def get_page_size(self, request):
+        if self.page_size_query_param:
+            try:
+                return _positive_int(
+                    request.query_params[self.page_size_query_param],
+                    strict=True,
+                    cutoff=self.max_page_size,
+                )
+            except (KeyError, ValueError):
+                pass
+        return self.page_size
+
+    def get_ordering(self):
+        if self.has_company:
+            return F('company').asc(nulls_first=True), 'id'
+        return 'id',
+
+    def after_cursor(self, company, pk):
+        """Rows strictly after (company, pk) in get_ordering() order."""
+        if not self.has_company:
+            return Q(id__gt=pk)
+        if company is None:
+            return Q(company__isnull=True, id__gt=pk) | Q(company__isnull=False)
+        return Q(company__gt=company) | Q(company=company, id__gt=pk)
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        company, pk = self.row_key(self.page[-1])
+        url = self.request.build_absolute_uri()
+        return replace_query_param(url, self.cursor_query_param, self.encode_cursor(company, pk))
+
+    def row_key(self, row):
+        """(company, id) of a model instance or of a values() dict"""
+        if isinstance(row, dict):
+            return row.get('company_id') if self.has_company else None, row['id']
+        return row.company_id if self.has_company else None, row.pk
+
+    def get_previous_link(self):
+        return None
+
+    def encode_cursor(self, company, pk):
+        raw = f'{"" if company is None else company}:{pk}'
+        return b64encode(raw.encode('ascii')).decode('ascii')
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if encoded is None:
+            return None
+        try:
+            company, pk = b64decode(encoded.encode('ascii')).decode('ascii').split(':')
+            return (int(company) if company else None), int(pk)
+        except (TypeError, ValueError):
+            raise NotFound(self.invalid_cursor_message)
+
+    @staticmethod
+    def model_has_company(model):
+        try:
+            model._meta.get_field('company')
+        except FieldDoesNotExist:
+            return False
+        return True
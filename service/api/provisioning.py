@@ -0,0 +1,179 @@
+from django.conf import settings
+from django.db import IntegrityError, connection, transaction
+from rest_framework import permissions, serializers
+
+from service import changelog, rollups, search
+from service.api.imports import EmployeeImportSerializer
+from service.api.serializers import CompaniesSerializer
+from service.hashers import make_passwords
+from service.models import Company, MyUser, Office, Vehicle
+
+
+class IsSuperUser(permissions.BasePermission):
+    """Provisioning creates tenants, so it is for the operators of the service, not for company admins"""
+
+    def has_permission(self, request, view):
+        return bool(request.user and request.user.is_superuser)
+
+
+class ProvisionOfficeSerializer(serializers.ModelSerializer):
+    """The office employee is the email of one of the document's employees"""
+    employee = serializers.EmailField(required=False, allow_null=True, default=None)
+
+    class Meta:
+        model = Office
+        fields = ('office_name', 'address', 'country', 'city', 'region', 'employee')
+
+
+class ProvisionVehicleSerializer(serializers.ModelSerializer):
+    """Office is the office_name of one of the document's offices, driver the email of one of its employees"""
+    office = serializers.CharField(required=False, allow_null=True, default=None)
+    driver = serializers.EmailField(required=False, allow_null=True, default=None)
+
+    class Meta:
+        model = Vehicle
+        fields = ('licence_plate', 'name', 'model', 'year_of_manufacture', 'office', 'driver')
+
+
+class TenantSerializer(serializers.Serializer):
+    """A whole tenant in one document. References between its parts are checked here, without the DB."""
+    company = CompaniesSerializer()
+    admin = EmployeeImportSerializer()
+    employees = EmployeeImportSerializer(many=True, required=False, default=list)
+    offices = ProvisionOfficeSerializer(many=True, required=False, default=list)
+    vehicles = ProvisionVehicleSerializer(many=True, required=False, default=list)
+
+    def to_internal_value(self, data):
+        limit = getattr(settings, 'TENANT_PROVISION_MAX_ROWS', 100000)
+        if isinstance(data, dict):
+            rows = sum(len(data.get(name) or []) for name in ('employees', 'offices', 'vehicles'))
+            if rows > limit:
+                raise serializers.ValidationError(f'At most {limit} employees, offices and vehicles in one document')
+        return super().to_internal_value(data)
+
+    def validate(self, data):
+        emails = [data['admin']['email']] + [employee['email'] for employee in data['employees']]
+        if len(set(emails)) != len(emails):
+            raise serializers.ValidationError({'employees': ['Emails repeat in the document']})
+        employees = set(emails[1:])
+
+        offices = {}
+        for office in data['offices']:
+            if office['office_name'] in offices:
+                raise serializers.ValidationError({'offices': [f'Office {office["office_name"]} repeats']})
+            if office['employee'] is not None and office['employee'] not in employees:
+                raise serializers.ValidationError({'offices': [f'Unknown employee {office["employee"]}']})
+            offices[office['office_name']] = office['employee']
+        assigned = [employee for employee in offices.values() if employee is not None]
+        if len(set(assigned)) != len(assigned):
+            raise serializers.ValidationError({'offices': ['An employee can be assigned to one office only']})
+
+        for vehicle in data['vehicles']:
+            office, driver = vehicle['office'], vehicle['driver']
+            if office is not None and office not in offices:
+                raise serializers.ValidationError({'vehicles': [f'Unknown office {office}']})
+            if driver is not None and driver not in employees:
+                raise serializers.ValidationError({'vehicles': [f'Unknown driver {driver}']})
+            if office is not None and driver is not None and offices[office] != driver:
+                raise serializers.ValidationError({'vehicles': ['The Employee work in another office']})
+        return data
+
+
+def insert(model, objects):
+    """Insert objects and set their ids with a fixed number of statements, where bulk_create() would
+    split them into batches of 999 parameters on SQLite and leave the ids unset.
+    On SQLite that is one executemany() and one SELECT MAX(id): inside a transaction the first INSERT
+    takes the write lock until the commit, so the new rows get the highest, consecutive ids."""
+    if not objects:
+        return
+    if connection.features.can_return_rows_from_bulk_insert:
+        model.objects.bulk_create(objects)
+        return
+    quote = connection.ops.quote_name
+    fields = [field for field in model._meta.concrete_fields if not field.primary_key]
+    sql = 'INSERT INTO {} ({}) VALUES ({})'.format(
+        quote(model._meta.db_table),
+        ', '.join(quote(field.column) for field in fields),
+        ', '.join(['%s'] * len(fields)),
+    )
+    rows = [[field.get_db_prep_save(field.pre_save(obj, True), connection) for field in fields] for obj in objects]
+    with connection.cursor() as cursor:
+        cursor.executemany(sql, rows)
+        cursor.execute(f'SELECT MAX({quote(model._meta.pk.column)}) FROM {quote(model._meta.db_table)}')
+        last = cursor.fetchone()[0]
+    for pk, obj in zip(range(last - len(objects) + 1, last + 1), objects):
+        obj.pk = pk
+        obj._state.adding = False
+        obj._state.db = connection.alias
+
+
+class TenantProvisioner:
+    """Create a company with its admin, employees, offices and vehicles from a validated TenantSerializer
+    document, in one transaction and a fixed number of queries: the email check, one insert per table,
+    the rollups recount, the search index and the change log. Passwords are hashed before the transaction starts."""
+
+    def __init__(self, data):
+        self.data = data
+
+    def run(self):
+        data = self.data
+        people = [data['admin']] + data['employees']
+        emails = [person['email'] for person in people]
+        taken = list(MyUser.objects.filter(email__in=emails).values_list('email', flat=True))
+        if taken:
+            raise self.emails_taken(taken)
+        hashes = make_passwords(person['password'] for person in people)
+        try:
+            return self.create(people, hashes)
+        except IntegrityError:
+            # an email was registered by someone else while the passwords were hashed
+            raise self.emails_taken(MyUser.objects.filter(email__in=emails).values_list('email', flat=True))
+
+    @staticmethod
+    def emails_taken(emails):
+        return serializers.ValidationError({
+            'employees': [f'This {email} has already registration' for email in emails],
+        })
+
+    def create(self, people, hashes):
+        data = self.data
+        with transaction.atomic():
+            company = Company(**data['company'])
+            insert(Company, [company])
+
+            users = [
+                MyUser(company=company, password=hashed, is_staff=number == 0, email=person['email'],
+                       first_name=person.get('first_name', ''), last_name=person.get('last_name', ''))
+                for number, (person, hashed) in enumerate(zip(people, hashes))
+            ]
+            insert(MyUser, users)
+            by_email = {user.email: user.pk for user in users}
+
+            offices = [
+                Office(company=company, employee_id=by_email.get(office['employee']),
+                       **{key: value for key, value in office.items() if key != 'employee'})
+                for office in data['offices']
+            ]
+            insert(Office, offices)
+            by_name = {office.office_name: office.pk for office in offices}
+
+            vehicles = [
+                Vehicle(company=company, office_id=by_name.get(vehicle['office']),
+                        driver_id=by_email.get(vehicle['driver']),
+                        **{key: value for key, value in vehicle.items() if key not in ('office', 'driver')})
+                for vehicle in data['vehicles']
+            ]
+            insert(Vehicle, vehicles)
+
+            # no post_save was sent for any of it
+            rollups.rebuild(company.pk)
+            search.reindex_company(company.pk)
+            changelog.record_company(company.pk)
+
+        return {
+            'company': company.pk,
+            'admin': users[0].pk,
+            'employees': [user.pk for user in users[1:]],
+            'offices': [office.pk for office in offices],
+            'vehicles': [vehicle.pk for vehicle in vehicles],
+        }
@@ -0,0 +1,166 @@
+from collections import Counter
+
+from django.db import connection, transaction
+from django.db.models import Count, F, IntegerField, Value
+from rest_framework import serializers
+
+from service import changelog, rollups
+from service.api.caching import bump_tenant_version
+from service.models import Change, MyUser, Office, Vehicle
+
+
+class ChangeSerializer(serializers.Serializer):
+    vehicle = serializers.IntegerField()
+    office = serializers.IntegerField(required=False, allow_null=True, default=None)
+    driver = serializers.IntegerField(required=False, allow_null=True, default=None)
+
+
+class TargetSerializer(serializers.Serializer):
+    office = serializers.IntegerField(required=False, allow_null=True, default=None)
+    driver = serializers.IntegerField(required=False, allow_null=True, default=None)
+
+
+class ReassignmentSerializer(serializers.Serializer):
+    """Either a list of changes: {"changes": [{"vehicle": 1, "office": 2, "driver": 3}, ...]}
+    or every vehicle matching a filter: {"filter": {"office": 2}, "target": {"office": 5, "driver": null}}.
+    A missing office/driver means none, as in VehicleSerializer; a missing filter key matches anything."""
+    changes = ChangeSerializer(many=True, required=False)
+    filter = serializers.DictField(child=serializers.IntegerField(allow_null=True), required=False)
+    target = TargetSerializer(required=False)
+
+    def validate_filter(self, value):
+        unknown = set(value) - {'office', 'driver'}
+        if unknown:
+            raise serializers.ValidationError(f'Unknown filter field(s): {", ".join(sorted(unknown))}')
+        return value
+
+    def validate(self, data):
+        if ('changes' in data) == ('filter' in data or 'target' in data):
+            raise serializers.ValidationError('Send either changes, or filter and target')
+        if 'changes' not in data and 'target' not in data:
+            raise serializers.ValidationError({'target': ['This field is required.']})
+        return data
+
+
+NULL = Value(None, output_field=IntegerField())
+
+
+class VehicleReassignment:
+    """Move vehicles between offices and drivers of a company with a constant number of statements:
+    one UNION query checks every vehicle, office and driver involved, the vehicles are updated with a
+    single executemany() (changes) or a single UPDATE (filter), the fleet rollups get the
+    aggregated deltas and the change log a set-based entry per vehicle. All in one transaction."""
+
+    def __init__(self, company):
+        self.company = company
+
+    def run(self, data):
+        with transaction.atomic():
+            if 'changes' in data:
+                updated = self.apply_changes(data['changes'])
+            else:
+                updated = self.apply_filter(data.get('filter', {}), data['target'])
+        if updated:
+            bump_tenant_version(self.company.pk)
+        return {'updated': updated}
+
+    def lookup(self, vehicle_ids, office_ids, driver_ids):
+        """({vehicle: (office, driver, year)}, {office: employee}, {driver ids}) of the company, one query"""
+        company = self.company
+        # every column but id is an annotation, so the three SELECTs line up in the same order
+        vehicles = Vehicle.objects.filter(company=company, id__in=vehicle_ids).order_by().annotate(
+            kind=Value('vehicle'), first=F('office_id'), second=F('driver_id'), third=F('year_of_manufacture'))
+        offices = Office.objects.filter(company=company, id__in=office_ids).order_by().annotate(
+            kind=Value('office'), first=F('employee_id'), second=NULL, third=NULL)
+        drivers = MyUser.objects.filter(company=company, id__in=driver_ids).order_by().annotate(
+            kind=Value('driver'), first=NULL, second=NULL, third=NULL)
+        columns = ('kind', 'id', 'first', 'second', 'third')
+        found_vehicles, found_offices, found_drivers = {}, {}, set()
+        rows = vehicles.values_list(*columns).union(
+            offices.values_list(*columns), drivers.values_list(*columns), all=True)
+        for kind, pk, first, second, third in rows:
+            if kind == 'vehicle':
+                found_vehicles[pk] = (first, second, third)
+            elif kind == 'office':
+                found_offices[pk] = first
+            else:
+                found_drivers.add(pk)
+        return found_vehicles, found_offices, found_drivers
+
+    @staticmethod
+    def target_errors(office, driver, offices, drivers):
+        errors = {}
+        if office is not None and office not in offices:
+            errors['office'] = [f'Invalid pk "{office}" - object does not exist.']
+        if driver is not None and driver not in drivers:
+            errors['driver'] = [f'Invalid pk "{driver}" - object does not exist.']
+        if not errors and office is not None and driver is not None and offices[office] != driver:
+            errors['non_field_errors'] = ['The Employee work in another office']
+        return errors
+
+    def apply_changes(self, changes):
+        vehicles, offices, drivers = self.lookup(
+            {change['vehicle'] for change in changes},
+            {change['office'] for change in changes if change['office'] is not None},
+            {change['driver'] for change in changes if change['driver'] is not None},
+        )
+        errors = {}
+        for number, change in enumerate(changes):
+            row_errors = self.target_errors(change['office'], change['driver'], offices, drivers)
+            if change['vehicle'] not in vehicles:
+                row_errors['vehicle'] = [f'Invalid pk "{change["vehicle"]}" - object does not exist.']
+            if row_errors:
+                errors[number] = row_errors
+        if errors:
+            raise serializers.ValidationError({'changes': errors})
+
+        # the last change of a vehicle wins
+        final = {change['vehicle']: (change['office'], change['driver']) for change in changes}
+        deltas = Counter()
+        rows = []
+        for pk, (office, driver) in final.items():
+            old_office, old_driver, year = vehicles[pk]
+            if (office, driver) == (old_office, old_driver):
+                continue
+            deltas.update(rollups.contributions(rollups.vehicle_state(self.company.pk, office, driver, year), 1))
+            deltas.update(rollups.contributions(
+                rollups.vehicle_state(self.company.pk, old_office, old_driver, year), -1))
+            rows.append((office, driver, pk, self.company.pk))
+        if rows:
+            changelog.record_queryset(Change.VEHICLE, Vehicle.objects.filter(pk__in=[row[2] for row in rows]))
+            quote = connection.ops.quote_name
+            with connection.cursor() as cursor:
+                cursor.executemany(
+                    f'UPDATE {quote(Vehicle._meta.db_table)} SET {quote("office_id")} = %s, '
+                    f'{quote("driver_id")} = %s WHERE {quote("id")} = %s AND {quote("company_id")} = %s',
+                    rows,
+                )
+            rollups.apply(deltas)
+        return len(rows)
+
+    def apply_filter(self, filters, target):
+        office, driver = target['office'], target['driver']
+        _, offices, drivers = self.lookup(
+            [], [office] if office is not None else [], [driver] if driver is not None else [])
+        errors = self.target_errors(office, driver, offices, drivers)
+        if errors:
+            raise serializers.ValidationError({'target': errors})
+
+        queryset = Vehicle.objects.filter(company=self.company)
+        for name, value in filters.items():
+            queryset = queryset.filter(**{f'{name}__isnull': True} if value is None else {name: value})
+        # vehicles already in place would only churn the rollups
+        queryset = queryset.exclude(**{'office__isnull': True} if office is None else {'office': office},
+                                    **{'driver__isnull': True} if driver is None else {'driver': driver})
+
+        deltas = Counter()
+        groups = queryset.order_by().values_list('office_id', 'driver_id', 'year_of_manufacture').annotate(
+            total=Count('id'))
+        for old_office, old_driver, year, total in groups:
+            deltas.update(rollups.contributions(rollups.vehicle_state(self.company.pk, office, driver, year), total))
+            deltas.update(rollups.contributions(
+                rollups.vehicle_state(self.company.pk, old_office, old_driver, year), -total))
+        changelog.record_queryset(Change.VEHICLE, queryset)
+        updated = queryset.update(office_id=office, driver_id=driver)
+        rollups.apply(deltas)
+        return updated
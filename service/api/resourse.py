@@ -1,14 +1,38 @@
-from django.contrib.auth.hashers import make_password
+from django.conf import settings
+from django.db import transaction
+from django.http import StreamingHttpResponse
 from django_filters.rest_framework import DjangoFilterBackend
 from rest_framework import viewsets, status, permissions
+from rest_framework.decorators import action
+from rest_framework.exceptions import NotFound, UnsupportedMediaType
 from rest_framework.permissions import AllowAny, IsAdminUser
 from rest_framework.response import Response
+from rest_framework.throttling import ScopedRateThrottle
 from rest_framework.authtoken.views import ObtainAuthToken
 from rest_framework.generics import get_object_or_404
+from rest_framework.utils.urls import replace_query_param
+from service.api.authentication import token_cache
+from service.api.caching import CachedResponseMixin
+from service.api.conditional import ConditionalMixin
+from service.api.deletions import BackgroundDeleteMixin, DeletionSerializer
+from service.api.events import issue_ticket
+from service.api.exports import NDJSONRenderer, CSVRenderer, vehicle_export_response
+from service.api.fastlist import FastListMixin
+from service.api.fieldsets import ExpandMixin
+from service.api.imports import VehicleImporter, EmployeeImporter, iter_rows, iter_list, NDJSON_CONTENT_TYPES, \
+    CSV_CONTENT_TYPES, body_payload, iter_upload
+from service.api.jobs import JobSerializer, wants_async, accepted
+from service.api.pagination import KeysetPagination
+from service.api.provisioning import IsSuperUser, TenantSerializer, TenantProvisioner
+from service.api.reassignment import ReassignmentSerializer, VehicleReassignment
+from service.api.sync import sync_page
 from service.api.serializers import MyAuthTokenSerializer, EmployeeCreateSerializer, \
     CompaniesSerializer, ProfileSerializer, OfficeSerializer, OfficeDetailSerializer, AssignEmployeeToOfficeSerializer, \
     VehicleSerializer, UserRegisterSerializer
-from service.models import MyUser, Company, Office, Vehicle
+from service.hashers import get_hashing_service
+from service.models import MyUser, Company, Office, Vehicle, Deletion, Job, Upload
+from service.rollups import fleet_stats
+from service import jobs, search
 from rest_framework.authtoken.models import Token
 
 
@@ -27,18 +51,33 @@ class CompanyCreateViewSet(viewsets.ModelViewSet):
         if serializer.is_valid():
             company = serializer.validated_data['company']
             company_name = company['company_name']
-            company_obj = Company.objects.create(company_name=company_name)
-            serializer.validated_data['company'] = company_obj
             serializer.validated_data.pop('confirm_password')
-            user = MyUser.objects.create(is_staff=True, **serializer.validated_data)
-            user.set_password(serializer.validated_data['password'])
-            user.save()
-            company_obj.save()
+            password = get_hashing_service().make_password(serializer.validated_data.pop('password'))
+            # company and admin together or nothing
+            with transaction.atomic():
+                company_obj = Company.objects.create(company_name=company_name)
+                serializer.validated_data['company'] = company_obj
+                MyUser.objects.create(is_staff=True, password=password, **serializer.validated_data)
             data = {'success': "Company is created successfully"}
             return Response(data=data, status=status.HTTP_201_CREATED)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 
+class ProvisionViewSet(viewsets.ViewSet):
+    """Superuser creates a whole tenant - company, admin, employees, offices and vehicles - from one document,
+    in one transaction. Answers the ids of everything created, in the order of the document.
+    Self-service signup stays the single admin of CompanyCreateViewSet."""
+    permission_classes = [IsSuperUser, ]
+    throttle_classes = [ScopedRateThrottle, ]
+    throttle_scope = 'provision'
+
+    def create(self, request, *args, **kwargs):
+        serializer = TenantSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        created = TenantProvisioner(serializer.validated_data).run()
+        return Response(data=created, status=status.HTTP_201_CREATED)
+
+
 class AuthToken(ObtainAuthToken):
     """Create token by Email"""
     serializer_class = MyAuthTokenSerializer
@@ -48,17 +87,18 @@ class AuthToken(ObtainAuthToken):
         if serializer.is_valid():
             user = serializer.validated_data['user']
             token = Token.objects.get_or_create(user=user)
-
+            token_cache.set(token[0])
             return Response({'token': token[0].key, 'email': user.email})
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 
-class EmployeeViewSet(viewsets.ModelViewSet):
+class EmployeeViewSet(ConditionalMixin, FastListMixin, viewsets.ModelViewSet):
     """Admin can create an employee of his company(without field admin), can see list of company employees
     and filter them by first name, last name, email"""
     permission_classes = [IsAdminUser, ]
     serializer_class = EmployeeCreateSerializer
     queryset = MyUser.objects.all()
+    pagination_class = KeysetPagination
     filter_backends = [DjangoFilterBackend]
     filterset_fields = ['first_name', 'last_name', 'email']
 
@@ -71,23 +111,38 @@ class EmployeeViewSet(viewsets.ModelViewSet):
         if serializer.is_valid():
             company = self.request.user.company
             serializer.validated_data.pop('confirm_password')
-            user = MyUser.objects.create(company=company, **serializer.validated_data)
-            user.set_password(serializer.validated_data['password'])
-            user.save()
-            company.save()
+            password = get_hashing_service().make_password(serializer.validated_data.pop('password'))
+            MyUser.objects.create(company=company, password=password, **serializer.validated_data)
             data = {'success': 'You assign an employee to the company'}
             return Response(data=data, status=status.HTTP_201_CREATED)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
+    @action(detail=False, methods=['post'], url_path='bulk')
+    def bulk_import(self, request, *args, **kwargs):
+        """Admin creates many employees at once: a JSON array, or a NDJSON/CSV stream for big HR syncs"""
+        content_type = request.content_type.split(';')[0].strip()
+        if content_type in NDJSON_CONTENT_TYPES + CSV_CONTENT_TYPES:
+            rows = iter_rows(request.stream, content_type)
+        elif isinstance(request.data, list):
+            rows = iter_list(request.data)
+        else:
+            return Response(data={'Expected a list of employees'}, status=status.HTTP_400_BAD_REQUEST)
+        importer = EmployeeImporter(self.request.user.company)
+        report = importer.run(rows)
+        if report['created'] or not report['error_count']:
+            return Response(data=report, status=status.HTTP_201_CREATED)
+        return Response(data=report, status=status.HTTP_400_BAD_REQUEST)
+
     def get_queryset(self):
         queryset = MyUser.objects.filter(company=self.request.user.company, is_staff=False)
         return queryset
 
 
-class EmployeeUpViewsSet(viewsets.ModelViewSet):
+class EmployeeUpViewsSet(BackgroundDeleteMixin, ConditionalMixin, viewsets.ModelViewSet):
     """Admin can change(first name, last name, password, NOT email), see details(first name, last name, email)
     and delete employee"""
     permission_classes = [IsAdminUser, ]
+    deletion_target = Deletion.EMPLOYEE
     serializer_class = ProfileSerializer
     queryset = MyUser.objects.all()
 
@@ -110,20 +165,14 @@ class EmployeeUpViewsSet(viewsets.ModelViewSet):
         else:
             return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
-    def delete(self, request, pk, format=None):
-        pk = self.kwargs.get('pk')
-        office = get_object_or_404(MyUser.objects.filter(id=pk, company=self.request.user.company))
-        office.delete()
-        return Response(status=status.HTTP_204_NO_CONTENT)
-
     def perform_update(self, serializer):
-        hashed_password = make_password(serializer.validated_data['password'])
+        hashed_password = get_hashing_service().make_password(serializer.validated_data['password'])
         serializer.validated_data['password'] = hashed_password
         employee = super(EmployeeUpViewsSet, self).perform_update(serializer)
         return employee
 
 
-class CompanyViewSet(viewsets.ModelViewSet):
+class CompanyViewSet(ConditionalMixin, CachedResponseMixin, viewsets.ModelViewSet):
     """ As an employee/admin you able to add company info. Admin can change name and address"""
     serializer_class = CompaniesSerializer
     queryset = Company.objects.all()
@@ -138,6 +187,7 @@ class CompanyViewSet(viewsets.ModelViewSet):
         serializer = CompaniesSerializer(instance=company, data=request.data, partial=True)
 
         if serializer.is_valid():
+            self.check_if_match(company)
             serializer.save()
             return Response(serializer.errors, status=status.HTTP_200_OK)
         else:
@@ -150,7 +200,7 @@ class CompanyViewSet(viewsets.ModelViewSet):
             return [permissions.IsAdminUser()]
 
 
-class ProfileViewSet(viewsets.ModelViewSet):
+class ProfileViewSet(ConditionalMixin, viewsets.ModelViewSet):
     """An employee can see his profile(first name, last name, email) and change the password"""
     serializer_class = ProfileSerializer
     queryset = MyUser.objects.all()
@@ -165,17 +215,19 @@ class ProfileViewSet(viewsets.ModelViewSet):
         serializer = ProfileSerializer(instance=user, data=request.data, partial=True)
 
         if serializer.is_valid():
-            user.set_password(serializer.validated_data.get('password'))
+            self.check_if_match(user)
+            user.password = get_hashing_service().make_password(serializer.validated_data.get('password'))
             user.save()
             return Response(serializer.errors, status=status.HTTP_200_OK)
         else:
             return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 
-class OfficeViewSet(viewsets.ModelViewSet):
+class OfficeViewSet(ConditionalMixin, CachedResponseMixin, FastListMixin, viewsets.ModelViewSet):
     """Admin can create the office, and admin/employee can see list of company offices"""
     serializer_class = OfficeSerializer
     queryset = Office.objects.all()
+    pagination_class = KeysetPagination
     filter_backends = [DjangoFilterBackend]
     filterset_fields = ['country', 'city']
 
@@ -202,9 +254,10 @@ class OfficeViewSet(viewsets.ModelViewSet):
             return [permissions.IsAdminUser()]
 
 
-class DetailOfficeViewSet(viewsets.ModelViewSet):
+class DetailOfficeViewSet(BackgroundDeleteMixin, ConditionalMixin, ExpandMixin, viewsets.ModelViewSet):
     """Admin can change/delete/get details one of his offices"""
     permission_classes = [IsAdminUser, ]
+    deletion_target = Deletion.OFFICE
     serializer_class = OfficeDetailSerializer
     queryset = Office.objects.all()
 
@@ -214,17 +267,12 @@ class DetailOfficeViewSet(viewsets.ModelViewSet):
         serializer = OfficeDetailSerializer(instance=office, data=request.data, partial=True)
 
         if serializer.is_valid():
+            self.check_if_match(office)
             serializer.save()
             return Response(serializer.errors, status=status.HTTP_200_OK)
         else:
             return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
-    def delete(self, request, pk, format=None):
-        pk = self.kwargs.get('pk')
-        office = get_object_or_404(Office.objects.filter(id=pk, company=self.request.user.company))
-        office.delete()
-        return Response(status=status.HTTP_204_NO_CONTENT)
-
     def get_queryset(self):
         pk = self.kwargs.get('pk')
         queryset = Office.objects.filter(id=pk, company=self.request.user.company)
@@ -232,7 +280,7 @@ class DetailOfficeViewSet(viewsets.ModelViewSet):
         return queryset
 
 
-class AssignEmployeeToOfficeViewSet(viewsets.ModelViewSet):
+class AssignEmployeeToOfficeViewSet(ConditionalMixin, ExpandMixin, viewsets.ModelViewSet):
     """Admin can assign employee to one of companies offices"""
     permission_classes = [IsAdminUser, ]
     serializer_class = AssignEmployeeToOfficeSerializer
@@ -244,6 +292,7 @@ class AssignEmployeeToOfficeViewSet(viewsets.ModelViewSet):
         serializer = AssignEmployeeToOfficeSerializer(instance=office, data=request.data, partial=True)
 
         if serializer.is_valid():
+            self.check_if_match(office)
             serializer.save()
             return Response(serializer.errors, status=status.HTTP_200_OK)
         else:
@@ -254,8 +303,9 @@ class AssignEmployeeToOfficeViewSet(viewsets.ModelViewSet):
         return queryset
 
 
-class EmployeeOfficeDetailViewSet(viewsets.ModelViewSet):
+class EmployeeOfficeDetailViewSet(ConditionalMixin, ExpandMixin, CachedResponseMixin, viewsets.ModelViewSet):
     """Employee cas review his office details"""
+    cache_per_user = True
     serializer_class = OfficeDetailSerializer
     queryset = Office.objects.all()
 
@@ -264,11 +314,12 @@ class EmployeeOfficeDetailViewSet(viewsets.ModelViewSet):
         return queryset
 
 
-class VehicleViewSet(viewsets.ModelViewSet):
+class VehicleViewSet(ConditionalMixin, ExpandMixin, FastListMixin, viewsets.ModelViewSet):
     """Admin can create vehicle and optionally add office and driver"""
     permission_classes = [IsAdminUser, ]
     serializer_class = VehicleSerializer
     queryset = Vehicle.objects.all()
+    pagination_class = KeysetPagination
     filter_backends = [DjangoFilterBackend]
     filterset_fields = ['driver', 'office']
 
@@ -277,19 +328,63 @@ class VehicleViewSet(viewsets.ModelViewSet):
         serializer.is_valid(raise_exception=True)
         if serializer.is_valid():
             company = self.request.user.company
-            vehicle = Vehicle.objects.create(company=company, **serializer.validated_data)
-            vehicle.save()
+            Vehicle.objects.create(company=company, **serializer.validated_data)
             data = {'success': 'You create the Vehicle Successfully'}
             return Response(data=data, status=status.HTTP_201_CREATED)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
+    @action(detail=False, methods=['post'], url_path='import')
+    def bulk_import(self, request, *args, **kwargs):
+        """Bulk create vehicles from a NDJSON or CSV body, one vehicle per line/row.
+        The body is read as a stream and validated in chunks, the answer is a per-row error report.
+        With ?async=1 the import is queued as a job and the answer is 202 with the job"""
+        content_type = request.content_type.split(';')[0].strip()
+        if content_type not in NDJSON_CONTENT_TYPES + CSV_CONTENT_TYPES:
+            raise UnsupportedMediaType(content_type)
+        if wants_async(request):
+            job = jobs.enqueue('vehicle_import', body_payload(request, content_type),
+                               company_id=request.user.company_id, user=request.user)
+            return accepted(request, job)
+        importer = VehicleImporter(self.request.user.company)
+        report = importer.run(iter_rows(request.stream, content_type))
+        if report['created'] or not report['error_count']:
+            return Response(data=report, status=status.HTTP_201_CREATED)
+        return Response(data=report, status=status.HTTP_400_BAD_REQUEST)
+
+    @action(detail=False, methods=['post'])
+    def reassign(self, request, *args, **kwargs):
+        """Move many vehicles to other offices/drivers at once: a list of changes, or a filter and a target.
+        All or nothing, with a constant number of queries. ?async=1 queues it as a job (202)"""
+        serializer = ReassignmentSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        if wants_async(request):
+            job = jobs.enqueue('vehicle_reassign', serializer.validated_data,
+                               company_id=request.user.company_id, user=request.user)
+            return accepted(request, job)
+        report = VehicleReassignment(self.request.user.company).run(serializer.validated_data)
+        return Response(data=report, status=status.HTTP_200_OK)
+
+    @action(detail=False, methods=['get'], renderer_classes=[NDJSONRenderer, CSVRenderer])
+    def export(self, request, *args, **kwargs):
+        """Stream the whole fleet with office and driver inlined, as NDJSON or CSV (Accept header or ?format=).
+        Accepts the same filters as the list. With ?async=1 a job writes the file, downloaded from
+        /api/jobs/<id>/download/ once it succeeded"""
+        queryset = self.filter_queryset(self.get_queryset())
+        if wants_async(request):
+            filters = {name: request.query_params[name] for name in self.filterset_fields
+                       if request.query_params.get(name)}
+            job = jobs.enqueue('vehicle_export', {'format': request.accepted_renderer.format, 'filters': filters},
+                               company_id=request.user.company_id, user=request.user)
+            return accepted(request, job)
+        return vehicle_export_response(queryset, request.accepted_renderer.format)
+
     def get_queryset(self):
         queryset = Vehicle.objects.filter(company=self.request.user.company)
 
         return queryset
 
 
-class VehicleChangeViewSet(viewsets.ModelViewSet):
+class VehicleChangeViewSet(ConditionalMixin, ExpandMixin, viewsets.ModelViewSet):
     """Admin can delete/change/get a details vehicle """
     permission_classes = [IsAdminUser, ]
     serializer_class = VehicleSerializer
@@ -301,6 +396,7 @@ class VehicleChangeViewSet(viewsets.ModelViewSet):
         serializer = OfficeDetailSerializer(instance=vehicle, data=request.data, partial=True)
 
         if serializer.is_valid():
+            self.check_if_match(vehicle)
             serializer.save()
             return Response(serializer.errors, status=status.HTTP_200_OK)
         else:
@@ -319,12 +415,111 @@ class VehicleChangeViewSet(viewsets.ModelViewSet):
         return queryset
 
 
-class VehicleProfileViewSet(viewsets.ModelViewSet):
+class VehicleProfileViewSet(ConditionalMixin, ExpandMixin, CachedResponseMixin, viewsets.ModelViewSet):
     """The employee can view the list of vehicles he drives"""
+    cache_per_user = True
     serializer_class = VehicleSerializer
     queryset = Vehicle.objects.all()
+    pagination_class = KeysetPagination
 
     def get_queryset(self):
         driver = self.request.user.id
         queryset = Vehicle.objects.filter(driver=driver)
         return queryset
+
+
+class FleetStatsViewSet(viewsets.ViewSet):
+    """Admin dashboard: vehicles per office and per driver, unassigned vehicles and years of manufacture.
+    Read from the rollup table, so the cost does not depend on the number of vehicles"""
+    permission_classes = [IsAdminUser, ]
+
+    def list(self, request, *args, **kwargs):
+        return Response(fleet_stats(self.request.user.company_id))
+
+
+class SearchViewSet(viewsets.ViewSet):
+    """Ranked prefix search over employees, offices and vehicles of the company:
+    /api/search/?q=kov ol&type=employee,office&page_size=20&offset=0"""
+    permission_classes = [IsAdminUser, ]
+    page_size = 20
+    max_page_size = 100
+
+    def list(self, request, *args, **kwargs):
+        params = request.query_params
+        text = params.get('q', '')
+        kinds = [kind for kind in params.get('type', '').split(',') if kind] or None
+        try:
+            page_size = min(max(int(params.get('page_size', self.page_size)), 1), self.max_page_size)
+            offset = max(int(params.get('offset', 0)), 0)
+        except ValueError:
+            return Response({'detail': 'page_size and offset must be integers'}, status=status.HTTP_400_BAD_REQUEST)
+
+        results = search.search(request.user.company_id, text, kinds, limit=page_size + 1, offset=offset)
+        next_link = None
+        if len(results) > page_size:
+            next_link = replace_query_param(request.build_absolute_uri(), 'offset', offset + page_size)
+        return Response({'next': next_link, 'results': results[:page_size]})
+
+
+class SyncViewSet(viewsets.ViewSet):
+    """Delta sync for clients that keep the offices, vehicles and employees of the company:
+    /api/sync/?since=<cursor>&page_size=500 answers the rows changed after the cursor, the ids deleted since
+    and the next cursor. Start with since=0 (everything); call again with the cursor while "more" is true; on
+    "reset" drop the local copy, the cursor was older than the kept deletions and the answer starts from
+    scratch. Cursors are opaque integers: a walk from scratch gets negative ones until it is up to date."""
+    permission_classes = [IsAdminUser, ]
+
+    def list(self, request, *args, **kwargs):
+        params = request.query_params
+        max_page_size = getattr(settings, 'API_MAX_PAGE_SIZE', 1000)
+        try:
+            since = int(params.get('since', 0))
+            page_size = min(max(int(params.get('page_size', getattr(settings, 'SYNC_PAGE_SIZE', 500))), 1),
+                            max_page_size)
+        except ValueError:
+            return Response({'detail': 'since and page_size must be integers'}, status=status.HTTP_400_BAD_REQUEST)
+        return Response(sync_page(request.user.company_id, since, page_size))
+
+
+class EventTicketViewSet(viewsets.ViewSet):
+    """Admin gets a ticket for /api/events/?ticket=, for EventSource which can not send the token header.
+    It is good for EVENTS_TICKET_MAX_AGE seconds, to open the stream: reconnect with a new one"""
+    permission_classes = [IsAdminUser, ]
+
+    def create(self, request, *args, **kwargs):
+        data = {'ticket': issue_ticket(request.auth), 'expires_in': getattr(settings, 'EVENTS_TICKET_MAX_AGE', 30)}
+        return Response(data=data, status=status.HTTP_201_CREATED)
+
+
+class DeletionViewSet(viewsets.ReadOnlyModelViewSet):
+    """Admin can follow the background deletions of the company's offices and employees"""
+    permission_classes = [IsAdminUser, ]
+    serializer_class = DeletionSerializer
+    queryset = Deletion.objects.all()
+    pagination_class = KeysetPagination
+
+    def get_queryset(self):
+        return Deletion.objects.filter(company=self.request.user.company)
+
+
+class JobViewSet(viewsets.ReadOnlyModelViewSet):
+    """Admin can follow the background jobs of the company: status, attempts and result"""
+    permission_classes = [IsAdminUser, ]
+    serializer_class = JobSerializer
+    queryset = Job.objects.all()
+    pagination_class = KeysetPagination
+
+    def get_queryset(self):
+        return Job.objects.filter(company=self.request.user.company)
+
+    @action(detail=True, methods=['get'])
+    def download(self, request, *args, **kwargs):
+        """The file written by a succeeded export job"""
+        job = self.get_object()
+        upload_id = (job.result or {}).get('upload') if job.status == Job.SUCCEEDED else None
+        upload = Upload.objects.filter(pk=upload_id, company=job.company_id).first() if upload_id else None
+        if upload is None:
+            raise NotFound('This job has no file to download')
+        response = StreamingHttpResponse(iter_upload(upload.pk), content_type=upload.content_type)
+        response['Content-Length'] = upload.size
+        return response
@@ -1,16 +1,17 @@
 from django.contrib.auth import authenticate
 from rest_framework import serializers
 
+from service.api.fieldsets import DynamicFieldsMixin
 from service.models import MyUser, Company, Office, Vehicle
 
 
-class CompanySerializer(serializers.ModelSerializer):
+class CompanySerializer(DynamicFieldsMixin, serializers.ModelSerializer):
     class Meta:
         model = Company
         fields = ('id', 'company_name')
 
 
-class UserRegisterSerializer(serializers.ModelSerializer):
+class UserRegisterSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
     """Serializer for Create Company, where user automatically become the Admin of Company.
     We use nested CompanySerializer and take field company_name.  """
     password = serializers.CharField(write_only=True, required=True, style={'input_type': 'password'})
@@ -53,7 +54,7 @@ class MyAuthTokenSerializer(serializers.Serializer):
         return attrs
 
 
-class EmployeeCreateSerializer(serializers.ModelSerializer):
+class EmployeeCreateSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
     """Admin can create Employee for his company."""
     password = serializers.CharField(write_only=True, required=True, style={'input_type': 'password'})
     confirm_password = serializers.CharField(write_only=True, required=True, style={'input_type': 'password'})
@@ -70,13 +71,13 @@ class EmployeeCreateSerializer(serializers.ModelSerializer):
         return data
 
 
-class CompaniesSerializer(serializers.ModelSerializer):
+class CompaniesSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
     class Meta:
         model = Company
         fields = ('id', 'company_name', 'address')
 
 
-class ProfileSerializer(serializers.ModelSerializer):
+class ProfileSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
     """Employee can see his profile, and change it, exclude EMAIL"""
     class Meta:
         model = MyUser
@@ -87,21 +88,25 @@ class ProfileSerializer(serializers.ModelSerializer):
         }
 
 
-class OfficeSerializer(serializers.ModelSerializer):
+class OfficeSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
     class Meta:
         model = Office
         fields = ('id', 'office_name', 'address', 'country', 'city', 'region')
 
 
-class OfficeDetailSerializer(serializers.ModelSerializer):
+class OfficeDetailSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
+    expandable_fields = {'employee': ProfileSerializer}
+
     class Meta:
         model = Office
         fields = ('id', 'office_name', 'address', 'country', 'city', 'region', 'employee')
         read_only_fields = ('id', 'employee')
 
 
-class AssignEmployeeToOfficeSerializer(serializers.ModelSerializer):
+class AssignEmployeeToOfficeSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
     """Employee can be only assigned to a one office"""
+    expandable_fields = {'employee': ProfileSerializer}
+
     class Meta:
         model = Office
         fields = ('id', 'employee')
@@ -113,8 +118,11 @@ class AssignEmployeeToOfficeSerializer(serializers.ModelSerializer):
         return data
 
 
-class VehicleSerializer(serializers.ModelSerializer):
-    """Serializer for create Vehicle. Driver should belong to the office chosen by admin. """
+class VehicleSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
+    """Serializer for create Vehicle. Driver should belong to the office chosen by admin.
+    ?expand=office,driver inlines the office and the driver instead of their ids"""
+    expandable_fields = {'office': OfficeSerializer, 'driver': ProfileSerializer}
+
     class Meta:
         model = Vehicle
         fields = ('id', 'licence_plate', 'name', 'model', 'year_of_manufacture', 'office', 'driver')
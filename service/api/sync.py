@@ -0,0 +1,28 @@
+from service import changelog
+from service.api.serializers import EmployeeCreateSerializer, OfficeSerializer, VehicleSerializer
+from service.models import Change, MyUser, Office, Vehicle
+
+# kind -> (key in the answer, queryset of what the list endpoints show, serializer of those lists)
+SOURCES = {
+    Change.OFFICE: ('offices', Office.objects.all(), OfficeSerializer),
+    Change.VEHICLE: ('vehicles', Vehicle.objects.all(), VehicleSerializer),
+    Change.EMPLOYEE: ('employees', MyUser.objects.filter(is_staff=False), EmployeeCreateSerializer),
+}
+
+
+def sync_page(company_id, since, limit):
+    """What changed in a company after the cursor, as the /api/office/, /api/vehicle/ and /api/employee/
+    rows plus the ids of deleted objects. At most five queries whatever the page size: horizon, log, loads.
+    An object deleted after the log was read is left out, its tombstone comes with a later page."""
+    entries, more, reset, cursor = changelog.changes_since(company_id, since, limit)
+    changed = {kind: [] for kind in SOURCES}
+    deleted = {kind: [] for kind in SOURCES}
+    for entry in entries:
+        (deleted if entry.deleted else changed)[entry.kind].append(entry.object_id)
+
+    page = {'cursor': cursor, 'more': more, 'reset': reset}
+    for kind, (key, queryset, serializer_class) in SOURCES.items():
+        objects = queryset.filter(company_id=company_id, pk__in=changed[kind]).order_by('pk') if changed[kind] else []
+        page[key] = serializer_class(objects, many=True).data
+    page['deleted'] = {SOURCES[kind][0]: ids for kind, ids in deleted.items()}
+    return page
@@ -4,3 +4,16 @@ from django.apps import AppConfig
 class ServiceConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'service'
+
+    def ready(self):
+        from service import signals, tasks  # noqa: F401
+        from service.api.caching import response_cache
+        from service.events import event_stats
+        from service.hashers import hashing_stats
+        from service.jobs import queue_stats
+        from service.metrics import registry
+
+        registry.register_collector('response_cache', 'Response cache counters', response_cache.stats)
+        registry.register_collector('password_hashing', 'Password hashing service counters', hashing_stats)
+        registry.register_collector('background_jobs', 'Background jobs per status', queue_stats)
+        registry.register_collector('push_events', 'Server-sent event subscribers and counters', event_stats)
@@ -0,0 +1,71 @@
+from django.db.backends.sqlite3 import base
+
+# PRAGMAs run on every new connection, overridable with DATABASES[...]['OPTIONS']['pragmas'].
+# journal_mode is not among them: WAL is stored in the database file itself, so it is set for the deployed
+# database only (see settings.DATABASES) instead of rewriting any file a command happens to open.
+DEFAULT_PRAGMAS = {
+    # wait for the write lock (ms) instead of failing with "database is locked"
+    'busy_timeout': 5000,
+    # page cache per connection, negative means KiB
+    'cache_size': -64000,
+    'mmap_size': 256 * 1024 * 1024,
+    'temp_store': 'memory',
+}
+# synchronous, unless OPTIONS['pragmas'] sets it, follows the journal mode of the file: with WAL, NORMAL only
+# fsyncs at checkpoints and is durable against crashes of the app, not of the OS; in the rollback journal
+# mode NORMAL can corrupt the database on power loss, so it is FULL there
+SYNCHRONOUS = {'wal': 'normal'}
+DEFAULT_SYNCHRONOUS = 'full'
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    """Django's sqlite3 backend with a connection profile for concurrent use. Extra OPTIONS:
+    pragmas - dict merged over DEFAULT_PRAGMAS (None drops one), run on every new connection, then
+        synchronous by SYNCHRONOUS if not given;
+    transaction_mode - 'IMMEDIATE' (default) takes the write lock at BEGIN, so a transaction that reads
+        and then writes waits in busy_timeout instead of failing on the lock upgrade. Every atomic() block
+        then holds the write lock, read-only ones too: keep plain reads out of atomic();
+    health_checks - with CONN_MAX_AGE, check a persistent connection with SELECT 1 before a request reuses it."""
+    custom_options = ('pragmas', 'transaction_mode', 'health_checks')
+
+    def __init__(self, settings_dict, alias='default'):
+        super().__init__(settings_dict, alias)
+        options = settings_dict.get('OPTIONS', {})
+        pragmas = {**DEFAULT_PRAGMAS, **options.get('pragmas', {})}
+        self.pragmas = {name: value for name, value in pragmas.items() if value is not None}
+        self.journal_synchronous = 'synchronous' not in pragmas
+        self.transaction_mode = options.get('transaction_mode', 'IMMEDIATE')
+        self.health_checks = options.get('health_checks', True)
+
+    def get_connection_params(self):
+        kwargs = super().get_connection_params()
+        for name in self.custom_options:
+            kwargs.pop(name, None)
+        return kwargs
+
+    def get_new_connection(self, conn_params):
+        conn = super().get_new_connection(conn_params)
+        for name, value in self.pragmas.items():
+            conn.execute(f'PRAGMA {name} = {value}')
+        if self.journal_synchronous:
+            journal_mode = conn.execute('PRAGMA journal_mode').fetchone()[0].lower()
+            conn.execute(f'PRAGMA synchronous = {SYNCHRONOUS.get(journal_mode, DEFAULT_SYNCHRONOUS)}')
+        return conn
+
+    def _start_transaction_under_autocommit(self):
+        self.cursor().execute(f'BEGIN {self.transaction_mode or ""}'.strip())
+
+    def is_usable(self):
+        try:
+            self.connection.execute('SELECT 1')
+        except base.Database.Error:
+            return False
+        return True
+
+    def close_if_unusable_or_obsolete(self):
+        # runs at the start and the end of every request; Django only checks is_usable() after errors
+        if self.connection is not None and self.health_checks and self.close_at is not None \
+                and not self.in_atomic_block and not self.is_usable():
+            self.close()
+            return
+        super().close_if_unusable_or_obsolete()
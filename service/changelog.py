@@ -0,0 +1,88 @@
+from django.db import connection, transaction
+from django.db.models import Max
+from django.utils import timezone
+
+from service.models import Change, ChangeHorizon, Company, MyUser, Office, Vehicle
+
+MODELS = {
+    Office: Change.OFFICE,
+    Vehicle: Change.VEHICLE,
+    MyUser: Change.EMPLOYEE,
+}
+KIND_MODELS = {kind: model for model, kind in MODELS.items()}
+
+
+def record(kind, company_id, object_id, deleted=False):
+    """Move an object to the end of the log of its company (post_save / post_delete)"""
+    if company_id is None:
+        return
+    Change.objects.filter(kind=kind, object_id=object_id).delete()
+    Change.objects.create(company_id=company_id, kind=kind, object_id=object_id, deleted=deleted)
+
+
+def record_queryset(kind, queryset, deleted=False):
+    """record() every row of a queryset with two statements, for writes that send no signals.
+    Call it before an UPDATE or DELETE that takes the rows out of the queryset."""
+    quote = connection.ops.quote_name
+    table, source = quote(Change._meta.db_table), quote(queryset.model._meta.db_table)
+    ids, params = queryset.order_by().values('pk').query.sql_with_params()
+    columns = ', '.join(quote(name) for name in ('company_id', 'kind', 'object_id', 'deleted', 'changed_at'))
+    now = connection.ops.adapt_datetimefield_value(timezone.now())
+    with connection.cursor() as cursor:
+        cursor.execute(f'DELETE FROM {table} WHERE kind = %s AND object_id IN ({ids})', [kind, *params])
+        cursor.execute(
+            f'INSERT INTO {table} ({columns}) SELECT company_id, %s, id, %s, %s FROM {source} '
+            f'WHERE company_id IS NOT NULL AND id IN ({ids}) ORDER BY id',
+            [kind, deleted, now, *params],
+        )
+
+
+def record_inserted(kind, after):
+    """Log the rows of a bulk insert, called inside its transaction: the ids over `after`, read before the
+    insert (see search.index_inserted)"""
+    model = KIND_MODELS[kind]
+    record_queryset(kind, model.objects.filter(pk__gt=after))
+
+
+def record_company(company_id):
+    """Log every object of a company loaded without signals (provisioning, seed)"""
+    for model, kind in MODELS.items():
+        record_queryset(kind, model.objects.filter(company_id=company_id))
+
+
+def horizon(company_id):
+    return ChangeHorizon.objects.filter(company_id=company_id).values_list('cursor', flat=True).first() or 0
+
+
+def changes_since(company_id, since, limit):
+    """Entries of a company after the cursor, in log order: ([Change], more, reset, next cursor).
+    A walk from scratch (since=0) can pass below the horizon, so its cursors are negative (-id) until it gets
+    past it; a negative cursor is never reset. reset - a plain cursor older than a compacted tombstone: the
+    page starts a walk from scratch and the client has to drop what it has."""
+    walk = since <= 0
+    since = abs(since)
+    last = horizon(company_id)
+    reset = not walk and since < last
+    if reset:
+        since, walk = 0, True
+    entries = list(Change.objects.filter(company_id=company_id, id__gt=since).order_by('id')[:limit + 1])
+    more = len(entries) > limit
+    entries = entries[:limit]
+    cursor = entries[-1].id if entries else since
+    if walk and cursor < last:
+        cursor = -cursor if more else last
+    return entries, more, reset, cursor
+
+
+def compact(older_than):
+    """Drop the tombstones changed before older_than and the log of deleted companies.
+    Returns the number of entries removed."""
+    with transaction.atomic():
+        tombstones = Change.objects.filter(deleted=True, changed_at__lt=older_than)
+        for company_id, last in tombstones.order_by().values_list('company').annotate(last=Max('id')):
+            ChangeHorizon.objects.update_or_create(company_id=company_id, defaults={'cursor': last})
+        removed = tombstones.delete()[0]
+        companies = Company.objects.values('pk')
+        removed += Change.objects.exclude(company__in=companies).delete()[0]
+        ChangeHorizon.objects.exclude(company__in=companies).delete()
+    return removed
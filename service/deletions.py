@@ -0,0 +1,173 @@
+from collections import Counter
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from service import changelog, jobs, rollups, search
+from service.api.caching import bump_tenant_version
+from service.models import ArchivedRow, Change, Company, Deletion, MyUser, Office, Vehicle
+
+
+def steps(deletion):
+    """(model, queryset) pairs emptied one after the other. Dependents go first, so by the time a row is
+    deleted nothing refers to it any more and the CASCADE collector has next to nothing to load."""
+    pk = deletion.target_id
+    if deletion.target == Deletion.OFFICE:
+        return [
+            (Vehicle, Vehicle.objects.filter(office_id=pk)),
+            (Office, Office.objects.filter(pk=pk)),
+        ]
+    if deletion.target == Deletion.EMPLOYEE:
+        return [
+            (Vehicle, Vehicle.objects.filter(driver_id=pk)),
+            (Vehicle, Vehicle.objects.filter(office__employee_id=pk)),
+            (Office, Office.objects.filter(employee_id=pk)),
+            (MyUser, MyUser.objects.filter(pk=pk)),
+        ]
+    return [
+        (Vehicle, Vehicle.objects.filter(company_id=pk)),
+        (Office, Office.objects.filter(company_id=pk)),
+        (MyUser, MyUser.objects.filter(company_id=pk)),
+        (Company, Company.objects.filter(pk=pk)),
+    ]
+
+
+class DeletionRunner:
+    """Empties the steps of a Deletion batch by batch. Every batch is its own short transaction that also
+    saves the progress, so the write lock is held for one batch only and a crashed run resumes where it
+    stopped. Vehicles, the bulk of any tenant, skip the collector and post_delete: they are removed with one
+    DELETE per batch and the rollups, search index and cached responses are updated for the whole batch.
+    With archive=True the rows of every step are copied to ArchivedRow before they are deleted."""
+
+    def __init__(self, deletion, batch_size=None):
+        self.deletion = deletion
+        self.batch_size = batch_size or getattr(settings, 'DELETION_BATCH_SIZE', 500)
+
+    def run(self, max_rows=None):
+        """Work until the deletion is done (True) or max_rows rows were removed (False)"""
+        deletion = self.deletion
+        try:
+            if not deletion.planned:
+                deletion.planned = self.plan()
+                deletion.save(update_fields=['planned', 'updated_at'])
+            removed = 0
+            for model, queryset in steps(deletion):
+                while True:
+                    if max_rows is not None and removed >= max_rows:
+                        return False
+                    count = self.delete_batch(model, queryset)
+                    if not count:
+                        break
+                    removed += count
+        except Exception as exc:
+            deletion.status = Deletion.FAILED
+            deletion.error = repr(exc)
+            deletion.save(update_fields=['status', 'error', 'updated_at'])
+            raise
+        deletion.status = Deletion.DONE
+        deletion.error = ''
+        deletion.finished_at = timezone.now()
+        deletion.save(update_fields=['status', 'error', 'finished_at', 'updated_at'])
+        return True
+
+    def plan(self):
+        """Rows to delete per model; steps of the same model may overlap, so they are counted together"""
+        querysets = {}
+        for model, queryset in steps(self.deletion):
+            label = model._meta.label
+            querysets[label] = querysets[label] | queryset if label in querysets else queryset
+        return {label: queryset.count() for label, queryset in querysets.items()}
+
+    def delete_batch(self, model, queryset):
+        with transaction.atomic():
+            ids = list(queryset.order_by().values_list('pk', flat=True)[:self.batch_size])
+            if not ids:
+                return 0
+            if self.deletion.archive:
+                self.archive(model, ids)
+            if model is Vehicle:
+                counts = self.delete_vehicles(ids)
+            else:
+                counts = model.objects.filter(pk__in=ids).delete()[1]
+            deleted = Counter(self.deletion.deleted)
+            deleted.update({label: count for label, count in counts.items() if count})
+            self.deletion.deleted = dict(deleted)
+            self.deletion.save(update_fields=['deleted', 'updated_at'])
+        return len(ids)
+
+    def archive(self, model, ids):
+        ArchivedRow.objects.bulk_create([
+            ArchivedRow(deletion=self.deletion, company_id=row['id'] if model is Company else row['company_id'],
+                        model=model._meta.label, object_id=row['id'], data=row)
+            for row in model.objects.filter(pk__in=ids).values()
+        ])
+
+    @staticmethod
+    def delete_vehicles(ids):
+        """What the post_delete receivers of Vehicle do, once per batch. The rows go with QuerySet._raw_delete,
+        a single DELETE that skips the collector and the signals: delete() would load every vehicle and run
+        the receivers row by row. That is only right while no model refers to Vehicle (nothing to cascade)
+        and while this method keeps up with the receivers in service/signals.py - the rollups, the change
+        log, the search index and the tenant version. DeletionTest checks both."""
+        vehicles = Vehicle.objects.filter(pk__in=ids)
+        deltas = Counter()
+        companies = set()
+        for state in vehicles.values_list('company_id', 'office_id', 'driver_id', 'year_of_manufacture'):
+            deltas.update(rollups.contributions(rollups.vehicle_state(*state), -1))
+            companies.add(state[0])
+        changelog.record_queryset(Change.VEHICLE, vehicles, deleted=True)
+        count = vehicles._raw_delete(vehicles.db)
+        rollups.apply(deltas)
+        search.remove_objects('vehicle', ids)
+        for company_id in companies:
+            bump_tenant_version(company_id)
+        return {Vehicle._meta.label: count}
+
+
+def create(target, instance, archive=False):
+    """A Deletion of instance, or the one already under way"""
+    company_id = instance.pk if target == Deletion.COMPANY else instance.company_id
+    unfinished = Deletion.objects.filter(company_id=company_id, target=target, target_id=instance.pk,
+                                         status__in=[Deletion.PENDING, Deletion.RUNNING])
+    return unfinished.first() or Deletion.objects.create(
+        company_id=company_id, target=target, target_id=instance.pk, archive=archive)
+
+
+def claimable():
+    """Deletions a runner can pick up: pending ones, and running ones that saved no progress for
+    DELETION_STALE_SECONDS, taken to have crashed"""
+    stale = timezone.now() - timedelta(seconds=getattr(settings, 'DELETION_STALE_SECONDS', 60))
+    return Deletion.objects.filter(Q(status=Deletion.PENDING) | Q(status=Deletion.RUNNING, updated_at__lt=stale))
+
+
+def claim(pk):
+    """The deletion, marked running, unless another runner is working on it"""
+    claimed = claimable().filter(pk=pk).update(status=Deletion.RUNNING, updated_at=timezone.now())
+    return Deletion.objects.get(pk=pk) if claimed else None
+
+
+def run(pk):
+    """Run a deletion to the end if it can be claimed; the claimed Deletion or None"""
+    deletion = claim(pk)
+    if deletion is not None:
+        DeletionRunner(deletion).run()
+    return deletion
+
+
+def schedule(target, instance, archive=False):
+    """Delete instance with its dependents. Up to DELETION_BATCH_SIZE rows are removed right away, so small
+    deletions are done when this returns; the rest is left to a 'deletion' job."""
+    deletion = create(target, instance, archive)
+    claimed = claim(deletion.pk)
+    if claimed is None:
+        return deletion
+    deletion = claimed
+    if DeletionRunner(deletion).run(max_rows=getattr(settings, 'DELETION_BATCH_SIZE', 500)):
+        return deletion
+    deletion.status = Deletion.PENDING
+    deletion.save(update_fields=['status', 'updated_at'])
+    jobs.enqueue('deletion', {'deletion': deletion.pk}, company_id=deletion.company_id)
+    return deletion
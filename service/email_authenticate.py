@@ -1,6 +1,7 @@
 from django.contrib.auth.backends import ModelBackend
-from django.contrib.auth.hashers import check_password
 from django.contrib.auth import get_user_model
+from django.db.models.functions import Lower
+from service.hashers import get_hashing_service
 from service.models import MyUser
 
 
@@ -17,8 +18,10 @@ class UserEmailBackend(ModelBackend):
         try:
             # Ищем совпадение по email у пользовательских моделей в БД.
             # Если находим - сверяем пароли.
-            user = user_model.objects.get(email__iexact=username)
-            if check_password(password, user.password):
+            # Сравниваем lower(email), чтобы запрос шел по индексу myuser_email_lower_idx.
+            email = username or kwargs.get('email') or ''
+            user = user_model.objects.alias(email_lower=Lower('email')).get(email_lower=email.lower())
+            if get_hashing_service().check_password(password, user.password):
                 return user
             else:
                 return None
@@ -0,0 +1,195 @@
+import asyncio
+import logging
+import threading
+from collections import Counter, defaultdict
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import close_old_connections
+from django.db.models import Max
+from django.utils.module_loading import import_string
+
+from service.api.renderers import ORJSONRenderer
+from service.models import Change
+
+logger = logging.getLogger(__name__)
+
+# sent instead of the events a subscriber could not keep up with; the stream ends after it
+RESYNC = b'event: resync\ndata: {}\n\n'
+
+_broker = None
+_broker_lock = threading.Lock()
+
+
+def frame(event_id, name, data):
+    """One server-sent event, encoded once for all the subscribers"""
+    head = f'event: {name}\n' if event_id is None else f'id: {event_id}\nevent: {name}\n'
+    return head.encode() + b'data: ' + ORJSONRenderer().render(data) + b'\n\n'
+
+
+class Subscription:
+    __slots__ = ('company_id', 'queue')
+
+    def __init__(self, company_id, size):
+        self.company_id = company_id
+        self.queue = asyncio.Queue(maxsize=size)
+
+
+class Broker:
+    """In-process pub/sub of the event loop serving /api/events/: publish() hands the frame of an event to
+    the queue of every subscriber of the company, so an idle subscriber costs a queue and nothing else.
+    The base class only carries what this process publishes; subclasses feed it from outside in run(),
+    which runs as long as anyone is subscribed. A subscriber EVENTS_QUEUE_SIZE events behind gets RESYNC
+    instead and is dropped."""
+
+    def __init__(self):
+        self.subscribers = defaultdict(set)
+        self.counters = Counter()
+        self.queue_size = getattr(settings, 'EVENTS_QUEUE_SIZE', 1000)
+        self.ready = None
+        self._task = None
+
+    async def subscribe(self, company_id):
+        subscription = Subscription(company_id, self.queue_size)
+        self.subscribers[company_id].add(subscription)
+        try:
+            if self._task is None or self._task.done():
+                self.ready = asyncio.Event()
+                self._task = asyncio.ensure_future(self._run())
+            # events published from now on reach the subscription
+            await self.ready.wait()
+        except BaseException:
+            self.unsubscribe(subscription)
+            raise
+        return subscription
+
+    def unsubscribe(self, subscription):
+        subscribers = self.subscribers.get(subscription.company_id)
+        if subscribers is not None:
+            subscribers.discard(subscription)
+            if not subscribers:
+                del self.subscribers[subscription.company_id]
+
+    def publish(self, company_id, event_id, name, data):
+        """Call on the event loop; from other threads use publish_threadsafe()"""
+        subscribers = self.subscribers.get(company_id)
+        self.counters['published'] += 1
+        if not subscribers:
+            return
+        encoded = frame(event_id, name, data)
+        for subscription in list(subscribers):
+            try:
+                subscription.queue.put_nowait(encoded)
+                self.counters['delivered'] += 1
+            except asyncio.QueueFull:
+                self.overflow(subscription)
+
+    def publish_threadsafe(self, company_id, event_id, name, data):
+        if self._task is not None and not self._task.done():
+            self._task.get_loop().call_soon_threadsafe(self.publish, company_id, event_id, name, data)
+
+    def overflow(self, subscription):
+        queue = subscription.queue
+        while not queue.empty():
+            queue.get_nowait()
+        queue.put_nowait(RESYNC)
+        self.unsubscribe(subscription)
+        self.counters['overflowed'] += 1
+
+    async def _run(self):
+        try:
+            await self.run()
+        except Exception:
+            logger.exception('Event broker %s stopped', type(self).__name__)
+        finally:
+            self.ready.set()
+
+    async def run(self):
+        self.ready.set()
+
+    def stats(self):
+        return {
+            'subscribers': sum(len(subscribers) for subscribers in self.subscribers.values()),
+            'companies': len(self.subscribers),
+            **self.counters,
+        }
+
+
+class ChangeLogBroker(Broker):
+    """Reads the change log (service.changelog) every EVENTS_POLL_INTERVAL seconds while anyone is
+    subscribed, so it sees the writes of every process: web, job workers, management commands. A poll costs
+    one query plus one per kind of object changed in the subscribed companies, whatever the number of
+    subscribers. Events are 'office' and 'vehicle' (the /api/office/ and /api/vehicle/ row, office and
+    driver included) and 'deleted' ({kind, id}); the id of an event is a cursor for /api/sync/.
+    Entries are read in id order, which is their commit order with SQLite's single writer."""
+    kinds = (Change.OFFICE, Change.VEHICLE)
+
+    def __init__(self):
+        super().__init__()
+        self.interval = getattr(settings, 'EVENTS_POLL_INTERVAL', 1.0)
+        self.batch_size = getattr(settings, 'SYNC_PAGE_SIZE', 500)
+        self.position = None
+
+    async def run(self):
+        self.position = await sync_to_async(self.last_change, thread_sensitive=False)()
+        self.ready.set()
+        while self.subscribers:
+            try:
+                events, self.position, more = await sync_to_async(self.poll, thread_sensitive=False)(
+                    self.position, set(self.subscribers))
+            except Exception:
+                logger.exception('Event broker could not read the change log')
+                await asyncio.sleep(self.interval)
+                continue
+            self.counters['polls'] += 1
+            for event in events:
+                self.publish(*event)
+            if not more:
+                await asyncio.sleep(self.interval)
+
+    @staticmethod
+    def last_change():
+        close_old_connections()
+        return Change.objects.aggregate(last=Max('id'))['last'] or 0
+
+    def poll(self, position, companies):
+        """([(company_id, event id, name, data)], new position, more) of the entries after position"""
+        from service.api.sync import SOURCES
+
+        close_old_connections()
+        entries = list(Change.objects.filter(id__gt=position).order_by('id')[:self.batch_size])
+        if not entries:
+            return [], position, False
+        entries_of = [entry for entry in entries if entry.company_id in companies and entry.kind in self.kinds]
+        changed = defaultdict(list)
+        for entry in entries_of:
+            if not entry.deleted:
+                changed[entry.kind].append(entry.object_id)
+        rows = {}
+        for kind, ids in changed.items():
+            _, queryset, serializer_class = SOURCES[kind]
+            for row in serializer_class(queryset.filter(pk__in=ids), many=True).data:
+                rows[kind, row['id']] = row
+        events = []
+        for entry in entries_of:
+            if entry.deleted:
+                events.append((entry.company_id, entry.id, 'deleted', {'kind': entry.kind, 'id': entry.object_id}))
+            elif (entry.kind, entry.object_id) in rows:
+                # a row deleted since the entry was written is left out, its tombstone follows
+                events.append((entry.company_id, entry.id, entry.kind, rows[entry.kind, entry.object_id]))
+        return events, entries[-1].id, len(entries) == self.batch_size
+
+
+def get_broker():
+    """Broker configured by EVENTS_BROKER, created on first use"""
+    global _broker
+    if _broker is None:
+        with _broker_lock:
+            if _broker is None:
+                _broker = import_string(getattr(settings, 'EVENTS_BROKER', 'service.events.ChangeLogBroker'))()
+    return _broker
+
+
+def event_stats():
+    """Counters of the broker, empty until the first subscriber"""
+    return _broker.stats() if _broker is not None else {}
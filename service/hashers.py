@@ -0,0 +1,148 @@
+import os
+import threading
+from concurrent import futures
+from concurrent.futures import ProcessPoolExecutor
+
+from django.conf import settings
+from django.contrib.auth import hashers
+from django.utils.module_loading import import_string
+from rest_framework import status
+from rest_framework.exceptions import APIException
+
+_service = None
+_service_lock = threading.Lock()
+
+
+class HashingBusy(APIException):
+    status_code = status.HTTP_429_TOO_MANY_REQUESTS
+    default_detail = 'Too many password operations in progress, try again later.'
+    default_code = 'hashing_busy'
+
+
+def _init_worker():
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'mobidev.settings')
+    import django
+    django.setup()
+
+
+def _make_passwords(passwords):
+    return [hashers.make_password(password) for password in passwords]
+
+
+class InlineHashingService:
+    """Hashes on the calling thread. Useful for tests and management commands"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {
+            'submitted': 0, 'completed': 0, 'rejected': 0, 'timed_out': 0, 'pending': 0, 'peak_pending': 0,
+        }
+
+    def make_password(self, password):
+        return self.run(hashers.make_password, password)
+
+    def check_password(self, password, encoded):
+        return self.run(hashers.check_password, password, encoded)
+
+    def make_passwords(self, passwords):
+        return self.run(_make_passwords, list(passwords))
+
+    def run(self, fn, *args):
+        self._count('submitted')
+        try:
+            return fn(*args)
+        finally:
+            self._count('completed')
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counters)
+
+    def _count(self, name, delta=1):
+        with self._lock:
+            self.counters[name] += delta
+            if name == 'pending':
+                self.counters['peak_pending'] = max(self.counters['peak_pending'], self.counters['pending'])
+
+
+class ProcessPoolHashingService(InlineHashingService):
+    """Runs PBKDF2 on a bounded process pool, request workers only wait on a future.
+    At most PASSWORD_HASHING_MAX_PENDING jobs are queued; past that interactive calls
+    fail fast with HashingBusy (429) and bulk calls wait for a free slot. A call that gets no slot or no
+    result within PASSWORD_HASHING_TIMEOUT seconds raises HashingBusy too, its unstarted jobs cancelled."""
+
+    def __init__(self):
+        super().__init__()
+        self.workers = getattr(settings, 'PASSWORD_HASHING_WORKERS', None) or max(1, (os.cpu_count() or 1) // 2)
+        self.max_pending = getattr(settings, 'PASSWORD_HASHING_MAX_PENDING', None) or self.workers * 8
+        self.timeout = getattr(settings, 'PASSWORD_HASHING_TIMEOUT', 30)
+        self._slots = threading.BoundedSemaphore(self.max_pending)
+        self._executor = ProcessPoolExecutor(max_workers=self.workers, initializer=_init_worker)
+
+    def make_passwords(self, passwords):
+        passwords = list(passwords)
+        if not passwords:
+            return []
+        size = max(1, len(passwords) // (self.workers * 4))
+        chunks = [passwords[i:i + size] for i in range(0, len(passwords), size)]
+        submitted = []
+        try:
+            for chunk in chunks:
+                submitted.append(self.submit(_make_passwords, chunk, block=True))
+            return [hashed for hashed_chunk in self.results(submitted) for hashed in hashed_chunk]
+        finally:
+            for future in submitted:
+                future.cancel()
+
+    def run(self, fn, *args):
+        return self.results([self.submit(fn, *args)])[0]
+
+    def results(self, submitted):
+        """Results of the futures within one timeout in all"""
+        _, not_done = futures.wait(submitted, self.timeout)
+        if not_done:
+            for future in not_done:
+                future.cancel()
+            self._count('timed_out')
+            raise HashingBusy()
+        return [future.result() for future in submitted]
+
+    def submit(self, fn, *args, block=False):
+        if not (self._slots.acquire(timeout=self.timeout) if block else self._slots.acquire(blocking=False)):
+            self._count('rejected')
+            raise HashingBusy()
+        self._count('submitted')
+        self._count('pending')
+        try:
+            future = self._executor.submit(fn, *args)
+        except Exception:
+            self._release(None)
+            raise
+        future.add_done_callback(self._release)
+        return future
+
+    def _release(self, future):
+        self._slots.release()
+        self._count('pending', -1)
+        if future is not None:
+            self._count('completed')
+
+
+def get_hashing_service():
+    """Service configured by PASSWORD_HASHING_SERVICE, created on first use"""
+    global _service
+    if _service is None:
+        with _service_lock:
+            if _service is None:
+                _service = import_string(settings.PASSWORD_HASHING_SERVICE)()
+    return _service
+
+
+def hashing_stats():
+    """Counters of the hashing service, empty until it is first used"""
+    return _service.stats() if _service is not None else {}
+
+
+def make_passwords(passwords):
+    """Hash a batch of raw passwords"""
+    return get_hashing_service().make_passwords(passwords)
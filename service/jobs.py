@@ -0,0 +1,242 @@
+import logging
+import os
+import socket
+import threading
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import DatabaseError, close_old_connections, connection, transaction
+from django.db.models import Count, F
+from django.utils import timezone
+
+from service.models import Job
+
+logger = logging.getLogger(__name__)
+
+
+class JobFailed(Exception):
+    """Raised by a handler when retrying cannot help (invalid input). detail becomes the job result."""
+
+    def __init__(self, detail):
+        super().__init__(detail)
+        self.detail = detail
+
+
+class Handler:
+    __slots__ = ('function', 'priority', 'max_attempts', 'cleanup')
+
+    def __init__(self, function, priority, max_attempts, cleanup=None):
+        self.function = function
+        self.priority = priority
+        self.max_attempts = max_attempts
+        self.cleanup = cleanup
+
+
+handlers = {}
+
+
+def register(kind, priority=0, max_attempts=1, cleanup=None):
+    """Make a function (job -> JSON-able result) the handler of a job kind, with its default priority and
+    number of attempts. Only handlers that are safe to run again should allow more than one attempt.
+    cleanup(job) drops what an attempt left behind when its worker died (requeue_stale); job.status tells
+    whether the job was queued again or failed."""
+
+    def decorator(function):
+        handlers[kind] = Handler(function, priority, max_attempts, cleanup)
+        return function
+
+    return decorator
+
+
+def enqueue(kind, payload=None, company_id=None, user=None, priority=None, max_attempts=None):
+    """Queue a job; with JOBS_EAGER it runs on the calling thread once the transaction commits"""
+    handler = handlers[kind]
+    job = Job.objects.create(
+        kind=kind,
+        payload=payload or {},
+        company_id=company_id,
+        user=user,
+        priority=handler.priority if priority is None else priority,
+        max_attempts=handler.max_attempts if max_attempts is None else max_attempts,
+    )
+    if getattr(settings, 'JOBS_EAGER', False):
+        transaction.on_commit(lambda: run_claimed(claim(job.pk, 'eager')))
+    return job
+
+
+def claimable(kinds=None):
+    """Queued jobs due now, except those of companies already running JOB_TENANT_CONCURRENCY jobs"""
+    limit = getattr(settings, 'JOB_TENANT_CONCURRENCY', 1)
+    busy = (Job.objects.filter(status=Job.RUNNING, company__isnull=False).order_by()
+            .values('company').annotate(running=Count('id')).filter(running__gte=limit).values('company'))
+    jobs = Job.objects.filter(status=Job.QUEUED, run_after__lte=timezone.now()).exclude(company__in=busy)
+    if kinds:
+        jobs = jobs.filter(kind__in=kinds)
+    return jobs.order_by('-priority', 'run_after', 'id')
+
+
+def claim(pk, worker):
+    """The job, marked running for worker, or None when another worker took it first"""
+    now = timezone.now()
+    claimed = Job.objects.filter(pk=pk, status=Job.QUEUED).update(
+        status=Job.RUNNING, worker=worker, attempts=F('attempts') + 1, started_at=now, heartbeat_at=now)
+    return Job.objects.get(pk=pk) if claimed else None
+
+
+def claim_next(worker, kinds=None):
+    """Claim the next job in priority order. On SQLite the transaction takes the write lock first
+    (BEGIN IMMEDIATE), so the tenant limit check and the claim cannot interleave with another worker's."""
+    with transaction.atomic():
+        for pk in claimable(kinds).values_list('pk', flat=True)[:10]:
+            job = claim(pk, worker)
+            if job is not None:
+                return job
+    return None
+
+
+def finish(job, **fields):
+    """Store the outcome unless the job was taken away from this worker meanwhile (requeue_stale)"""
+    fields.setdefault('finished_at', timezone.now())
+    Job.objects.filter(pk=job.pk, status=Job.RUNNING, worker=job.worker).update(**fields)
+
+
+def run_claimed(job):
+    """Run a claimed job: success stores the result, JobFailed fails it at once, any other error queues
+    it again after JOB_RETRY_BACKOFF * 2 ** (attempt - 1) seconds until max_attempts"""
+    if job is None:
+        return None
+    handler = handlers.get(job.kind)
+    try:
+        if handler is None:
+            raise JobFailed(f'Unknown job kind {job.kind}')
+        result = handler.function(job)
+    except JobFailed as exc:
+        error = exc.detail if isinstance(exc.detail, str) else 'Invalid input, see the result'
+        finish(job, status=Job.FAILED, result=exc.detail, error=error)
+    except Exception as exc:
+        logger.exception('Job %s (%s) attempt %s failed', job.pk, job.kind, job.attempts)
+        if job.attempts < job.max_attempts:
+            backoff = getattr(settings, 'JOB_RETRY_BACKOFF', 5) * 2 ** (job.attempts - 1)
+            finish(job, status=Job.QUEUED, error=repr(exc), finished_at=None,
+                   run_after=timezone.now() + timedelta(seconds=backoff))
+        else:
+            finish(job, status=Job.FAILED, error=repr(exc))
+    else:
+        finish(job, status=Job.SUCCEEDED, result=result, error='')
+    return job
+
+
+def requeue_stale():
+    """Running jobs without a heartbeat for JOB_STALE_SECONDS lost their worker: queue them again, or fail
+    them when they are out of attempts, and run the cleanup of their kind"""
+    stale = Job.objects.filter(
+        status=Job.RUNNING,
+        heartbeat_at__lt=timezone.now() - timedelta(seconds=getattr(settings, 'JOB_STALE_SECONDS', 60)),
+    )
+    lost = 'Worker stopped sending heartbeats'
+    changed = 0
+    for job in stale:
+        if job.attempts < job.max_attempts:
+            fields = {'status': Job.QUEUED, 'worker': '', 'error': lost}
+        else:
+            fields = {'status': Job.FAILED, 'error': lost, 'finished_at': timezone.now()}
+        # the worker may still finish it meanwhile
+        if not Job.objects.filter(pk=job.pk, status=Job.RUNNING, worker=job.worker).update(**fields):
+            continue
+        changed += 1
+        handler = handlers.get(job.kind)
+        if handler is None or handler.cleanup is None:
+            continue
+        for name, value in fields.items():
+            setattr(job, name, value)
+        try:
+            handler.cleanup(job)
+        except Exception:
+            logger.exception('Cleanup of job %s (%s) failed', job.pk, job.kind)
+    return changed
+
+
+def queue_stats():
+    """Number of jobs per status, for the metrics endpoint"""
+    counts = dict(Job.objects.order_by().values_list('status').annotate(total=Count('id')))
+    return {status: counts.get(status, 0) for status, _ in Job.STATUSES}
+
+
+class Worker:
+    """Runs jobs on `threads` threads of this process. Every thread claims and runs one job at a time and
+    polls the queue every JOB_POLL_INTERVAL seconds when it is empty. Another thread stamps the heartbeat
+    of the jobs in progress and requeues the jobs of dead workers. Several processes may run workers."""
+
+    def __init__(self, threads=1, kinds=None, name=None):
+        self.threads = threads
+        self.kinds = kinds
+        self.name = name or f'{socket.gethostname()}:{os.getpid()}'
+        self.stopping = threading.Event()
+        self._lock = threading.Lock()
+        self.running = set()
+
+    def serve(self, once=False):
+        """Work until stop(); with once=True until the queue has nothing due"""
+        heartbeat = threading.Thread(target=self.beat, name=f'{self.name}-heartbeat', daemon=True)
+        heartbeat.start()
+        workers = [threading.Thread(target=self.work, args=(once,), name=f'{self.name}-{number}')
+                   for number in range(self.threads)]
+        for thread in workers:
+            thread.start()
+        try:
+            for thread in workers:
+                while thread.is_alive():
+                    thread.join(0.5)
+        except KeyboardInterrupt:
+            self.stop()
+            for thread in workers:
+                thread.join()
+        finally:
+            self.stop()
+            heartbeat.join()
+
+    def stop(self):
+        self.stopping.set()
+
+    def work(self, once):
+        name = threading.current_thread().name
+        poll = getattr(settings, 'JOB_POLL_INTERVAL', 1.0)
+        try:
+            while not self.stopping.is_set():
+                close_old_connections()
+                try:
+                    job = claim_next(name, self.kinds)
+                except DatabaseError:
+                    logger.exception('Worker %s could not claim a job', name)
+                    self.stopping.wait(poll)
+                    continue
+                if job is None:
+                    if once:
+                        return
+                    self.stopping.wait(poll)
+                    continue
+                with self._lock:
+                    self.running.add(job.pk)
+                try:
+                    run_claimed(job)
+                finally:
+                    with self._lock:
+                        self.running.discard(job.pk)
+        finally:
+            connection.close()
+
+    def beat(self):
+        interval = getattr(settings, 'JOB_HEARTBEAT_INTERVAL', 10)
+        try:
+            while not self.stopping.wait(interval):
+                close_old_connections()
+                with self._lock:
+                    running = list(self.running)
+                try:
+                    if running:
+                        Job.objects.filter(pk__in=running, status=Job.RUNNING).update(heartbeat_at=timezone.now())
+                    requeue_stale()
+                except DatabaseError:
+                    logger.exception('Worker %s missed a heartbeat', self.name)
+        finally:
+            connection.close()
@@ -0,0 +1,194 @@
+import json
+import os
+import platform
+import statistics
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections
+from django.test.utils import setup_test_environment, teardown_test_environment
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient
+
+from service.middleware import QueryRecorder
+from service.seed import seed_tenants
+
+PASSWORD = 'benchmark-password'
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    index = min(len(values) - 1, max(0, round(fraction * len(values) + 0.5) - 1))
+    return values[index]
+
+
+class Scenario:
+    """One endpoint driven by the benchmark: method, url and the token of the user calling it"""
+
+    def __init__(self, name, method, url, token=None, data=None):
+        self.name = name
+        self.method = method
+        self.url = url
+        self.token = token
+        self.data = data
+
+    def request(self, client, number):
+        client.credentials(**({'HTTP_AUTHORIZATION': f'Token {self.token}'} if self.token else {}))
+        data = self.data(number) if callable(self.data) else self.data
+        return getattr(client, self.method)(self.url, data, format='json')
+
+
+class Command(BaseCommand):
+    help = ('Seed a throwaway SQLite database and load every API endpoint with concurrent clients. '
+            'Reports throughput, p50/p95/p99 latency and queries per request, and compares with a baseline.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--companies', type=int, default=2)
+        parser.add_argument('--offices', type=int, default=20)
+        parser.add_argument('--employees', type=int, default=200)
+        parser.add_argument('--vehicles', type=int, default=5000)
+        parser.add_argument('--clients', type=int, default=8, help='Concurrent clients (threads)')
+        parser.add_argument('--requests', type=int, default=200, help='Requests per endpoint')
+        parser.add_argument('--only', nargs='*', default=None, help='Run only these scenarios')
+        parser.add_argument('--output', help='Write results as JSON to this file')
+        parser.add_argument('--baseline', help='JSON results of an earlier run to compare with')
+        parser.add_argument('--threshold', type=float, default=0.2,
+                            help='Relative p95 / throughput change reported as a regression')
+        parser.add_argument('--fail-on-regression', action='store_true')
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'sqlite':
+            raise CommandError('The benchmark runs against a throwaway SQLite database only')
+        directory = tempfile.mkdtemp(prefix='mobidev-bench-')
+        connection.settings_dict.setdefault('TEST', {})['NAME'] = os.path.join(directory, 'bench.sqlite3')
+        setup_test_environment(debug=False)
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            started = time.perf_counter()
+            tenants = seed_tenants(options['companies'], options['offices'], options['employees'],
+                                   options['vehicles'], password=PASSWORD)
+            self.stdout.write(f'Seeded in {time.perf_counter() - started:.1f}s')
+            scenarios = self.build_scenarios(tenants)
+            if options['only']:
+                scenarios = [scenario for scenario in scenarios if scenario.name in options['only']]
+            results = {
+                'config': {key: options[key] for key in
+                           ('companies', 'offices', 'employees', 'vehicles', 'clients', 'requests')},
+                'environment': {'python': platform.python_version(), 'machine': platform.machine(),
+                                'cpus': os.cpu_count()},
+                'endpoints': {},
+            }
+            for scenario in scenarios:
+                results['endpoints'][scenario.name] = self.run_scenario(scenario, options['clients'],
+                                                                        options['requests'])
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+
+        self.print_results(results['endpoints'])
+        if options['output']:
+            with open(options['output'], 'w') as output:
+                json.dump(results, output, indent=2)
+        if options['baseline']:
+            with open(options['baseline']) as baseline:
+                regressions = self.compare(json.load(baseline)['endpoints'], results['endpoints'],
+                                           options['threshold'])
+            if regressions and options['fail_on_regression']:
+                raise CommandError(f'{len(regressions)} regression(s) against {options["baseline"]}')
+
+    def build_scenarios(self, tenants):
+        company, admin, staff, offices = tenants[0]
+        employee = offices[0].employee if offices and offices[0].employee else staff[0]
+        admin_token = Token.objects.create(user=admin).key
+        employee_token = Token.objects.create(user=employee).key
+        office = offices[0].id
+        vehicle = company.vehicle_set.order_by('id').values_list('id', flat=True).first()
+        return [
+            Scenario('api-token-auth', 'post', '/api-token-auth/', data={'email': admin.email, 'password': PASSWORD}),
+            Scenario('auth-create', 'post', '/api/auth/', data=lambda n: {
+                'email': f'bench{n}-{time.time_ns()}@signup.test', 'password': PASSWORD,
+                'confirm_password': PASSWORD, 'company': {'company_name': f'Signup {n}'}}),
+            Scenario('employee-list', 'get', '/api/employee/', admin_token),
+            Scenario('employee-filter', 'get', f'/api/employee/?last_name={staff[-1].last_name}', admin_token),
+            Scenario('employee_up-detail', 'get', f'/api/employee_up/{employee.id}/', admin_token),
+            Scenario('company-list', 'get', '/api/company/', admin_token),
+            Scenario('profile-list', 'get', '/api/profile/', employee_token),
+            Scenario('office-list', 'get', '/api/office/', admin_token),
+            Scenario('detail_office-detail', 'get', f'/api/detail_office/{office}/', admin_token),
+            Scenario('employee_office-list', 'get', '/api/employee_office/', admin_token),
+            Scenario('employee_office_detail-list', 'get', '/api/employee_office_detail/', employee_token),
+            Scenario('vehicle-list', 'get', '/api/vehicle/', admin_token),
+            Scenario('vehicle-filter', 'get', f'/api/vehicle/?office={office}', admin_token),
+            Scenario('vehicle_change-detail', 'get', f'/api/vehicle_change/{vehicle}/', admin_token),
+            Scenario('vehicle_profile-list', 'get', '/api/vehicle_profile/', employee_token),
+        ]
+
+    def run_scenario(self, scenario, clients, requests):
+        def worker(numbers):
+            client = APIClient()
+            samples = []
+            for number in numbers:
+                recorder = QueryRecorder()
+                with ExitStack() as stack:
+                    for conn in connections.all():
+                        stack.enter_context(conn.execute_wrapper(recorder))
+                    start = time.perf_counter()
+                    response = scenario.request(client, number)
+                    if response.streaming:
+                        b''.join(response.streaming_content)
+                    latency = time.perf_counter() - start
+                samples.append((latency, recorder.count, response.status_code))
+            connections.close_all()
+            return samples
+
+        batches = [range(i, requests, clients) for i in range(clients)]
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=clients) as executor:
+            samples = [sample for batch in executor.map(worker, batches) for sample in batch]
+        elapsed = time.perf_counter() - start
+
+        latencies = [latency * 1000 for latency, _, _ in samples]
+        return {
+            'requests': len(samples),
+            'errors': sum(1 for _, _, status in samples if status >= 400),
+            'throughput_rps': round(len(samples) / elapsed, 2) if elapsed else 0.0,
+            'p50_ms': round(percentile(latencies, 0.50), 3),
+            'p95_ms': round(percentile(latencies, 0.95), 3),
+            'p99_ms': round(percentile(latencies, 0.99), 3),
+            'mean_ms': round(statistics.mean(latencies), 3) if latencies else 0.0,
+            'queries_per_request': round(statistics.mean(q for _, q, _ in samples), 2) if samples else 0.0,
+        }
+
+    def print_results(self, endpoints):
+        header = f'{"endpoint":32} {"req/s":>9} {"p50 ms":>9} {"p95 ms":>9} {"p99 ms":>9} {"queries":>8} {"errors":>7}'
+        self.stdout.write(header)
+        for name, result in endpoints.items():
+            self.stdout.write(
+                f'{name:32} {result["throughput_rps"]:>9} {result["p50_ms"]:>9} {result["p95_ms"]:>9} '
+                f'{result["p99_ms"]:>9} {result["queries_per_request"]:>8} {result["errors"]:>7}'
+            )
+
+    def compare(self, baseline, current, threshold):
+        regressions = []
+        for name, result in current.items():
+            old = baseline.get(name)
+            if old is None:
+                continue
+            if old['p95_ms'] and result['p95_ms'] > old['p95_ms'] * (1 + threshold):
+                regressions.append(f'{name}: p95 {old["p95_ms"]}ms -> {result["p95_ms"]}ms')
+            if old['throughput_rps'] and result['throughput_rps'] < old['throughput_rps'] * (1 - threshold):
+                regressions.append(f'{name}: throughput {old["throughput_rps"]} -> {result["throughput_rps"]} req/s')
+            # cold caches of a run add fractions of a query, a new query on every request adds one
+            if result['queries_per_request'] > old['queries_per_request'] + 0.5:
+                regressions.append(f'{name}: queries/request {old["queries_per_request"]} -> '
+                                   f'{result["queries_per_request"]}')
+        for line in regressions:
+            self.stdout.write(self.style.WARNING(f'REGRESSION {line}'))
+        if not regressions:
+            self.stdout.write(self.style.SUCCESS('No regressions against the baseline'))
+        return regressions
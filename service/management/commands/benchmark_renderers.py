@@ -0,0 +1,93 @@
+import io
+import json
+import random
+import time
+
+from django.core.management.base import BaseCommand
+from rest_framework.parsers import JSONParser
+from rest_framework.renderers import JSONRenderer
+
+from service.api import renderers
+from service.seed import CITIES, FIRST_NAMES, LAST_NAMES, PLATE_LETTERS, VEHICLES
+
+
+def vehicle_rows(count, rnd):
+    """Rows shaped like VehicleSerializer output with ?expand=office,driver"""
+    rows = []
+    for pk in range(1, count + 1):
+        city, region = rnd.choice(CITIES)
+        make, model = rnd.choice(VEHICLES)
+        first, last = rnd.choice(FIRST_NAMES), rnd.choice(LAST_NAMES)
+        letters = ''.join(rnd.choice(PLATE_LETTERS) for _ in range(4))
+        rows.append({
+            'id': pk,
+            'licence_plate': f'{letters[:2]}{rnd.randint(0, 9999):04d}{letters[2:]}',
+            'name': make,
+            'model': model,
+            'year_of_manufacture': rnd.randint(1984, 2021),
+            'office': {'id': pk % 50 + 1, 'office_name': f'{city} {pk % 50 + 1}', 'address': f'{pk % 300} Street',
+                       'country': 'Ukraine', 'city': city, 'region': region},
+            'driver': {'id': pk % 500 + 1, 'first_name': first, 'last_name': last,
+                       'email': f'{first}.{last}.{pk % 500 + 1}@company1.example'.lower()},
+        })
+    return rows
+
+
+def office_rows(count, rnd):
+    """Rows shaped like OfficeSerializer output"""
+    rows = []
+    for pk in range(1, count + 1):
+        city, region = rnd.choice(CITIES)
+        rows.append({'id': pk, 'office_name': f'{city} {pk}', 'address': f'{rnd.randint(1, 300)} Street {pk}',
+                     'country': 'Ukraine', 'city': city, 'region': region})
+    return rows
+
+
+class Command(BaseCommand):
+    help = ('Compare encode/decode time and payload size of the stdlib JSON, orjson and MessagePack '
+            'renderers/parsers on vehicle and office list pages')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=1000, help='Rows per list page')
+        parser.add_argument('--repeat', type=int, default=50)
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--output', help='Write results as JSON to this file')
+
+    def handle(self, *args, **options):
+        rnd = random.Random(options['seed'])
+        payloads = {
+            'vehicles': {'next': None, 'results': vehicle_rows(options['rows'], rnd)},
+            'offices': {'next': None, 'results': office_rows(options['rows'], rnd)},
+        }
+        codecs = [('json', JSONRenderer(), JSONParser())]
+        if renderers.orjson is not None:
+            codecs.append(('orjson', renderers.ORJSONRenderer(), renderers.ORJSONParser()))
+        if renderers.msgpack is not None:
+            codecs.append(('msgpack', renderers.MessagePackRenderer(), renderers.MessagePackParser()))
+
+        results = {}
+        for payload_name, data in payloads.items():
+            for codec_name, renderer, parser in codecs:
+                results[f'{payload_name}/{codec_name}'] = self.measure(data, renderer, parser, options['repeat'])
+
+        self.stdout.write(f'{"payload/codec":22} {"bytes":>10} {"encode ms":>10} {"decode ms":>10}')
+        for name, result in results.items():
+            self.stdout.write(f'{name:22} {result["bytes"]:>10} {result["encode_ms"]:>10} {result["decode_ms"]:>10}')
+        if options['output']:
+            with open(options['output'], 'w') as output:
+                json.dump(results, output, indent=2)
+
+    @staticmethod
+    def measure(data, renderer, parser, repeat):
+        body = renderer.render(data, renderer.media_type, {})
+        if parser.parse(io.BytesIO(body), parser.media_type, {}) != data:
+            raise AssertionError(f'{type(parser).__name__} does not read back what {type(renderer).__name__} wrote')
+        start = time.perf_counter()
+        for _ in range(repeat):
+            renderer.render(data, renderer.media_type, {})
+        encode = (time.perf_counter() - start) / repeat
+        start = time.perf_counter()
+        for _ in range(repeat):
+            parser.parse(io.BytesIO(body), parser.media_type, {})
+        decode = (time.perf_counter() - start) / repeat
+        return {'bytes': len(body), 'encode_ms': round(encode * 1000, 3), 'decode_ms': round(decode * 1000, 3)}
@@ -0,0 +1,20 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from service import changelog
+
+
+class Command(BaseCommand):
+    help = ('Keep the change log of /api/sync/ bounded: drop deletions older than SYNC_TOMBSTONE_DAYS and the '
+            'log of deleted companies. Clients with an older cursor are told to sync from scratch.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=float, default=None, help='Override SYNC_TOMBSTONE_DAYS')
+
+    def handle(self, *args, **options):
+        days = options['days'] if options['days'] is not None else getattr(settings, 'SYNC_TOMBSTONE_DAYS', 30)
+        removed = changelog.compact(timezone.now() - timedelta(days=days))
+        self.stdout.write(self.style.SUCCESS(f'Removed {removed} change log entries'))
@@ -0,0 +1,54 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models.functions import Lower
+from rest_framework.authtoken.models import Token
+
+from service.models import MyUser, Office, Vehicle
+
+
+def endpoint_queries(company=0, user=0, email=''):
+    """The filters the API endpoints run, as (endpoint, queryset)"""
+    employees = MyUser.objects.filter(company=company, is_staff=False)
+    offices = Office.objects.filter(company=company)
+    vehicles = Vehicle.objects.filter(company=company)
+    return [
+        ('auth: token lookup', Token.objects.filter(key='x')),
+        ('auth: email backend', MyUser.objects.alias(email_lower=Lower('email')).filter(email_lower=email.lower())),
+        ('employee: list', employees),
+        ('employee: ?first_name=', employees.filter(first_name='x')),
+        ('employee: ?last_name=', employees.filter(last_name='x')),
+        ('employee: ?email=', employees.filter(email='x')),
+        ('employee_up: detail', MyUser.objects.filter(id=user, company=company, is_staff=False)),
+        ('office: list', offices),
+        ('office: ?country=', offices.filter(country='x')),
+        ('office: ?city=', offices.filter(city='x')),
+        ('office: ?country=&city=', offices.filter(country='x', city='x')),
+        ('employee_office_detail: list', Office.objects.filter(employee=user)),
+        ('vehicle: list', vehicles),
+        ('vehicle: ?office=', vehicles.filter(office=0)),
+        ('vehicle: ?driver=', vehicles.filter(driver=0)),
+        ('vehicle: ?office=&driver=', vehicles.filter(office=0, driver=0)),
+        ('vehicle_profile: list', Vehicle.objects.filter(driver=user)),
+    ]
+
+
+class Command(BaseCommand):
+    help = 'Run EXPLAIN for the queries of every API endpoint and fail if one of them scans a whole table'
+
+    def handle(self, *args, **options):
+        scans = []
+        for endpoint, queryset in endpoint_queries():
+            plan = queryset.explain()
+            full_scan = any(self.is_full_scan(line) for line in plan.splitlines())
+            if full_scan:
+                scans.append(endpoint)
+            self.stdout.write(f'{"SCAN " if full_scan else "INDEX"} {endpoint}')
+            if options['verbosity'] > 1:
+                self.stdout.write(f'      {plan}')
+        if scans:
+            raise CommandError(f'Full table scan in: {", ".join(scans)}')
+        self.stdout.write(self.style.SUCCESS('Every endpoint query uses an index'))
+
+    @staticmethod
+    def is_full_scan(line):
+        # SQLite: "SCAN service_vehicle" is a table scan, "SEARCH ... USING INDEX" / "SCAN ... USING INDEX" are not
+        return 'SCAN' in line and 'USING' not in line
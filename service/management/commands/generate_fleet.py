@@ -0,0 +1,47 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from service.seed import FleetGenerator
+
+
+class Command(BaseCommand):
+    help = ('Generate synthetic tenants (companies, admins, employees, offices, vehicles) for capacity tests. '
+            'Counts are per company; the same --seed always gives the same data.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--companies', type=int, default=1)
+        parser.add_argument('--offices', type=int, default=50, help='Offices per company')
+        parser.add_argument('--employees', type=int, default=500, help='Employees per company')
+        parser.add_argument('--vehicles', type=int, default=100000, help='Vehicles per company')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--batch-size', type=int, default=5000)
+        parser.add_argument('--password', default='password', help='Password of every generated user')
+        parser.add_argument('--fast', action='store_true',
+                            help='SQLite only: skip fsync while loading (synchronous=OFF); '
+                                 'a crash during the load can corrupt the database')
+
+    def handle(self, *args, **options):
+        if options['fast'] and connection.vendor == 'sqlite':
+            with connection.cursor() as cursor:
+                cursor.execute('PRAGMA synchronous=OFF')
+
+        last_report = [0]
+
+        def progress(model, rows, elapsed):
+            if rows - last_report[0] >= 100000 or options['verbosity'] > 1:
+                last_report[0] = rows
+                self.stdout.write(f'{rows:>12,} rows  {rows / elapsed:>10,.0f} rows/s  ({model.__name__})')
+
+        generator = FleetGenerator(seed=options['seed'], batch_size=options['batch_size'],
+                                   password=options['password'], progress=progress)
+        companies = generator.generate(options['companies'], options['offices'], options['employees'],
+                                       options['vehicles'])
+        if not companies:
+            self.stdout.write('Nothing to create')
+            return
+        elapsed = time.perf_counter() - generator.started
+        self.stdout.write(self.style.SUCCESS(
+            f'Created {generator.rows:,} rows for companies {companies[0]}..{companies[-1]} in {elapsed:.1f}s'
+        ))
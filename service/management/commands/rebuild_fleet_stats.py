@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from service import rollups
+from service.models import Company
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the fleet statistics rollups from a full recount and verify them'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--company', type=int, action='append', help='Only this company (repeatable)')
+        parser.add_argument('--verify-only', action='store_true',
+                            help='Compare the rollups with a recount without changing anything')
+
+    def handle(self, *args, **options):
+        companies = options['company'] or Company.objects.order_by('id').values_list('id', flat=True)
+        broken = 0
+        for company_id in companies:
+            if not options['verify_only']:
+                rollups.rebuild(company_id)
+            differences = rollups.differences(company_id)
+            if differences:
+                broken += 1
+                for (dimension, key), (stored, recounted) in sorted(differences.items()):
+                    self.stdout.write(f'company {company_id} {dimension}={key}: stored {stored}, recount {recounted}')
+            elif options['verbosity'] > 1:
+                self.stdout.write(f'company {company_id}: ok')
+        if broken:
+            raise CommandError(f'Rollups differ from the recount for {broken} company(ies)')
+        self.stdout.write(self.style.SUCCESS('Fleet rollups match the recount'))
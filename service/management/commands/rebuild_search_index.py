@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from service import search
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the full-text search index of employees, offices and vehicles'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--company', type=int, action='append', help='Only this company (repeatable)')
+
+    def handle(self, *args, **options):
+        if not search.available():
+            raise CommandError('The search index is SQLite FTS5 only, other databases search without it')
+        if options['company']:
+            for company_id in options['company']:
+                search.reindex_company(company_id)
+        else:
+            search.reindex_all()
+        self.stdout.write(self.style.SUCCESS('Search index rebuilt'))
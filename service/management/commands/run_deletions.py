@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from service import deletions
+from service.models import Company, Deletion
+
+
+class Command(BaseCommand):
+    help = ('Run the pending deletions, and the running ones a crashed process left behind, to the end. '
+            'With --company, first schedule the deletion of a whole company.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--company', type=int, action='append', help='Delete this company (repeatable)')
+        parser.add_argument('--archive', action='store_true', help='Copy the rows of --company to ArchivedRow')
+        parser.add_argument('--retry-failed', action='store_true', help='Run failed deletions again')
+
+    def handle(self, *args, **options):
+        for company_id in options['company'] or []:
+            company = Company.objects.filter(pk=company_id).first()
+            if company is None:
+                raise CommandError(f'Company {company_id} does not exist')
+            deletion = deletions.create(Deletion.COMPANY, company, archive=options['archive'])
+            self.stdout.write(f'Deletion {deletion.pk}: company {company_id}')
+        if options['retry_failed']:
+            Deletion.objects.filter(status=Deletion.FAILED).update(status=Deletion.PENDING)
+
+        for pk in list(deletions.claimable().order_by('pk').values_list('pk', flat=True)):
+            deletion = deletions.run(pk)
+            if deletion is None:
+                continue
+            removed = ', '.join(f'{label} {count}' for label, count in sorted(deletion.deleted.items()))
+            self.stdout.write(self.style.SUCCESS(
+                f'Deletion {pk} ({deletion.target} {deletion.target_id}) done: {removed or "nothing left"}'))
@@ -0,0 +1,25 @@
+import signal
+
+from django.core.management.base import BaseCommand
+
+from service import jobs
+
+
+class Command(BaseCommand):
+    help = ('Run background jobs (imports, bulk updates, deletions) on worker threads until '
+            'stopped with Ctrl+C or SIGTERM; the current jobs are finished first. Start several processes '
+            'to scale out.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=2)
+        parser.add_argument('--kind', action='append', choices=sorted(jobs.handlers),
+                            help='Only jobs of this kind (repeatable)')
+        parser.add_argument('--once', action='store_true', help='Exit when no job is due')
+
+    def handle(self, *args, **options):
+        worker = jobs.Worker(threads=options['threads'], kinds=options['kind'])
+        signal.signal(signal.SIGTERM, lambda signum, frame: worker.stop())
+        self.stdout.write(f'Worker {worker.name}: {options["threads"]} thread(s), '
+                          f'kinds: {", ".join(options["kind"] or sorted(jobs.handlers))}')
+        worker.serve(once=options['once'])
+        self.stdout.write(self.style.SUCCESS('Worker stopped'))
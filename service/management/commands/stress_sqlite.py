@@ -0,0 +1,131 @@
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import OperationalError, connections, transaction
+
+from service.management.commands.benchmark import percentile
+
+PROFILES = {
+    # what the project ran with before: rollback journal, deferred BEGIN, one connection per request
+    'stock': {'ENGINE': 'django.db.backends.sqlite3', 'CONN_MAX_AGE': 0, 'OPTIONS': {}},
+    # the settings.DATABASES['default'] profile
+    'tuned': None,
+}
+
+
+class Command(BaseCommand):
+    help = ('Mixed read/write load from concurrent threads against a throwaway SQLite file, once with the '
+            'stock sqlite3 backend and once with the connection profile of settings.DATABASES["default"]. '
+            'Reports throughput, p95 latency and "database is locked" errors of each.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=8)
+        parser.add_argument('--seconds', type=float, default=5.0, help='Duration of each profile')
+        parser.add_argument('--write-ratio', type=float, default=0.2, help='Share of operations that write')
+        parser.add_argument('--rows', type=int, default=20000, help='Rows in the table before the run')
+        parser.add_argument('--profile', choices=sorted(PROFILES), action='append',
+                            help='Only this profile (repeatable)')
+
+    def handle(self, *args, **options):
+        directory = tempfile.mkdtemp(prefix='mobidev-stress-')
+        try:
+            results = {}
+            for name in options['profile'] or ['stock', 'tuned']:
+                path = os.path.join(directory, f'{name}.sqlite3')
+                alias = f'stress_{name}'
+                connections.databases[alias] = self.database_settings(name, path)
+                try:
+                    self.create_table(alias, options['rows'])
+                    results[name] = self.run(alias, options)
+                finally:
+                    connections[alias].close()
+                    del connections.databases[alias]
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+        self.stdout.write(f'{"profile":8} {"ops/s":>9} {"reads/s":>9} {"writes/s":>9} {"p95 ms":>9} {"locked":>7}')
+        for name, result in results.items():
+            self.stdout.write(f'{name:8} {result["ops"]:>9} {result["reads"]:>9} {result["writes"]:>9} '
+                              f'{result["p95_ms"]:>9} {result["locked"]:>7}')
+
+    @staticmethod
+    def database_settings(name, path):
+        profile = PROFILES[name] or connections.databases['default']
+        options = dict(profile.get('OPTIONS', {}))
+        if PROFILES[name] is None:
+            # as deployed, with MOBIDEV_SQLITE_JOURNAL_MODE
+            pragmas = options.get('pragmas', {})
+            options['pragmas'] = {**pragmas, 'journal_mode': pragmas.get('journal_mode') or 'wal'}
+        return {
+            'ENGINE': profile['ENGINE'],
+            'NAME': path,
+            'CONN_MAX_AGE': profile.get('CONN_MAX_AGE', 0),
+            'OPTIONS': options,
+        }
+
+    @staticmethod
+    def create_table(alias, rows):
+        with connections[alias].cursor() as cursor:
+            cursor.execute('CREATE TABLE fleet (id INTEGER PRIMARY KEY, company INTEGER, mileage INTEGER)')
+            cursor.execute('CREATE INDEX fleet_company ON fleet (company)')
+            cursor.executemany('INSERT INTO fleet (company, mileage) VALUES (%s, %s)',
+                               [(i % 50, 0) for i in range(rows)])
+
+    def run(self, alias, options):
+        deadline = time.perf_counter() + options['seconds']
+        counters = {'reads': 0, 'writes': 0, 'locked': 0}
+        latencies = []
+        lock = threading.Lock()
+
+        def worker(number):
+            rnd = random.Random(number)
+            local = {'reads': 0, 'writes': 0, 'locked': 0}
+            samples = []
+            while time.perf_counter() < deadline:
+                company = rnd.randrange(50)
+                write = rnd.random() < options['write_ratio']
+                start = time.perf_counter()
+                try:
+                    if write:
+                        # read then write in one transaction, like a typical PUT handler
+                        with transaction.atomic(using=alias), connections[alias].cursor() as cursor:
+                            cursor.execute('SELECT id FROM fleet WHERE company = %s LIMIT 1', [company])
+                            pk = cursor.fetchone()[0]
+                            cursor.execute('UPDATE fleet SET mileage = mileage + 1 WHERE id = %s', [pk])
+                    else:
+                        with connections[alias].cursor() as cursor:
+                            cursor.execute('SELECT COUNT(*), SUM(mileage) FROM fleet WHERE company = %s', [company])
+                            cursor.fetchone()
+                    local['writes' if write else 'reads'] += 1
+                    samples.append(time.perf_counter() - start)
+                except OperationalError as exc:
+                    if 'locked' not in str(exc):
+                        raise
+                    local['locked'] += 1
+                # end of a "request": closes the connection unless CONN_MAX_AGE keeps it
+                connections[alias].close_if_unusable_or_obsolete()
+            connections[alias].close()
+            with lock:
+                for key, value in local.items():
+                    counters[key] += value
+                latencies.extend(samples)
+
+        threads = [threading.Thread(target=worker, args=(number,)) for number in range(options['threads'])]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+        return {
+            'ops': round((counters['reads'] + counters['writes']) / elapsed, 1),
+            'reads': round(counters['reads'] / elapsed, 1),
+            'writes': round(counters['writes'] / elapsed, 1),
+            'p95_ms': round(percentile([latency * 1000 for latency in latencies], 0.95), 3),
+            'locked': counters['locked'],
+        }
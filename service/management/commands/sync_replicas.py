@@ -0,0 +1,49 @@
+import sqlite3
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from service.models import ReplicaHeartbeat
+from service.routers import PRIMARY, replica_aliases
+
+
+class Command(BaseCommand):
+    help = ('Stamp the replica heartbeat on the primary and copy the primary into the SQLite replicas of '
+            'DATABASE_REPLICAS (online backup). Replicas of other databases only get the heartbeat, '
+            'their own replication ships it.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, default=0,
+                            help='Repeat every INTERVAL seconds until interrupted (default: once)')
+        parser.add_argument('--alias', action='append', help='Only this replica (repeatable)')
+
+    def handle(self, *args, **options):
+        aliases = options['alias'] or replica_aliases()
+        unknown = set(aliases) - set(connections.databases)
+        if unknown:
+            raise CommandError(f'Unknown database alias(es): {", ".join(sorted(unknown))}')
+        while True:
+            started = time.time()
+            self.sync(aliases)
+            if options['verbosity'] > 1:
+                self.stdout.write(f'Synced {", ".join(aliases) or "no replicas"} in {time.time() - started:.3f}s')
+            if not options['interval']:
+                break
+            time.sleep(max(0.0, options['interval'] - (time.time() - started)))
+
+    @staticmethod
+    def sync(aliases):
+        # stamped before the copy, so a replica never claims to be newer than it is
+        ReplicaHeartbeat.objects.using(PRIMARY).update_or_create(id=1, defaults={'beat': time.time()})
+        primary = connections[PRIMARY]
+        for alias in aliases:
+            replica = connections[alias]
+            if replica.vendor != 'sqlite' or primary.vendor != 'sqlite':
+                continue
+            primary.ensure_connection()
+            target = sqlite3.connect(str(replica.settings_dict['NAME']))
+            try:
+                primary.connection.backup(target)
+            finally:
+                target.close()
@@ -0,0 +1,96 @@
+import threading
+from bisect import bisect_left
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class RouteStats:
+    __slots__ = ('buckets', 'count', 'latency_sum', 'queries', 'sql_seconds', 'response_bytes', 'n_plus_one')
+
+    def __init__(self):
+        self.buckets = [0] * len(LATENCY_BUCKETS)
+        self.count = 0
+        self.latency_sum = 0.0
+        self.queries = 0
+        self.sql_seconds = 0.0
+        self.response_bytes = 0
+        self.n_plus_one = 0
+
+
+class MetricsRegistry:
+    """Per-route request metrics, rendered in the Prometheus text format.
+    A request costs one dict lookup and a few additions under a lock."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.routes = {}
+        self.collectors = []
+
+    def observe(self, route, method, status, latency, queries, sql_seconds, response_bytes, n_plus_one):
+        key = (route.replace('\\', '\\\\').replace('"', '\\"'), method, str(status))
+        index = bisect_left(LATENCY_BUCKETS, latency)
+        with self._lock:
+            stats = self.routes.get(key)
+            if stats is None:
+                stats = self.routes[key] = RouteStats()
+            if index < len(LATENCY_BUCKETS):
+                stats.buckets[index] += 1
+            stats.count += 1
+            stats.latency_sum += latency
+            stats.queries += queries
+            stats.sql_seconds += sql_seconds
+            stats.response_bytes += response_bytes
+            stats.n_plus_one += n_plus_one
+
+    def register_collector(self, name, help_text, collect):
+        """Export a dict of counters returned by collect() as name{key="..."}"""
+        self.collectors.append((name, help_text, collect))
+
+    def reset(self):
+        with self._lock:
+            self.routes.clear()
+
+    def render(self):
+        with self._lock:
+            routes = sorted(self.routes.items())
+            lines = []
+            self._render_routes(lines, routes)
+        for name, help_text, collect in self.collectors:
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} gauge')
+            for key, value in sorted(collect().items()):
+                lines.append(f'{name}{{key="{key}"}} {value}')
+        return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def _render_routes(lines, routes):
+        lines.append('# HELP http_request_duration_seconds Request latency by route')
+        lines.append('# TYPE http_request_duration_seconds histogram')
+        for (route, method, status), stats in routes:
+            labels = f'route="{route}",method="{method}",status="{status}"'
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS, stats.buckets):
+                cumulative += count
+                lines.append(f'http_request_duration_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f'http_request_duration_seconds_bucket{{{labels},le="+Inf"}} {stats.count}')
+            lines.append(f'http_request_duration_seconds_sum{{{labels}}} {stats.latency_sum:.6f}')
+            lines.append(f'http_request_duration_seconds_count{{{labels}}} {stats.count}')
+
+        counters = (
+            ('http_request_db_queries_total', 'DB queries run by requests of the route', 'queries'),
+            ('http_request_db_seconds_total', 'Time spent in SQL by requests of the route', 'sql_seconds'),
+            ('http_response_bytes_total', 'Response body bytes of the route (streaming bodies not counted)',
+             'response_bytes'),
+            ('http_request_n_plus_one_total', 'Requests of the route with a suspected N+1 query pattern',
+             'n_plus_one'),
+        )
+        for name, help_text, attribute in counters:
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} counter')
+            for (route, method, status), stats in routes:
+                value = getattr(stats, attribute)
+                value = f'{value:.6f}' if isinstance(value, float) else value
+                lines.append(f'{name}{{route="{route}",method="{method}",status="{status}"}} {value}')
+
+
+registry = MetricsRegistry()
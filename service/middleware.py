@@ -0,0 +1,105 @@
+import logging
+import time
+from collections import Counter
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.db import connections
+
+from service.metrics import registry
+from service.routers import replica_aliases, routing, use_replicas
+
+logger = logging.getLogger(__name__)
+
+
+class QueryRecorder:
+    """DB execute wrapper counting the queries of one request and their time.
+    Django passes the SQL with placeholders, so equal strings are structurally identical queries."""
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.statements = Counter()
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.seconds += time.perf_counter() - start
+            self.count += 1
+            self.statements[sql] += 1
+
+    def repeated(self, threshold):
+        """Reads run at least threshold times; batched writes (bulk_create) legitimately repeat"""
+        return [
+            (sql, count) for sql, count in self.statements.items()
+            if count >= threshold and sql.lstrip()[:6].upper() == 'SELECT'
+        ]
+
+
+class MetricsMiddleware:
+    """Record latency, query count, SQL time and response size per resolved route, and flag
+    requests that run the same query METRICS_N_PLUS_ONE_THRESHOLD or more times as suspected N+1."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.threshold = getattr(settings, 'METRICS_N_PLUS_ONE_THRESHOLD', 10)
+
+    def __call__(self, request):
+        recorder = QueryRecorder()
+        start = time.perf_counter()
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(recorder))
+            response = self.get_response(request)
+        latency = time.perf_counter() - start
+
+        match = request.resolver_match
+        route = match.route if match is not None else 'unresolved'
+        repeated = recorder.repeated(self.threshold)
+        if repeated:
+            sql, count = max(repeated, key=lambda item: item[1])
+            logger.warning('Suspected N+1 on %s: query ran %d times: %s', route, count, sql)
+        size = 0 if response.streaming else len(response.content)
+        registry.observe(
+            route, request.method, response.status_code, latency,
+            recorder.count, recorder.seconds, size, 1 if repeated else 0,
+        )
+        return response
+
+
+class ReplicaRoutingMiddleware:
+    """GET/HEAD requests may read from the replicas of DATABASE_REPLICAS (see service.routers.ReplicaRouter).
+    A request that writes pins its client to the primary for REPLICA_STICKY_SECONDS with a signed cookie,
+    so the client reads its own writes whatever the replica lag and whichever process serves it next.
+    Clients that drop cookies still read the writes to their company (the router compares the replica with
+    the company's last-modified time), just not rows outside it such as jobs.
+    Views opt out with replica_reads = False."""
+    pin_cookie = 'replica_pin'
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.sticky_seconds = getattr(settings, 'REPLICA_STICKY_SECONDS', 5)
+
+    def __call__(self, request):
+        if not replica_aliases():
+            return self.get_response(request)
+        safe = request.method in ('GET', 'HEAD', 'OPTIONS')
+        # the signature carries the time it was made: an older pin is ignored, whatever the browser keeps
+        pinned = request.get_signed_cookie(self.pin_cookie, None, salt=self.pin_cookie,
+                                           max_age=self.sticky_seconds) is not None
+        with use_replicas(request) as state:
+            state.replica_reads = safe and not pinned
+            response = self.get_response(request)
+        if state.wrote or not safe:
+            response.set_signed_cookie(self.pin_cookie, '1', salt=self.pin_cookie, max_age=self.sticky_seconds,
+                                       httponly=True, samesite='Lax')
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        view_class = getattr(view_func, 'cls', None) or getattr(view_func, 'view_class', None)
+        if not getattr(view_class, 'replica_reads', True):
+            state = routing.get()
+            if state is not None:
+                state.replica_reads = False
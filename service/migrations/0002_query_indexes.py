@@ -0,0 +1,42 @@
+# Generated by Django 3.2.3 on 2026-10-18 07:07
+
+from django.db import migrations, models
+import django.db.models.functions.text
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('service', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='myuser',
+            index=models.Index(django.db.models.functions.text.Lower('email'), name='myuser_email_lower_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='myuser',
+            index=models.Index(fields=['company', 'is_staff', 'first_name'], name='myuser_company_first_name_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='myuser',
+            index=models.Index(fields=['company', 'is_staff', 'last_name'], name='myuser_company_last_name_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='office',
+            index=models.Index(fields=['company', 'country', 'city'], name='office_company_country_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='office',
+            index=models.Index(fields=['company', 'city'], name='office_company_city_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='vehicle',
+            index=models.Index(fields=['company', 'office'], name='vehicle_company_office_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='vehicle',
+            index=models.Index(fields=['company', 'driver'], name='vehicle_company_driver_idx'),
+        ),
+    ]
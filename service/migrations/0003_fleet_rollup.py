@@ -0,0 +1,28 @@
+# Generated by Django 3.2.3 on 2026-10-18 07:16
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('service', '0002_query_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FleetRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('dimension', models.CharField(choices=[('office', 'Office'), ('driver', 'Driver'), ('year', 'Year of manufacture')], max_length=10)),
+                ('key', models.BigIntegerField()),
+                ('count', models.IntegerField(default=0)),
+                ('company', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='service.company')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='fleetrollup',
+            constraint=models.UniqueConstraint(fields=('company', 'dimension', 'key'), name='fleetrollup_unique_key'),
+        ),
+    ]
@@ -0,0 +1,45 @@
+from django.db import migrations
+
+CREATE_TABLE = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS service_search USING fts5("
+    "tenant, kind UNINDEXED, title, body, "
+    "tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3 4')"
+)
+
+BACKFILL = (
+    "INSERT INTO service_search (rowid, tenant, kind, title, body) "
+    "SELECT id * 4 + 1, 'c' || IFNULL(company_id, 0), 'employee', first_name || ' ' || last_name, email "
+    "FROM service_myuser",
+    "INSERT INTO service_search (rowid, tenant, kind, title, body) "
+    "SELECT id * 4 + 2, 'c' || IFNULL(company_id, 0), 'office', office_name, "
+    "address || ' ' || city || ' ' || region || ' ' || country FROM service_office",
+    "INSERT INTO service_search (rowid, tenant, kind, title, body) "
+    "SELECT id * 4 + 3, 'c' || IFNULL(company_id, 0), 'vehicle', licence_plate, name || ' ' || model "
+    "FROM service_vehicle",
+)
+
+
+def create_search_index(apps, schema_editor):
+    # FTS5 is SQLite only; other databases search with icontains (see service.search)
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    schema_editor.execute(CREATE_TABLE)
+    for sql in BACKFILL:
+        schema_editor.execute(sql)
+
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    schema_editor.execute('DROP TABLE IF EXISTS service_search')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('service', '0003_fleet_rollup'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
@@ -0,0 +1,61 @@
+# Generated by Django 3.2.3 on 2026-10-18 07:58
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+from django.utils import timezone
+
+SOURCES = (('office', 'service_office'), ('employee', 'service_myuser'), ('vehicle', 'service_vehicle'))
+
+
+def backfill_change_log(apps, schema_editor):
+    """One entry per existing object, so that ?since=0 returns everything"""
+    now = schema_editor.connection.ops.adapt_datetimefield_value(timezone.now())
+    for kind, table in SOURCES:
+        schema_editor.execute(
+            f'INSERT INTO service_change (company_id, kind, object_id, deleted, changed_at) '
+            f'SELECT company_id, %s, id, %s, %s FROM {table} WHERE company_id IS NOT NULL ORDER BY id',
+            [kind, False, now],
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('service', '0007_jobs'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChangeHorizon',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('cursor', models.BigIntegerField()),
+                ('company', models.OneToOneField(db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='service.company')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Change',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('office', 'Office'), ('vehicle', 'Vehicle'), ('employee', 'Employee')], max_length=10)),
+                ('object_id', models.BigIntegerField()),
+                ('deleted', models.BooleanField(default=False)),
+                ('changed_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('company', models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='service.company')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='change',
+            index=models.Index(fields=['company', 'id'], name='change_company_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='change',
+            index=models.Index(fields=['deleted', 'changed_at'], name='change_tombstone_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='change',
+            constraint=models.UniqueConstraint(fields=('kind', 'object_id'), name='change_unique_object'),
+        ),
+        migrations.RunPython(backfill_change_log, migrations.RunPython.noop),
+    ]
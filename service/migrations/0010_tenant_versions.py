@@ -0,0 +1,21 @@
+# Generated by Django 3.2.3 on 2026-10-18 08:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('service', '0009_uploads'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TenantVersion',
+            fields=[
+                ('tenant', models.BigIntegerField(primary_key=True, serialize=False)),
+                ('version', models.BigIntegerField(default=0)),
+                ('modified', models.BigIntegerField()),
+            ],
+        ),
+    ]
@@ -1,6 +1,8 @@
 from django.utils import timezone
 from django.contrib.auth.models import AbstractUser
+from django.core.serializers.json import DjangoJSONEncoder
 from django.db import models
+from django.db.models.functions import Lower
 
 
 # Create your models here.
@@ -22,6 +24,13 @@ class MyUser(AbstractUser):
     USERNAME_FIELD = 'email'
     REQUIRED_FIELDS = []
 
+    class Meta(AbstractUser.Meta):
+        indexes = [
+            models.Index(Lower('email'), name='myuser_email_lower_idx'),
+            models.Index(fields=['company', 'is_staff', 'first_name'], name='myuser_company_first_name_idx'),
+            models.Index(fields=['company', 'is_staff', 'last_name'], name='myuser_company_last_name_idx'),
+        ]
+
 
 class Office(models.Model):
     office_name = models.CharField(max_length=20)
@@ -32,6 +41,12 @@ class Office(models.Model):
     company = models.ForeignKey(Company, on_delete=models.CASCADE, blank=True, null=True)
     employee = models.ForeignKey(MyUser, on_delete=models.CASCADE, blank=True, null=True)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['company', 'country', 'city'], name='office_company_country_idx'),
+            models.Index(fields=['company', 'city'], name='office_company_city_idx'),
+        ]
+
     def __str__(self):
         return f'{self.office_name}'
 
@@ -47,3 +62,182 @@ class Vehicle(models.Model):
     company = models.ForeignKey(Company, on_delete=models.CASCADE, blank=True, null=True)
     office = models.ForeignKey(Office, on_delete=models.CASCADE, blank=True, null=True)
     driver = models.ForeignKey(MyUser, on_delete=models.CASCADE, blank=True, null=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['company', 'office'], name='vehicle_company_office_idx'),
+            models.Index(fields=['company', 'driver'], name='vehicle_company_driver_idx'),
+        ]
+
+
+class FleetRollup(models.Model):
+    """Incrementally maintained vehicle counters of a company (see service/rollups.py).
+    dimension: 'office' (key - office id), 'driver' (key - driver id) or 'year' (key - year of manufacture);
+    key 0 counts vehicles without office/driver."""
+    OFFICE = 'office'
+    DRIVER = 'driver'
+    YEAR = 'year'
+    DIMENSIONS = [(OFFICE, 'Office'), (DRIVER, 'Driver'), (YEAR, 'Year of manufacture')]
+
+    company = models.ForeignKey(Company, on_delete=models.CASCADE)
+    dimension = models.CharField(max_length=10, choices=DIMENSIONS)
+    key = models.BigIntegerField()
+    count = models.IntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['company', 'dimension', 'key'], name='fleetrollup_unique_key'),
+        ]
+
+
+class ReplicaHeartbeat(models.Model):
+    """One row, stamped on the primary by `manage.py sync_replicas`. Read on a replica, it tells up to
+    which moment the replica has the primary's data (see service/routers.py)."""
+    beat = models.FloatField(default=0)
+
+
+class Deletion(models.Model):
+    """Removal of a company, office or employee with everything that depends on it, done in short batches
+    in the background (see service/deletions.py). deleted - rows removed so far per model label,
+    planned - rows there were to remove when it started. company is a plain id: the company may be the target."""
+    COMPANY = 'company'
+    OFFICE = 'office'
+    EMPLOYEE = 'employee'
+    TARGETS = [(COMPANY, 'Company'), (OFFICE, 'Office'), (EMPLOYEE, 'Employee')]
+
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUSES = [(PENDING, 'Pending'), (RUNNING, 'Running'), (DONE, 'Done'), (FAILED, 'Failed')]
+
+    company = models.ForeignKey(Company, on_delete=models.DO_NOTHING, db_constraint=False, blank=True, null=True,
+                                related_name='+')
+    target = models.CharField(max_length=10, choices=TARGETS)
+    target_id = models.BigIntegerField()
+    archive = models.BooleanField(default=False)
+    status = models.CharField(max_length=10, choices=STATUSES, default=PENDING)
+    planned = models.JSONField(default=dict)
+    deleted = models.JSONField(default=dict)
+    error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    finished_at = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'updated_at'], name='deletion_status_idx'),
+            models.Index(fields=['company', 'target', 'target_id'], name='deletion_target_idx'),
+        ]
+
+
+class ArchivedRow(models.Model):
+    """A row removed by a Deletion with archive=True, as the dict of its columns"""
+    deletion = models.ForeignKey(Deletion, on_delete=models.SET_NULL, blank=True, null=True)
+    company = models.ForeignKey(Company, on_delete=models.DO_NOTHING, db_constraint=False, blank=True, null=True,
+                                related_name='+')
+    model = models.CharField(max_length=100)
+    object_id = models.BigIntegerField()
+    data = models.JSONField(encoder=DjangoJSONEncoder)
+    archived_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['company', 'model', 'object_id'], name='archivedrow_object_idx'),
+        ]
+
+
+class Job(models.Model):
+    """A unit of background work run by `manage.py run_jobs` (see service/jobs.py).
+    payload - the arguments of the handler registered for kind, result - what it returned or why it failed.
+    Higher priority runs first; a failed attempt is queued again after a backoff until max_attempts."""
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    SUCCEEDED = 'succeeded'
+    FAILED = 'failed'
+    STATUSES = [(QUEUED, 'Queued'), (RUNNING, 'Running'), (SUCCEEDED, 'Succeeded'), (FAILED, 'Failed')]
+
+    kind = models.CharField(max_length=50)
+    company = models.ForeignKey(Company, on_delete=models.DO_NOTHING, db_constraint=False, blank=True, null=True,
+                                related_name='+')
+    user = models.ForeignKey(MyUser, on_delete=models.SET_NULL, blank=True, null=True, related_name='+')
+    payload = models.JSONField(default=dict, encoder=DjangoJSONEncoder)
+    result = models.JSONField(blank=True, null=True, encoder=DjangoJSONEncoder)
+    status = models.CharField(max_length=10, choices=STATUSES, default=QUEUED)
+    priority = models.IntegerField(default=0)
+    attempts = models.PositiveIntegerField(default=0)
+    max_attempts = models.PositiveIntegerField(default=1)
+    run_after = models.DateTimeField(default=timezone.now)
+    worker = models.CharField(max_length=100, blank=True)
+    heartbeat_at = models.DateTimeField(blank=True, null=True)
+    error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(blank=True, null=True)
+    finished_at = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'priority', 'run_after'], name='job_queue_idx'),
+            models.Index(fields=['company', 'status'], name='job_company_idx'),
+        ]
+
+
+class TenantVersion(models.Model):
+    """Cache version and last-modified time (unix seconds) of a company's data, see service.api.caching.
+    tenant is the company id, 0 for users without a company. In the database so every process sees a bump."""
+    tenant = models.BigIntegerField(primary_key=True)
+    version = models.BigIntegerField(default=0)
+    modified = models.BigIntegerField()
+
+
+class Upload(models.Model):
+    """A request body kept for a background job (the ?async=1 imports), stored in chunks as it is read,
+    or the file written by a background export"""
+    company = models.ForeignKey(Company, on_delete=models.DO_NOTHING, db_constraint=False, blank=True, null=True,
+                                related_name='+')
+    content_type = models.CharField(max_length=100)
+    size = models.BigIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+
+class UploadChunk(models.Model):
+    upload = models.ForeignKey(Upload, on_delete=models.CASCADE, related_name='chunks')
+    number = models.PositiveIntegerField()
+    data = models.BinaryField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['upload', 'number'], name='uploadchunk_unique_number'),
+        ]
+
+
+class Change(models.Model):
+    """Change log of the offices, vehicles and employees of a company, read by /api/sync/?since=<id>
+    (see service/changelog.py). An object has a single entry, moved to the end of the log (new id) on every
+    change, so the log never holds more than the live objects and the tombstones (deleted=True)."""
+    OFFICE = 'office'
+    VEHICLE = 'vehicle'
+    EMPLOYEE = 'employee'
+    KINDS = [(OFFICE, 'Office'), (VEHICLE, 'Vehicle'), (EMPLOYEE, 'Employee')]
+
+    company = models.ForeignKey(Company, on_delete=models.DO_NOTHING, db_constraint=False, related_name='+')
+    kind = models.CharField(max_length=10, choices=KINDS)
+    object_id = models.BigIntegerField()
+    deleted = models.BooleanField(default=False)
+    changed_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['kind', 'object_id'], name='change_unique_object'),
+        ]
+        indexes = [
+            models.Index(fields=['company', 'id'], name='change_company_idx'),
+            models.Index(fields=['deleted', 'changed_at'], name='change_tombstone_idx'),
+        ]
+
+
+class ChangeHorizon(models.Model):
+    """Newest tombstone of a company dropped by the compaction: a client with an older cursor missed
+    deletions and has to sync from scratch"""
+    company = models.OneToOneField(Company, on_delete=models.DO_NOTHING, db_constraint=False, related_name='+')
+    cursor = models.BigIntegerField()
@@ -0,0 +1,163 @@
+from collections import Counter
+
+from django.db import IntegrityError, connection, transaction
+from django.db.models import Count, F
+
+from service.models import FleetRollup, Office, Vehicle
+
+NONE_KEY = 0
+# a field of a vehicle state that was deferred when the vehicle was loaded
+UNKNOWN = object()
+FIELDS = ('company_id', 'office_id', 'driver_id', 'year_of_manufacture')
+
+
+def vehicle_state(company_id, office_id, driver_id, year):
+    """What a vehicle contributes to the rollups, None when it belongs to no company"""
+    if company_id is None:
+        return None
+    return company_id, office_id, driver_id, year
+
+
+def state_of(vehicle):
+    """vehicle_state() from the fields in the instance's __dict__. A deferred field is UNKNOWN instead of
+    loaded, which on .only()/.defer() querysets would cost a query per row."""
+    values = vehicle.__dict__
+    return vehicle_state(*(values.get(name, UNKNOWN) for name in FIELDS))
+
+
+def merge(old_state, new_state):
+    """new_state with its UNKNOWN fields taken from old_state: a deferred field is not saved, so it did not
+    change"""
+    if old_state is None or new_state is None:
+        return new_state
+    return tuple(old if new is UNKNOWN else new for old, new in zip(old_state, new_state))
+
+
+def complete(state, vehicle):
+    """state with its UNKNOWN fields read from the vehicle's row, one query; state itself if it has none.
+    The fields of the row still deferred on the instance are set too, so later receivers need no query."""
+    if state is None or UNKNOWN not in state:
+        return state
+    row = Vehicle.objects.filter(pk=vehicle.pk).values_list(*FIELDS).first()
+    if row is None:
+        return state
+    for name, stored in zip(FIELDS, row):
+        vehicle.__dict__.setdefault(name, stored)
+    return vehicle_state(*(stored if value is UNKNOWN else value for value, stored in zip(state, row)))
+
+
+def contributions(state, sign):
+    """Counter {(company, dimension, key): delta} of one vehicle state; UNKNOWN fields contribute nothing"""
+    if state is None or state[0] is UNKNOWN:
+        return Counter()
+    company_id, office_id, driver_id, year = state
+    counters = {
+        FleetRollup.OFFICE: office_id if office_id is UNKNOWN else office_id or NONE_KEY,
+        FleetRollup.DRIVER: driver_id if driver_id is UNKNOWN else driver_id or NONE_KEY,
+        FleetRollup.YEAR: year,
+    }
+    return Counter({(company_id, dimension, key): sign for dimension, key in counters.items() if key is not UNKNOWN})
+
+
+def apply(deltas):
+    """Add a Counter of deltas to the rollup table; one UPDATE per changed counter"""
+    for (company_id, dimension, key), delta in deltas.items():
+        if delta:
+            add(company_id, dimension, key, delta)
+
+
+def add(company_id, dimension, key, delta):
+    rows = FleetRollup.objects.filter(company_id=company_id, dimension=dimension, key=key)
+    if rows.update(count=F('count') + delta) or delta < 0:
+        # decrements never create rows: the company may be in the middle of a cascade delete
+        return
+    try:
+        with transaction.atomic():
+            FleetRollup.objects.create(company_id=company_id, dimension=dimension, key=key, count=delta)
+    except IntegrityError:
+        rows.update(count=F('count') + delta)
+
+
+def vehicle_changed(old_state, new_state):
+    deltas = contributions(new_state, 1)
+    deltas.update(contributions(old_state, -1))
+    apply(deltas)
+
+
+def add_vehicles(vehicles):
+    """Count vehicles inserted without post_save (bulk_create)"""
+    deltas = Counter()
+    for vehicle in vehicles:
+        deltas.update(contributions(state_of(vehicle), 1))
+    apply(deltas)
+
+
+def recount(company_id):
+    """Rollup counters computed from scratch with GROUP BY, as {(dimension, key): count}"""
+    vehicles = Vehicle.objects.filter(company_id=company_id).order_by()
+    counts = {}
+    for dimension, column in ((FleetRollup.OFFICE, 'office'), (FleetRollup.DRIVER, 'driver'),
+                              (FleetRollup.YEAR, 'year_of_manufacture')):
+        for key, count in vehicles.values_list(column).annotate(total=Count('id')):
+            counts[(dimension, key or NONE_KEY)] = count
+    return counts
+
+
+def stored(company_id):
+    return {
+        (dimension, key): count
+        for dimension, key, count in
+        FleetRollup.objects.filter(company_id=company_id).values_list('dimension', 'key', 'count')
+    }
+
+
+def differences(company_id):
+    """{(dimension, key): (stored, recounted)} for every counter that is off"""
+    expected, actual = recount(company_id), stored(company_id)
+    return {
+        key: (actual.get(key, 0), expected.get(key, 0))
+        for key in set(expected) | set(actual)
+        if actual.get(key, 0) != expected.get(key, 0)
+    }
+
+
+def rebuild(company_id):
+    """Recount a company with one INSERT ... SELECT ... GROUP BY per dimension, whatever its size"""
+    quote = connection.ops.quote_name
+    table, vehicles = quote(FleetRollup._meta.db_table), quote(Vehicle._meta.db_table)
+    columns = ', '.join(quote(name) for name in ('company_id', 'dimension', 'key', 'count'))
+    with transaction.atomic(), connection.cursor() as cursor:
+        FleetRollup.objects.filter(company_id=company_id).delete()
+        for dimension, column in ((FleetRollup.OFFICE, 'office_id'), (FleetRollup.DRIVER, 'driver_id'),
+                                  (FleetRollup.YEAR, 'year_of_manufacture')):
+            cursor.execute(
+                f'INSERT INTO {table} ({columns}) '
+                f'SELECT company_id, %s, COALESCE({column}, {NONE_KEY}), COUNT(*) FROM {vehicles} '
+                f'WHERE company_id = %s GROUP BY company_id, {column}',
+                [dimension, company_id],
+            )
+
+
+def fleet_stats(company_id):
+    """Dashboard numbers of a company from the rollup table: O(offices + drivers + years) rows"""
+    rows = stored(company_id)
+    offices = dict(Office.objects.filter(company_id=company_id).values_list('id', 'office_name'))
+    by_dimension = {FleetRollup.OFFICE: {}, FleetRollup.DRIVER: {}, FleetRollup.YEAR: {}}
+    for (dimension, key), count in rows.items():
+        by_dimension[dimension][key] = count
+    per_office = by_dimension[FleetRollup.OFFICE]
+    per_driver = by_dimension[FleetRollup.DRIVER]
+    return {
+        'total': sum(by_dimension[FleetRollup.YEAR].values()),
+        'unassigned': per_driver.get(NONE_KEY, 0),
+        'without_office': per_office.get(NONE_KEY, 0),
+        'offices': [
+            {'office': office_id, 'office_name': name, 'vehicles': per_office.get(office_id, 0)}
+            for office_id, name in sorted(offices.items())
+        ],
+        'drivers': [
+            {'driver': driver_id, 'vehicles': count}
+            for driver_id, count in sorted(per_driver.items()) if driver_id != NONE_KEY and count
+        ],
+        'years': {year: count for year, count in sorted(by_dimension[FleetRollup.YEAR].items()) if count},
+    }
@@ -0,0 +1,145 @@
+import random
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.db import DatabaseError, connections
+from django.utils.functional import SimpleLazyObject
+
+PRIMARY = 'default'
+
+routing = ContextVar('database_routing', default=None)
+
+
+class RoutingState:
+    """What the router may do for the current request"""
+    __slots__ = ('request', 'replica_reads', 'wrote', 'replica', 'tenant_checked')
+
+    def __init__(self, request=None, replica_reads=False):
+        self.request = request
+        self.replica_reads = replica_reads
+        self.wrote = False
+        # the replica picked for the request, or PRIMARY once a replica was found unfit
+        self.replica = None
+        self.tenant_checked = False
+
+
+def replica_aliases():
+    return getattr(settings, 'DATABASE_REPLICAS', [])
+
+
+class ReplicaStatus:
+    """Per-process view of how far behind each replica is, refreshed every REPLICA_CHECK_INTERVAL
+    seconds from its ReplicaHeartbeat row"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # alias -> (checked at, replica has the primary's data up to this time)
+        self.checked = {}
+
+    def as_of(self, alias):
+        now = time.time()
+        interval = getattr(settings, 'REPLICA_CHECK_INTERVAL', 1.0)
+        with self._lock:
+            checked = self.checked.get(alias)
+        if checked is not None and now - checked[0] < interval:
+            return checked[1]
+        from service.models import ReplicaHeartbeat
+        try:
+            beat = ReplicaHeartbeat.objects.using(alias).values_list('beat', flat=True).first() or 0.0
+        except DatabaseError:
+            beat = 0.0
+        with self._lock:
+            self.checked[alias] = (now, beat)
+        return beat
+
+    def healthy(self):
+        """Replicas lagging at most REPLICA_MAX_LAG seconds"""
+        max_lag = getattr(settings, 'REPLICA_MAX_LAG', 30)
+        now = time.time()
+        return [alias for alias in replica_aliases() if now - self.as_of(alias) <= max_lag]
+
+    def reset(self):
+        with self._lock:
+            self.checked.clear()
+
+
+replica_status = ReplicaStatus()
+
+
+@contextmanager
+def use_replicas(request=None):
+    """Let the reads of a block go to a replica, see ReplicaRouter"""
+    token = routing.set(RoutingState(request, replica_reads=True))
+    try:
+        yield routing.get()
+    finally:
+        routing.reset(token)
+
+
+def resolved_user(request):
+    """request.user once authentication has loaded it, else None. The lazy user of AuthenticationMiddleware
+    is never loaded here: that reads the session, through the router asking"""
+    user = request.__dict__.get('user')
+    if isinstance(user, SimpleLazyObject):
+        # set by django.contrib.auth.get_user() when the lazy user is first used
+        user = request.__dict__.get('_cached_user')
+    return user
+
+
+def tenant_modified(request):
+    """Last-modified time of the requesting user's company, None before authentication"""
+    if getattr(resolved_user(request), 'company_id', None) is None:
+        return None
+    from service.api.caching import tenant_state
+    return tenant_state(request)[1]
+
+
+class ReplicaRouter:
+    """Writes go to the primary. Reads go to a replica only inside use_replicas() (GET requests, see
+    ReplicaRoutingMiddleware) and only while it is safe, otherwise to the primary:
+    - nothing was written in this request and no transaction is open on the primary;
+    - the replica lags at most REPLICA_MAX_LAG seconds;
+    - the replica already has the last change of the user's company (its heartbeat is newer than the
+      company's last-modified mark), so cached responses and ETags never describe older data."""
+
+    def db_for_read(self, model, **hints):
+        state = routing.get()
+        if state is None or not state.replica_reads or state.wrote or not replica_aliases():
+            return PRIMARY
+        if connections[PRIMARY].in_atomic_block:
+            return PRIMARY
+        if state.replica is None:
+            healthy = replica_status.healthy()
+            state.replica = random.choice(healthy) if healthy else PRIMARY
+        if state.replica != PRIMARY and not state.tenant_checked and state.request is not None:
+            # set first: reading the company's mark must not come back here
+            state.tenant_checked = True
+            modified = tenant_modified(state.request)
+            if modified is None:
+                # not authenticated yet, checked again by a later read
+                state.tenant_checked = False
+            # last-modified is in whole seconds
+            elif replica_status.as_of(state.replica) < modified + 1:
+                state.replica = PRIMARY
+        return state.replica
+
+    def db_for_write(self, model, **hints):
+        state = routing.get()
+        if state is not None:
+            state.wrote = True
+        return PRIMARY
+
+    def allow_relation(self, obj1, obj2, **hints):
+        databases = {PRIMARY, *replica_aliases()}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # replicas get the schema from the primary
+        if db in replica_aliases():
+            return False
+        return None
@@ -0,0 +1,185 @@
+import re
+
+from django.db import connection
+from django.db.models import Q, Value
+from django.db.models.functions import Concat
+
+from service.models import MyUser, Office, Vehicle
+
+TABLE = 'service_search'
+
+# rowid = object id * 4 + kind code, so a row is found by rowid and never by a scan of the UNINDEXED columns
+KINDS = {
+    'employee': 1,
+    'office': 2,
+    'vehicle': 3,
+}
+
+MODELS = {
+    MyUser: 'employee',
+    Office: 'office',
+    Vehicle: 'vehicle',
+}
+
+# kind -> (source table, title SQL, body SQL)
+SOURCES = {
+    'employee': ('service_myuser', "first_name || ' ' || last_name", 'email'),
+    'office': ('service_office', 'office_name', "address || ' ' || city || ' ' || region || ' ' || country"),
+    'vehicle': ('service_vehicle', 'licence_plate', "name || ' ' || model"),
+}
+
+TOKEN = re.compile(r'\w+', re.UNICODE)
+
+
+def available(conn=None):
+    """FTS5 index is used on SQLite only, other databases fall back to icontains"""
+    return (conn or connection).vendor == 'sqlite'
+
+
+def tenant_token(company_id):
+    return f'c{company_id or 0}'
+
+
+def index_sql(kind, where):
+    """INSERT OR REPLACE: rows left behind by a flush or a failed transaction are overwritten, not a conflict"""
+    table, title, body = SOURCES[kind]
+    return (
+        f"INSERT OR REPLACE INTO {TABLE} (rowid, tenant, kind, title, body) "
+        f"SELECT id * 4 + {KINDS[kind]}, 'c' || IFNULL(company_id, 0), '{kind}', {title}, {body} "
+        f"FROM {table} WHERE {where}"
+    )
+
+
+def index_object(kind, pk):
+    if not available():
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(index_sql(kind, 'id = %s'), [pk])
+
+
+def index_inserted(kind, after):
+    """Index the rows of a bulk_create: the ids over `after`, the highest id read in the same transaction
+    before the insert. SQLite has one writer and the read and the INSERT see one snapshot (with
+    transaction_mode IMMEDIATE the write lock is held from BEGIN), so no other rows get ids in between"""
+    if not available():
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(index_sql(kind, 'id > %s'), [after])
+
+
+def remove_object(kind, pk):
+    if not available():
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(f'DELETE FROM {TABLE} WHERE rowid = %s', [pk * 4 + KINDS[kind]])
+
+
+def remove_objects(kind, pks, batch_size=500):
+    """remove_object() for many rows deleted without post_delete, a statement per batch_size ids"""
+    if not available():
+        return
+    rowids = [pk * 4 + KINDS[kind] for pk in pks]
+    with connection.cursor() as cursor:
+        for start in range(0, len(rowids), batch_size):
+            batch = rowids[start:start + batch_size]
+            cursor.execute(f'DELETE FROM {TABLE} WHERE rowid IN ({", ".join(["%s"] * len(batch))})', batch)
+
+
+def reindex_company(company_id, conn=None):
+    """Rebuild the index rows of one company with set-based INSERT ... SELECT (after bulk loads)"""
+    conn = conn or connection
+    if not available(conn):
+        return
+    with conn.cursor() as cursor:
+        cursor.execute(
+            f'DELETE FROM {TABLE} WHERE rowid IN (SELECT rowid FROM {TABLE} WHERE {TABLE} MATCH %s)',
+            [f'tenant : {tenant_token(company_id)}'],
+        )
+        for kind in SOURCES:
+            cursor.execute(index_sql(kind, 'company_id = %s'), [company_id])
+
+
+def prune(conn=None):
+    """Remove the index rows whose object is gone without post_delete (flush, raw DELETE), so an id
+    reused after a sequence reset never answers with the text of another tenant"""
+    conn = conn or connection
+    if not available(conn) or TABLE not in conn.introspection.table_names():
+        return
+    with conn.cursor() as cursor:
+        for kind, (table, _, _) in SOURCES.items():
+            cursor.execute(
+                f'DELETE FROM {TABLE} WHERE rowid IN ('
+                f'SELECT rowid FROM {TABLE} WHERE rowid % 4 = {KINDS[kind]} '
+                f'AND rowid / 4 NOT IN (SELECT id FROM {table}))'
+            )
+
+
+def reindex_all(conn=None):
+    conn = conn or connection
+    if not available(conn):
+        return
+    with conn.cursor() as cursor:
+        cursor.execute(f'DELETE FROM {TABLE}')
+        for kind in SOURCES:
+            cursor.execute(index_sql(kind, '1 = 1'))
+
+
+def match_expression(company_id, text):
+    """tenant:cN AND "word1"* AND "word2"* - every word is a prefix, so it works for autocomplete"""
+    words = TOKEN.findall(text)
+    if not words:
+        return None
+    terms = ' AND '.join('"{}"*'.format(word.replace('"', '""')) for word in words)
+    return f'tenant : {tenant_token(company_id)} AND ({terms})'
+
+
+def search(company_id, text, kinds=None, limit=20, offset=0):
+    """Ranked matches of a company as [{'type', 'id', 'title', 'subtitle'}], best first"""
+    kinds = [kind for kind in (kinds or KINDS) if kind in KINDS]
+    if not available():
+        return fallback_search(company_id, text, kinds, limit, offset)
+    expression = match_expression(company_id, text)
+    if expression is None or not kinds:
+        return []
+    placeholders = ', '.join(['%s'] * len(kinds))
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f'SELECT rowid, kind, title, body FROM {TABLE} '
+            f'WHERE {TABLE} MATCH %s AND kind IN ({placeholders}) '
+            f'ORDER BY bm25({TABLE}, 0.0, 0.0, 10.0, 1.0) LIMIT %s OFFSET %s',
+            [expression, *kinds, limit, offset],
+        )
+        rows = cursor.fetchall()
+    return [
+        {'type': kind, 'id': rowid // 4, 'title': title.strip(), 'subtitle': body}
+        for rowid, kind, title, body in rows
+    ]
+
+
+def fallback_search(company_id, text, kinds, limit, offset):
+    """icontains over the same columns, for databases without FTS5; unranked"""
+    words = TOKEN.findall(text)
+    if not words:
+        return []
+    querysets = {
+        'employee': (MyUser.objects.annotate(title=Concat('first_name', Value(' '), 'last_name'), subtitle='email'),
+                     ('first_name', 'last_name', 'email')),
+        'office': (Office.objects.annotate(title='office_name', subtitle='address'),
+                   ('office_name', 'address', 'city', 'region', 'country')),
+        'vehicle': (Vehicle.objects.annotate(title='licence_plate', subtitle=Concat('name', Value(' '), 'model')),
+                    ('licence_plate', 'name', 'model')),
+    }
+    results = []
+    for kind in kinds:
+        queryset, fields = querysets[kind]
+        queryset = queryset.filter(company_id=company_id)
+        for word in words:
+            condition = Q()
+            for field in fields:
+                condition |= Q(**{f'{field}__icontains': word})
+            queryset = queryset.filter(condition)
+        results += [
+            {'type': kind, 'id': pk, 'title': title.strip(), 'subtitle': subtitle}
+            for pk, title, subtitle in queryset.order_by('id').values_list('id', 'title', 'subtitle')[:offset + limit]
+        ]
+    return results[offset:offset + limit]
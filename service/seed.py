@@ -0,0 +1,151 @@
+import random
+import time
+
+from django.contrib.auth.hashers import make_password
+from django.db import connection, transaction
+from django.db.models import Max
+
+from service import changelog, rollups, search
+from service.api.caching import bump_tenant_version
+from service.models import Company, MyUser, Office, Vehicle
+
+FIRST_NAMES = ('Olena', 'Ivan', 'Maria', 'Petro', 'Anna', 'Oleh', 'Iryna', 'Taras', 'Sofia', 'Andrii', 'Yulia', 'Dmytro')
+LAST_NAMES = ('Shevchenko', 'Kovalenko', 'Bondarenko', 'Tkachenko', 'Kravchenko', 'Oliinyk', 'Melnyk', 'Boiko')
+CITIES = (('Kyiv', 'Kyiv'), ('Lviv', 'Lviv'), ('Kharkiv', 'Kharkiv'), ('Odesa', 'Odesa'), ('Dnipro', 'Dnipro'),
+          ('Vinnytsia', 'Vinnytsia'), ('Poltava', 'Poltava'), ('Chernihiv', 'Chernihiv'))
+VEHICLES = (('Toyota', 'Corolla'), ('Renault', 'Master'), ('Ford', 'Transit'), ('Skoda', 'Octavia'),
+            ('Volkswagen', 'Crafter'), ('Mercedes', 'Sprinter'), ('Hyundai', 'Accent'))
+PLATE_LETTERS = 'ABCEHIKMOPTX'
+
+
+class FleetGenerator:
+    """Deterministic synthetic tenants: the same seed always produces the same rows.
+    Primary keys are assigned here, so nothing has to be read back between batches, and rows are
+    written in batch_size chunks, one short transaction each. Vehicles, the big table, skip model
+    instances and go straight to executemany(). No post_save is sent for any of it, the fleet rollups,
+    the search index and the change log are rebuilt and the response cache version is bumped once
+    per company instead."""
+
+    def __init__(self, seed=0, batch_size=5000, password='password', progress=None):
+        self.random = random.Random(seed)
+        self.batch_size = batch_size
+        self.password = make_password(password, salt=f'seed{seed}')
+        self.progress = progress
+        self.rows = 0
+        self.started = time.perf_counter()
+
+    def next_id(self, model):
+        return (model.objects.aggregate(last=Max('id'))['last'] or 0) + 1
+
+    def generate(self, companies=1, offices=5, employees=20, vehicles=100):
+        """Returns the ids of the created companies"""
+        company_id = self.next_id(Company)
+        user_id = self.next_id(MyUser)
+        office_id = self.next_id(Office)
+        vehicle_id = self.next_id(Vehicle)
+        created = []
+        for c in range(companies):
+            company = Company(id=company_id + c, company_name=f'Fleet {company_id + c}'[:20],
+                              address=f'{self.random.choice(CITIES)[0]}, {self.random.randint(1, 200)} Main st.')
+            self.write(Company, [company])
+
+            admin = MyUser(id=user_id, email=f'admin@company{company.id}.example', is_staff=True,
+                           company_id=company.id, password=self.password, first_name='Admin')
+            staff_ids = list(range(user_id + 1, user_id + 1 + employees))
+            user_id += 1 + employees
+            self.write(MyUser, [admin])
+            self.write(MyUser, (self.employee(company.id, pk) for pk in staff_ids))
+
+            office_ids = list(range(office_id, office_id + offices))
+            office_id += offices
+            # office id -> employee working there; only these employees can drive the office vehicles
+            office_employee = {pk: staff_ids[i] if i < len(staff_ids) else None for i, pk in enumerate(office_ids)}
+            self.write(Office, (self.office(company.id, pk, office_employee[pk]) for pk in office_ids))
+
+            self.write_rows(Vehicle, (
+                self.vehicle(company.id, pk, office_ids, office_employee)
+                for pk in range(vehicle_id, vehicle_id + vehicles)
+            ))
+            vehicle_id += vehicles
+            rollups.rebuild(company.id)
+            search.reindex_company(company.id)
+            changelog.record_company(company.id)
+            bump_tenant_version(company.id)
+            created.append(company.id)
+        return created
+
+    def employee(self, company, pk):
+        first, last = self.random.choice(FIRST_NAMES), self.random.choice(LAST_NAMES)
+        return MyUser(id=pk, email=f'{first}.{last}.{pk}@company{company}.example'.lower(), first_name=first,
+                      last_name=last, company_id=company, password=self.password)
+
+    def office(self, company, pk, employee):
+        city, region = self.random.choice(CITIES)
+        return Office(id=pk, office_name=f'{city} {pk}'[:20], address=f'{self.random.randint(1, 300)} Street {pk}',
+                      country='Ukraine', city=city, region=region, company_id=company, employee_id=employee)
+
+    def vehicle(self, company, pk, office_ids, office_employee):
+        """Row of service_vehicle, in the order of Vehicle._meta.concrete_fields"""
+        choice, letters = self.random.choice, PLATE_LETTERS
+        make, model = choice(VEHICLES)
+        office = choice(office_ids) if office_ids and self.random.random() < 0.9 else None
+        driver = office_employee[office] if office is not None and self.random.random() < 0.7 else None
+        plate = f'{choice(letters)}{choice(letters)}{self.random.randint(0, 9999):04d}{choice(letters)}{choice(letters)}'
+        year = self.random.randint(1984, Vehicle.today)
+        return pk, plate, make, model, year, company, office, driver
+
+    def write(self, model, objects):
+        batch = []
+        for obj in objects:
+            batch.append(obj)
+            if len(batch) >= self.batch_size:
+                self.flush(model, batch)
+                batch = []
+        if batch:
+            self.flush(model, batch)
+
+    def write_rows(self, model, rows):
+        """Like write() for plain tuples of column values, without building model instances"""
+        fields = model._meta.concrete_fields
+        sql = 'INSERT INTO {} ({}) VALUES ({})'.format(
+            connection.ops.quote_name(model._meta.db_table),
+            ', '.join(connection.ops.quote_name(field.column) for field in fields),
+            ', '.join(['%s'] * len(fields)),
+        )
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= self.batch_size:
+                self.flush_rows(model, sql, batch)
+                batch = []
+        if batch:
+            self.flush_rows(model, sql, batch)
+
+    def flush_rows(self, model, sql, batch):
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.executemany(sql, batch)
+        self.count(model, len(batch))
+
+    def flush(self, model, batch):
+        with transaction.atomic():
+            model.objects.bulk_create(batch, batch_size=self.batch_size)
+        self.count(model, len(batch))
+
+    def count(self, model, rows):
+        self.rows += rows
+        if self.progress is not None:
+            self.progress(model, self.rows, time.perf_counter() - self.started)
+
+
+def seed_tenants(companies=1, offices=5, employees=20, vehicles=100, password='password', seed=0):
+    """Small deterministic data set for benchmarks and tests.
+    Returns [(company, admin, [employees], [offices])]."""
+    generator = FleetGenerator(seed=seed, password=password)
+    created = []
+    for company_id in generator.generate(companies, offices, employees, vehicles):
+        company = Company.objects.get(id=company_id)
+        admin = MyUser.objects.get(company=company, is_staff=True)
+        staff = list(MyUser.objects.filter(company=company, is_staff=False).order_by('id'))
+        company_offices = list(Office.objects.filter(company=company).select_related('employee').order_by('id'))
+        created.append((company, admin, staff, company_offices))
+    return created
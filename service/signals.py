@@ -0,0 +1,112 @@
+from django.db import connections
+from django.db.models.signals import post_init, pre_save, post_save, pre_delete, post_delete, post_migrate
+from django.dispatch import receiver
+from rest_framework.authtoken.models import Token
+
+from service.api.authentication import token_cache
+from service.api.caching import bump_tenant_version
+from service import changelog, rollups, search
+from service.models import MyUser, Company, Office, Vehicle, FleetRollup
+
+
+@receiver([post_save, post_delete], sender=Token)
+def invalidate_token(sender, instance, **kwargs):
+    token_cache.delete_many([instance.key])
+
+
+@receiver([post_save, post_delete], sender=MyUser)
+def invalidate_user_tokens(sender, instance, **kwargs):
+    token_cache.delete_many(Token.objects.filter(user_id=instance.pk).values_list('key', flat=True))
+
+
+@receiver([post_save, post_delete], sender=Company)
+def invalidate_company_tokens(sender, instance, **kwargs):
+    token_cache.delete_many(Token.objects.filter(user__company_id=instance.pk).values_list('key', flat=True))
+
+
+@receiver([post_save, post_delete], sender=Company)
+def company_changed(sender, instance, **kwargs):
+    bump_tenant_version(instance.pk)
+
+
+@receiver([post_save, post_delete], sender=Office)
+@receiver([post_save, post_delete], sender=Vehicle)
+@receiver([post_save, post_delete], sender=MyUser)
+def tenant_data_changed(sender, instance, **kwargs):
+    bump_tenant_version(instance.company_id)
+
+
+@receiver(post_init, sender=Vehicle)
+def remember_vehicle_state(sender, instance, **kwargs):
+    instance._rollup_state = rollups.state_of(instance) if instance.pk is not None else None
+
+
+@receiver(pre_save, sender=Vehicle)
+def complete_vehicle_state(sender, instance, raw=False, **kwargs):
+    # a field deferred at load time that is saved now: its old value is only in the row
+    old_state = instance._rollup_state
+    if not raw and old_state is not None and rollups.merge(old_state, rollups.state_of(instance)) != old_state:
+        instance._rollup_state = rollups.complete(old_state, instance)
+
+
+@receiver(post_save, sender=Vehicle)
+def update_fleet_rollups(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    new_state = rollups.merge(instance._rollup_state, rollups.state_of(instance))
+    rollups.vehicle_changed(instance._rollup_state, new_state)
+    instance._rollup_state = new_state
+
+
+@receiver(pre_delete, sender=Vehicle)
+def complete_deleted_vehicle_state(sender, instance, **kwargs):
+    instance._rollup_state = rollups.complete(instance._rollup_state, instance)
+
+
+@receiver(post_delete, sender=Vehicle)
+def remove_from_fleet_rollups(sender, instance, **kwargs):
+    rollups.vehicle_changed(instance._rollup_state, None)
+    instance._rollup_state = None
+
+
+@receiver(post_delete, sender=Office)
+def drop_office_rollup(sender, instance, **kwargs):
+    FleetRollup.objects.filter(company_id=instance.company_id, dimension=FleetRollup.OFFICE, key=instance.pk).delete()
+
+
+@receiver(post_save, sender=Office)
+@receiver(post_save, sender=Vehicle)
+@receiver(post_save, sender=MyUser)
+def update_search_index(sender, instance, **kwargs):
+    search.index_object(search.MODELS[sender], instance.pk)
+
+
+@receiver(post_delete, sender=Office)
+@receiver(post_delete, sender=Vehicle)
+@receiver(post_delete, sender=MyUser)
+def remove_from_search_index(sender, instance, **kwargs):
+    search.remove_object(search.MODELS[sender], instance.pk)
+
+
+@receiver(post_migrate)
+def prune_search_index(sender, using, **kwargs):
+    """flush (and TransactionTestCase) empties the tables without post_delete, then sends post_migrate"""
+    if sender.name == 'service':
+        search.prune(connections[using])
+
+
+@receiver(post_save, sender=Office)
+@receiver(post_save, sender=Vehicle)
+@receiver(post_save, sender=MyUser)
+def log_change(sender, instance, update_fields=None, **kwargs):
+    # a login only stamps last_login, which no client syncs
+    if update_fields is not None and set(update_fields) <= {'last_login'}:
+        return
+    changelog.record(changelog.MODELS[sender], instance.company_id, instance.pk)
+
+
+@receiver(post_delete, sender=Office)
+@receiver(post_delete, sender=Vehicle)
+@receiver(post_delete, sender=MyUser)
+def log_deletion(sender, instance, **kwargs):
+    changelog.record(changelog.MODELS[sender], instance.company_id, instance.pk, deleted=True)
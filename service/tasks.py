@@ -0,0 +1,93 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.utils import timezone
+from rest_framework import serializers
+
+from service import deletions, jobs
+from service.api.exports import vehicle_export
+from service.api.imports import VehicleImporter, payload_rows, write_upload
+from service.api.reassignment import VehicleReassignment
+from service.models import Company, Deletion, Job, Upload, Vehicle
+
+
+def company_of(job):
+    company = Company.objects.filter(pk=job.company_id).first()
+    if company is None:
+        raise jobs.JobFailed(f'Company {job.company_id} does not exist')
+    return company
+
+
+def drop_import_upload(job):
+    # the body of an import whose worker died is of no use once the job failed
+    if job.status == Job.FAILED:
+        Upload.objects.filter(pk=job.payload.get('upload')).delete()
+
+
+@jobs.register('vehicle_import', cleanup=drop_import_upload)
+def import_vehicles(job):
+    """Not retried: the chunks imported before a failure stay. The uploaded body goes either way."""
+    try:
+        report = VehicleImporter(company_of(job)).run(payload_rows(job.payload))
+    finally:
+        Upload.objects.filter(pk=job.payload.get('upload')).delete()
+    if report['created'] or not report['error_count']:
+        return report
+    raise jobs.JobFailed(report)
+
+
+def drop_export_upload(job):
+    # the part of the file an attempt wrote before its worker died; a new attempt starts over
+    Upload.objects.filter(pk=(job.result or {}).get('upload')).delete()
+
+
+def expire_exports(company_id):
+    """Drop the files of the company's exports that finished over JOB_EXPORT_KEEP_SECONDS ago"""
+    finished = timezone.now() - timedelta(seconds=getattr(settings, 'JOB_EXPORT_KEEP_SECONDS', 24 * 3600))
+    expired = Job.objects.filter(kind='vehicle_export', company_id=company_id, status=Job.SUCCEEDED,
+                                 finished_at__lt=finished, result__has_key='upload')
+    for job in expired:
+        Upload.objects.filter(pk=job.result.pop('upload')).delete()
+        job.result['expired'] = True
+        job.save(update_fields=['result'])
+
+
+@jobs.register('vehicle_export', priority=-5, max_attempts=3, cleanup=drop_export_upload)
+def export_vehicles(job):
+    """Write the vehicles to a file downloaded from /api/jobs/<id>/download/. Read only, so it is retried;
+    the upload is in the result from the start, for drop_export_upload."""
+    company = company_of(job)
+    expire_exports(company.pk)
+    queryset = Vehicle.objects.filter(company=company, **job.payload.get('filters', {}))
+    content_type, pieces = vehicle_export(queryset, job.payload.get('format'))
+    upload = Upload.objects.create(company=company, content_type=content_type)
+    Job.objects.filter(pk=job.pk).update(result={'upload': upload.pk})
+    try:
+        write_upload(upload, pieces)
+    except BaseException:
+        upload.delete()
+        raise
+    return {'upload': upload.pk, 'content_type': content_type, 'size': upload.size}
+
+
+@jobs.register('vehicle_reassign', priority=10, max_attempts=3)
+def reassign_vehicles(job):
+    """One transaction, safe to run again"""
+    try:
+        return VehicleReassignment(company_of(job)).run(job.payload)
+    except serializers.ValidationError as exc:
+        raise jobs.JobFailed(exc.detail)
+
+
+@jobs.register('deletion', priority=-10, max_attempts=5)
+def run_deletion(job):
+    """Run a Deletion to the end. A deletion that failed is resumed by the next attempt; one that another
+    runner is still working on fails the attempt, so it is looked at again after the backoff."""
+    pk = job.payload['deletion']
+    Deletion.objects.filter(pk=pk, status=Deletion.FAILED).update(status=Deletion.PENDING)
+    deletion = deletions.run(pk) or Deletion.objects.filter(pk=pk).first()
+    if deletion is None:
+        raise jobs.JobFailed(f'Deletion {pk} does not exist')
+    if deletion.status != Deletion.DONE:
+        raise RuntimeError(f'Deletion {pk} is run by another process')
+    return {'deletion': pk, 'deleted': deletion.deleted}
@@ -1,3 +1,1432 @@
-from django.test import TestCase
+import asyncio
+import io
+import json
+import os
+import tempfile
+import time
+from datetime import timedelta
+from decimal import Decimal
+from unittest import mock, skipIf
 
-# Create your tests here.
+from asgiref.sync import sync_to_async
+from django.contrib.auth.hashers import check_password
+from django.core.cache import caches
+from django.db import connection, connections, transaction
+from django.db.models import F, Max
+from django.test import Client, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from rest_framework.authtoken.models import Token
+from rest_framework.exceptions import AuthenticationFailed, ParseError
+from django.utils import timezone
+from django.utils.http import http_date
+from rest_framework.test import APIClient
+
+from service import changelog, deletions, jobs, rollups, search, tasks
+from service.api.authentication import token_cache
+from service.api.events import event_stream, issue_ticket, redeem_ticket
+from service.api.imports import EmployeeImporter, VehicleImporter, iter_list
+from service.api.renderers import MessagePackParser, MessagePackRenderer, ORJSONParser, ORJSONRenderer, msgpack
+from service.api.resourse import EmployeeViewSet, OfficeViewSet, VehicleViewSet
+from service.backends.sqlite3.base import DatabaseWrapper as SqliteDatabaseWrapper
+from service.events import RESYNC, Broker, ChangeLogBroker, get_broker
+from service.hashers import HashingBusy, ProcessPoolHashingService, make_passwords
+from service.models import (ArchivedRow, Change, Company, Deletion, FleetRollup, Job, MyUser, Office,
+                            ReplicaHeartbeat, TenantVersion, Upload, UploadChunk, Vehicle)
+from service.routers import ReplicaRouter, replica_status, use_replicas
+
+
+class FastListEquivalenceTest(TestCase):
+    """The values() list path must answer byte for byte what ModelSerializer answers"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.company = Company.objects.create(company_name='Fleet', address='Kyiv')
+        other = Company.objects.create(company_name='Other')
+        cls.admin = MyUser.objects.create(email='admin@fleet.example', is_staff=True, company=cls.company)
+        cls.employees = [
+            MyUser.objects.create(email=f'driver{i}@fleet.example', first_name=f'Driver{i}', last_name='Melnyk',
+                                  company=cls.company)
+            for i in range(4)
+        ]
+        cls.offices = [
+            Office.objects.create(office_name=f'Office {i}', address=f'{i} Main st.', country='Ukraine',
+                                  city='Lviv' if i % 2 else 'Kyiv', region='Центр', company=cls.company,
+                                  employee=cls.employees[i])
+            for i in range(3)
+        ]
+        for i in range(12):
+            office = cls.offices[i % 3] if i % 4 else None
+            Vehicle.objects.create(licence_plate=f'AA{i:04d}BC', name='Ford', model='Transit',
+                                   year_of_manufacture=1990 + i, company=cls.company, office=office,
+                                   driver=office.employee if office is not None and i % 2 else None)
+        Vehicle.objects.create(licence_plate='ZZ0000ZZ', name='Ford', model='Transit', company=other)
+        cls.token = Token.objects.create(user=cls.admin).key
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {self.token}')
+
+    def get(self, url):
+        for cache in caches.all():
+            cache.clear()
+        token_cache.clear()
+        return self.client.get(url)
+
+    def assertSameResponse(self, viewset, url):
+        fast = self.get(url)
+        with mock.patch.object(viewset, 'fast_list', False):
+            slow = self.get(url)
+        self.assertEqual(fast.status_code, 200)
+        self.assertEqual(fast.status_code, slow.status_code)
+        self.assertEqual(fast.content, slow.content)
+        return fast
+
+    def test_vehicle_list(self):
+        self.assertSameResponse(VehicleViewSet, '/api/vehicle/')
+        self.assertSameResponse(VehicleViewSet, f'/api/vehicle/?office={self.offices[1].id}')
+        self.assertSameResponse(VehicleViewSet, '/api/vehicle/?fields=id,licence_plate,driver')
+        self.assertSameResponse(VehicleViewSet, '/api/vehicle/?expand=office,driver')
+
+    def test_filters_run_once(self):
+        for url, fast_list in (('/api/vehicle/?office=1', True), ('/api/vehicle/?expand=office', True),
+                               ('/api/vehicle/?office=1', False)):
+            with mock.patch.object(VehicleViewSet, 'fast_list', fast_list), \
+                    mock.patch.object(VehicleViewSet, 'filter_queryset', autospec=True,
+                                      side_effect=VehicleViewSet.filter_queryset) as filter_queryset:
+                self.assertEqual(self.get(url).status_code, 200)
+            self.assertEqual(filter_queryset.call_count, 1, url)
+
+    def test_pagination_scope(self):
+        # vehicles, the vehicle profile, employees and offices are paginated,
+        # the other lists keep their plain list shape
+        for url in ('/api/vehicle/', '/api/vehicle_profile/', '/api/employee/', '/api/office/'):
+            self.assertEqual(list(self.get(url).data), ['next', 'results'], url)
+        for url in ('/api/company/', '/api/profile/'):
+            self.assertIsInstance(self.get(url).data, list, url)
+
+    def test_vehicle_list_pages(self):
+        url = '/api/vehicle/?page_size=5'
+        while url:
+            url = self.assertSameResponse(VehicleViewSet, url).data['next']
+
+    def test_expand_queries_do_not_grow_with_the_rows(self):
+        def add_vehicles(count):
+            for i in range(count):
+                driver = MyUser.objects.create(email=f'extra{Vehicle.objects.count()}@fleet.example',
+                                               company=self.company)
+                office = Office.objects.create(office_name='Extra', address='9 Main st.', country='Ukraine',
+                                               city='Kyiv', region='Центр', company=self.company, employee=driver)
+                Vehicle.objects.create(licence_plate='EX0000EX', name='Ford', model='Transit',
+                                       company=self.company, office=office, driver=driver)
+
+        url = '/api/vehicle/?expand=office,driver'
+        add_vehicles(6)
+        # the first request of the tenant stores its version
+        self.get(url)
+        counts = {}
+        for fast_list in (True, False):
+            with mock.patch.object(VehicleViewSet, 'fast_list', fast_list), \
+                    CaptureQueriesContext(connection) as queries:
+                self.assertEqual(len(self.get(url).data['results']), 18)
+            counts[fast_list] = len(queries)
+        add_vehicles(18)
+        for fast_list, count in counts.items():
+            with mock.patch.object(VehicleViewSet, 'fast_list', fast_list), self.assertNumQueries(count):
+                self.assertEqual(len(self.get(url).data['results']), 36)
+
+    def test_office_list(self):
+        self.assertSameResponse(OfficeViewSet, '/api/office/')
+        self.assertSameResponse(OfficeViewSet, '/api/office/?city=Lviv&fields=office_name,region')
+
+    def test_employee_list(self):
+        self.assertSameResponse(EmployeeViewSet, '/api/employee/')
+        self.assertSameResponse(EmployeeViewSet, '/api/employee/?last_name=Melnyk&page_size=2')
+
+
+class SyncTest(TestCase):
+    """/api/sync/ deltas, and walks from scratch once compact_changes has dropped tombstones"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.company = Company.objects.create(company_name='Fleet')
+        cls.other = Company.objects.create(company_name='Other')
+        cls.admin = MyUser.objects.create(email='admin@fleet.example', is_staff=True, company=cls.company)
+        cls.token = Token.objects.create(user=cls.admin).key
+
+    def setUp(self):
+        for cache in caches.all():
+            cache.clear()
+        token_cache.clear()
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {self.token}')
+        self.vehicles = [
+            Vehicle.objects.create(licence_plate=f'AA{i:04d}BC', name='Ford', model='Transit', company=self.company)
+            for i in range(6)
+        ]
+
+    def sync(self, since, page_size=100):
+        response = self.client.get('/api/sync/', {'since': since, 'page_size': page_size})
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def walk(self, since, page_size):
+        """Follow the cursors while "more": (vehicle ids, deleted vehicle ids, resets, final cursor)"""
+        vehicles, deleted, resets = [], [], 0
+        for _ in range(20):
+            page = self.sync(since, page_size)
+            if page['reset']:
+                resets += 1
+                vehicles, deleted = [], []
+            vehicles += [row['id'] for row in page['vehicles']]
+            deleted += page['deleted']['vehicles']
+            since = page['cursor']
+            if not page['more']:
+                return vehicles, deleted, resets, since
+        self.fail('the sync never finished')
+
+    def test_delta(self):
+        _, _, _, cursor = self.walk(0, 100)
+        moved, gone = self.vehicles[0], self.vehicles[1].pk
+        moved.name = 'Renault'
+        moved.save()
+        self.vehicles[1].delete()
+        Vehicle.objects.create(licence_plate='ZZ0000ZZ', name='Ford', model='Transit', company=self.other)
+
+        page = self.sync(cursor)
+        self.assertEqual([row['name'] for row in page['vehicles']], ['Renault'])
+        self.assertEqual(page['deleted']['vehicles'], [gone])
+        self.assertEqual(self.sync(page['cursor'])['vehicles'], [])
+
+    def test_paged_resync_after_compaction(self):
+        _, _, _, stale = self.walk(0, 100)
+        self.vehicles[2].delete()
+        changelog.compact(timezone.now() + timedelta(days=1))
+        live = sorted(vehicle.pk for vehicle in self.vehicles if vehicle is not self.vehicles[2])
+
+        vehicles, deleted, resets, cursor = self.walk(stale, 2)
+        self.assertEqual(resets, 1)
+        self.assertEqual(sorted(vehicles), live)
+        self.assertEqual(deleted, [])
+
+        # a fresh client walks through the horizon without a reset too
+        vehicles, _, resets, _ = self.walk(0, 2)
+        self.assertEqual((resets, sorted(vehicles)), (0, live))
+
+        # and the cursor the walk ended with is a plain one again
+        gone = self.vehicles[0].pk
+        self.vehicles[0].delete()
+        self.assertEqual(self.sync(cursor)['deleted']['vehicles'], [gone])
+
+
+class SearchIndexTest(TestCase):
+    """Bulk imports index the rows they insert; prune() drops the rows of objects deleted without signals"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.company = Company.objects.create(company_name='Fleet')
+        cls.other = Company.objects.create(company_name='Other')
+        cls.admin = MyUser.objects.create(email='admin@fleet.example', is_staff=True, company=cls.company)
+        cls.token = Token.objects.create(user=cls.admin).key
+
+    def setUp(self):
+        for cache in caches.all():
+            cache.clear()
+        token_cache.clear()
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {self.token}')
+
+    def found(self, company, text):
+        return [(row['type'], row['id']) for row in search.search(company.pk, text, ['vehicle'])]
+
+    def test_import_indexes_the_inserted_rows(self):
+        kept = Vehicle.objects.create(licence_plate='KK0000KK', name='Volvo', model='Truck', company=self.other)
+        body = ''.join(
+            f'{{"licence_plate": "AA{i:04d}BC", "name": "Ford", "model": "Transit"}}\n' for i in range(3)
+        )
+        response = self.client.post('/api/vehicle/import/', body, content_type='application/x-ndjson')
+        self.assertEqual(response.status_code, 201)
+        imported = sorted(Vehicle.objects.filter(company=self.company).values_list('pk', flat=True))
+        self.assertEqual(len(imported), 3)
+        self.assertEqual(sorted(pk for _, pk in self.found(self.company, 'Transit')), imported)
+        self.assertEqual(self.found(self.other, 'Volvo'), [('vehicle', kept.pk)])
+
+    def test_prune_after_raw_delete(self):
+        vehicle = Vehicle.objects.create(licence_plate='KK0000KK', name='Volvo', model='Truck', company=self.other)
+        alive = Vehicle.objects.create(licence_plate='KK0001KK', name='Volvo', model='Truck', company=self.other)
+        Vehicle.objects.filter(pk=vehicle.pk)._raw_delete('default')
+        search.prune()
+        self.assertEqual(self.found(self.other, 'Volvo'), [('vehicle', alive.pk)])
+
+
+@override_settings(PASSWORD_HASHING_WORKERS=1, PASSWORD_HASHING_MAX_PENDING=1)
+class HashingServiceTest(TestCase):
+    """Every hash goes through the process pool and its backpressure; timeouts surface as HashingBusy (429)"""
+
+    def service(self):
+        service = ProcessPoolHashingService()
+        self.addCleanup(service._executor.shutdown)
+        return service
+
+    def test_single_password(self):
+        service = self.service()
+        [hashed] = service.make_passwords(['secret'])
+        self.assertTrue(check_password('secret', hashed))
+        self.assertEqual(service.stats()['submitted'], 1)
+
+        # with the only slot taken a login is turned away, not hashed on the request thread
+        service._slots.acquire()
+        self.addCleanup(service._slots.release)
+        with self.assertRaises(HashingBusy):
+            service.make_password('secret')
+        self.assertEqual(service.stats()['rejected'], 1)
+
+    @override_settings(PASSWORD_HASHING_TIMEOUT=0.2)
+    def test_timeout(self):
+        service = self.service()
+        with self.assertRaises(HashingBusy):
+            service.run(time.sleep, 1)
+        # the slot stays taken until the worker is done: bulk calls give up after the timeout as well
+        with self.assertRaises(HashingBusy):
+            service.make_passwords(['first', 'second'])
+        self.assertEqual((service.stats()['timed_out'], service.stats()['rejected']), (1, 1))
+
+
+class ProvisionTest(TestCase):
+    """Whole tenants are created by superusers only"""
+    document = {
+        'company': {'company_name': 'New fleet'},
+        'admin': {'email': 'boss@new.example', 'password': 'secret-1', 'confirm_password': 'secret-1'},
+        'offices': [{'office_name': 'Depot', 'address': '1 Main st.', 'country': 'Ukraine', 'city': 'Kyiv',
+                     'region': 'Центр'}],
+        'vehicles': [{'licence_plate': 'AA0000BC', 'name': 'Ford', 'model': 'Transit', 'office': 'Depot'}],
+    }
+
+    @classmethod
+    def setUpTestData(cls):
+        company = Company.objects.create(company_name='Fleet')
+        cls.admin = MyUser.objects.create(email='admin@fleet.example', is_staff=True, company=company)
+        cls.root = MyUser.objects.create(email='root@example.com', is_staff=True, is_superuser=True)
+
+    def setUp(self):
+        for cache in caches.all():
+            cache.clear()
+        token_cache.clear()
+
+    def provision(self, user=None):
+        client = APIClient()
+        if user is not None:
+            client.credentials(HTTP_AUTHORIZATION=f'Token {Token.objects.get_or_create(user=user)[0].key}')
+        return client.post('/api/provision/', self.document, format='json')
+
+    def test_anonymous_and_company_admin_are_refused(self):
+        self.assertEqual(self.provision().status_code, 401)
+        self.assertEqual(self.provision(self.admin).status_code, 403)
+        self.assertFalse(Company.objects.filter(company_name='New fleet').exists())
+
+    def test_superuser_provisions(self):
+        response = self.provision(self.root)
+        self.assertEqual(response.status_code, 201)
+        company = Company.objects.get(company_name='New fleet')
+        self.assertTrue(MyUser.objects.get(email='boss@new.example', company=company).is_staff)
+        self.assertEqual(Vehicle.objects.get(company=company).office.office_name, 'Depot')
+
+
+@override_settings(JOBS_EAGER=True)
+class AsyncImportTest(TestCase):
+    """?async=1 imports copy the body to the uploads table instead of reading request.body"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.company = Company.objects.create(company_name='Fleet')
+        cls.admin = MyUser.objects.create(email='admin@fleet.example', is_staff=True, company=cls.company)
+        cls.token = Token.objects.create(user=cls.admin).key
+
+    def setUp(self):
+        for cache in caches.all():
+            cache.clear()
+        token_cache.clear()
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {self.token}')
+
+    def post(self, body):
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.client.post('/api/vehicle/import/?async=1', body, content_type='application/x-ndjson')
+
+    def test_body_over_the_upload_memory_limit(self):
+        # 2000 rows padded to 1.6 KB: 3.2 MB, over the 2.5 MB of DATA_UPLOAD_MAX_MEMORY_SIZE
+        body = ''.join(
+            f'{{"licence_plate": "AA{i:04d}BC", "name": "Ford", "model": "Transit"}}'.ljust(1600) + '\n'
+            for i in range(2000)
+        )
+        response = self.post(body)
+        self.assertEqual(response.status_code, 202)
+        job = Job.objects.get(pk=response.data['id'])
+        self.assertEqual((job.status, job.result['created']), (Job.SUCCEEDED, 2000))
+        self.assertEqual(Vehicle.objects.filter(company=self.company).count(), 2000)
+        self.assertFalse(Upload.objects.exists())
+
+    @override_settings(JOB_UPLOAD_MAX_BYTES=100)
+    def test_body_over_the_job_upload_limit(self):
+        body = '{"licence_plate": "AA0000BC", "name": "Ford", "model": "Transit"}\n' * 5
+        self.assertEqual(self.post(body).status_code, 413)
+        self.assertFalse(Job.objects.exists())
+        self.assertFalse(Upload.objects.exists())
+
+
+class ImportTest(TestCase):
+    """Bulk imports report bad rows instead of failing, reject other companies' ids and insert a chunk
+    all or nothing"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.company = Company.objects.create(company_name='Fleet')
+        cls.other = Company.objects.create(company_name='Other')
+        cls.admin = MyUser.objects.create(email='admin@fleet.example', is_staff=True, company=cls.company)
+        cls.driver = MyUser.objects.create(email='driver@fleet.example', company=cls.company)
+        cls.office = Office.objects.create(office_name='Depot', address='1 Main st.', country='Ukraine',
+                                           city='Kyiv', region='Центр', company=cls.company, employee=cls.admin)
+        cls.stranger = MyUser.objects.create(email='stranger@other.example', company=cls.other)
+        cls.foreign_office = Office.objects.create(office_name='Yard', address='2 Main st.', country='Ukraine',
+                                                   city='Lviv', region='Захід', company=cls.other,
+                                                   employee=cls.stranger)
+        cls.token = Token.objects.create(user=cls.admin).key
+
+    def setUp(self):
+        for cache in caches.all():
+            cache.clear()
+        token_cache.clear()
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {self.token}')
+
+    def import_vehicles(self, *rows):
+        body = ''.join(f'{row}\n' for row in rows)
+        return self.client.post('/api/vehicle/import/', body, content_type='application/x-ndjson')
+
+    def vehicle(self, **fields):
+        return json.dumps({'licence_plate': 'AA0000BC', 'name': 'Ford', 'model': 'Transit', **fields})
+
+    def rows(self, report):
+        return {error['row']: error['errors'] for error in report['errors']}
+
+    def test_vehicle_validation_errors(self):
+        response = self.import_vehicles(self.vehicle(), '{"licence_plate": "AA0001BC"}', 'not json', '[1]',
+                                        self.vehicle(year_of_manufacture=1900))
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual((response.data['created'], response.data['error_count']), (1, 4))
+        errors = self.rows(response.data)
+        self.assertEqual(sorted(errors), [2, 3, 4, 5])
+        self.assertEqual(sorted(errors[2]), ['model', 'name'])
+        self.assertIn('year_of_manufacture', errors[5])
+
+        response = self.import_vehicles('{"licence_plate": "AA0001BC"}')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(Vehicle.objects.count(), 1)
+
+    def test_vehicle_ids_of_another_company(self):
+        response = self.import_vehicles(self.vehicle(office=self.foreign_office.pk),
+                                        self.vehicle(driver=self.stranger.pk),
+                                        self.vehicle(office=self.office.pk, driver=self.driver.pk),
+                                        self.vehicle(office=self.office.pk, driver=self.admin.pk))
+        self.assertEqual(response.status_code, 201)
+        errors = self.rows(response.data)
+        self.assertEqual(errors[1], {'office': [f'Invalid pk "{self.foreign_office.pk}" - object does not exist.']})
+        self.assertEqual(errors[2], {'driver': [f'Invalid pk "{self.stranger.pk}" - object does not exist.']})
+        self.assertEqual(errors[3], {'non_field_errors': ['The Employee work in another office']})
+        self.assertEqual(list(Vehicle.objects.values_list('office', 'driver')), [(self.office.pk, self.admin.pk)])
+
+    def test_csv_that_is_not_utf8(self):
+        body = 'licence_plate,name,model\nAA0000BC,Ford,Transit\n'.encode() + b'AA0001BC,F\xf6rd,Transit\n'
+        response = self.client.post('/api/vehicle/import/', body, content_type='text/csv')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual((response.data['created'], response.data['error_count']), (1, 1))
+        self.assertEqual(response.data['errors'][0]['row'], 2)
+        self.assertTrue(response.data['errors'][0]['errors'][0].startswith('Invalid UTF-8'))
+
+        # a header in Latin-1
+        body = b'licence_plate,name,mod\xe8le\nAA0000BC,Ford,Transit\n'
+        response = self.client.post('/api/vehicle/import/', body, content_type='text/csv')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data['errors'][0]['row'], 1)
+        self.assertEqual(Vehicle.objects.count(), 1)
+
+    def test_vehicle_chunk_is_all_or_nothing(self):
+        rows = iter_list([{'licence_plate': f'AA{i:04d}BC', 'name': 'Ford', 'model': 'Transit',
+                           'office': self.office.pk} for i in range(3)])
+        with mock.patch('service.api.imports.changelog.record_inserted', side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                VehicleImporter(self.company).run(rows)
+        self.assertFalse(Vehicle.objects.exists())
+        self.assertEqual({key: count for key, count in rollups.stored(self.company.pk).items() if count}, {})
+        self.assertEqual(search.search(self.company.pk, 'Transit', ['vehicle']), [])
+
+    def test_employee_validation_errors(self):
+        employee = {'first_name': 'Olena', 'last_name': 'Koval', 'password': 'secret', 'confirm_password': 'secret'}
+        rows = [
+            {**employee, 'email': 'olena@fleet.example'},
+            {**employee, 'email': 'olena@fleet.example'},
+            {**employee, 'email': self.stranger.email},
+            {**employee, 'email': 'taras@fleet.example', 'confirm_password': 'other'},
+            {**employee, 'email': 'not an email'},
+        ]
+        response = self.client.post('/api/employee/bulk/', rows, format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data['created'], 1)
+        self.assertEqual(sorted(self.rows(response.data)), [2, 3, 4, 5])
+        self.assertEqual(MyUser.objects.get(email='olena@fleet.example').company, self.company)
+
+    def test_employee_registered_during_the_import(self):
+        def register_first(passwords):
+            # another request takes one of the emails between the lookup and the insert
+            MyUser.objects.create(email='late@fleet.example', company=self.other)
+            return make_passwords(passwords)
+
+        rows = [{'email': email, 'password': 'secret', 'confirm_password': 'secret'}
+                for email in ('early@fleet.example', 'late@fleet.example')]
+        with mock.patch('service.api.imports.make_passwords', side_effect=register_first):
+            response = self.client.post('/api/employee/bulk/', rows, format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data['created'], 1)
+        self.assertEqual(self.rows(response.data),
+                         {2: {'non_field_errors': ['This late@fleet.example has already registration']}})
+        self.assertEqual(MyUser.objects.get(email='late@fleet.example').company, self.other)
+        self.assertEqual(MyUser.objects.get(email='early@fleet.example').company, self.company)
+
+    def test_employee_chunk_is_all_or_nothing(self):
+        rows = iter_list([{'email': f'user{i}@fleet.example', 'password': 'secret', 'confirm_password': 'secret'}
+                          for i in range(3)])
+        with mock.patch('service.api.imports.changelog.record_inserted', side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                EmployeeImporter(self.company).run(rows)
+        self.assertFalse(MyUser.objects.filter(email__startswith='user').exists())
+
+
+class JobQueueTest(TransactionTestCase):
+    """Claiming, retries with backoff, stale jobs and the per-company limit of service.jobs.
+    TransactionTestCase: Worker threads have their own connection and only see committed rows."""
+
+    def setUp(self):
+        self.company = Company.objects.create(company_name='Fleet')
+        self.other = Company.objects.create(company_name='Other')
+        self.calls = []
+        handlers = mock.patch.dict(jobs.handlers)
+        handlers.start()
+        self.addCleanup(handlers.stop)
+
+        @jobs.register('test_flaky', max_attempts=3)
+        def flaky(job):
+            self.calls.append(job.pk)
+            if job.attempts <= job.payload.get('failures', 0):
+                raise RuntimeError('boom')
+            return {'attempt': job.attempts}
+
+        @jobs.register('test_invalid', max_attempts=3)
+        def invalid(job):
+            raise jobs.JobFailed({'field': ['wrong']})
+
+    def test_retry_with_backoff(self):
+        job = jobs.enqueue('test_flaky', {'failures': 2}, company_id=self.company.pk)
+        with override_settings(JOB_RETRY_BACKOFF=5), self.assertLogs('service.jobs', 'ERROR'):
+            for attempt, backoff in ((1, 5), (2, 10)):
+                jobs.run_claimed(jobs.claim_next('worker'))
+                job.refresh_from_db()
+                self.assertEqual((job.status, job.attempts), (Job.QUEUED, attempt))
+                self.assertIn('boom', job.error)
+                delay = (job.run_after - timezone.now()).total_seconds()
+                self.assertTrue(backoff - 1 < delay <= backoff, delay)
+                # not due before the backoff is over
+                self.assertIsNone(jobs.claim_next('worker'))
+                Job.objects.filter(pk=job.pk).update(run_after=timezone.now())
+            jobs.run_claimed(jobs.claim_next('worker'))
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts, job.result, job.error), (Job.SUCCEEDED, 3, {'attempt': 3}, ''))
+
+    @override_settings(JOB_RETRY_BACKOFF=0)
+    def test_worker_runs_the_queue_in_priority_order(self):
+        low = jobs.enqueue('test_flaky', company_id=self.company.pk, priority=-1)
+        high = jobs.enqueue('test_flaky', company_id=self.other.pk, priority=5)
+        failing = jobs.enqueue('test_flaky', {'failures': 10}, company_id=self.company.pk, priority=1)
+        invalid = jobs.enqueue('test_invalid', company_id=self.company.pk)
+        with self.assertLogs('service.jobs', 'ERROR') as logs:
+            jobs.Worker(threads=1).serve(once=True)
+
+        self.assertEqual(len(logs.records), 3)
+        self.assertEqual(self.calls[:2], [high.pk, failing.pk])
+        statuses = dict(Job.objects.values_list('pk', 'status'))
+        self.assertEqual(statuses, {low.pk: Job.SUCCEEDED, high.pk: Job.SUCCEEDED, failing.pk: Job.FAILED,
+                                    invalid.pk: Job.FAILED})
+        failing.refresh_from_db()
+        invalid.refresh_from_db()
+        self.assertEqual(failing.attempts, 3)
+        # invalid input is not retried, its detail is the result
+        self.assertEqual((invalid.attempts, invalid.result), (1, {'field': ['wrong']}))
+
+    def test_requeue_stale(self):
+        alive = jobs.enqueue('test_flaky')
+        lost = jobs.enqueue('test_flaky')
+        spent = jobs.enqueue('test_flaky', max_attempts=1)
+        for job in (alive, lost, spent):
+            jobs.claim(job.pk, 'worker')
+        Job.objects.filter(pk__in=[lost.pk, spent.pk]).update(heartbeat_at=timezone.now() - timedelta(minutes=5))
+
+        self.assertEqual(jobs.requeue_stale(), 2)
+        statuses = dict(Job.objects.values_list('pk', 'status'))
+        self.assertEqual(statuses, {alive.pk: Job.RUNNING, lost.pk: Job.QUEUED, spent.pk: Job.FAILED})
+        # the worker that lost the job cannot overwrite what happened since
+        jobs.finish(Job.objects.get(pk=lost.pk), status=Job.SUCCEEDED)
+        self.assertEqual(Job.objects.get(pk=lost.pk).status, Job.QUEUED)
+
+    def test_stale_jobs_drop_their_uploads(self):
+        body = Upload.objects.create(company=self.company, content_type='application/x-ndjson')
+        UploadChunk.objects.create(upload=body, number=0, data=b'{}\n')
+        imported = jobs.enqueue('vehicle_import', {'content_type': 'application/x-ndjson', 'upload': body.pk},
+                                company_id=self.company.pk)
+        part = Upload.objects.create(company=self.other, content_type='text/csv; charset=utf-8')
+        exported = jobs.enqueue('vehicle_export', {'format': 'csv'}, company_id=self.other.pk)
+        for job in (imported, exported):
+            jobs.claim(job.pk, 'worker')
+        Job.objects.filter(pk=exported.pk).update(result={'upload': part.pk})
+        Job.objects.update(heartbeat_at=timezone.now() - timedelta(minutes=5))
+
+        self.assertEqual(jobs.requeue_stale(), 2)
+        # the import is not retried, the export is
+        statuses = dict(Job.objects.values_list('pk', 'status'))
+        self.assertEqual(statuses, {imported.pk: Job.FAILED, exported.pk: Job.QUEUED})
+        self.assertFalse(Upload.objects.exists())
+        self.assertFalse(UploadChunk.objects.exists())
+
+    def test_company_concurrency_limit(self):
+        running = jobs.enqueue('test_flaky', company_id=self.company.pk)
+        jobs.claim(running.pk, 'worker')
+        same = jobs.enqueue('test_flaky', company_id=self.company.pk, priority=10)
+        other = jobs.enqueue('test_flaky', company_id=self.other.pk)
+
+        self.assertEqual(list(jobs.claimable().values_list('pk', flat=True)), [other.pk])
+        with override_settings(JOB_TENANT_CONCURRENCY=2):
+            self.assertEqual(list(jobs.claimable().values_list('pk', flat=True)), [same.pk, other.pk])
+        self.assertEqual(jobs.claim_next('worker').pk, other.pk)
+        self.assertIsNone(jobs.claim_next('worker'))
+
+
+@override_settings(JOBS_EAGER=True)
+class AcceptedJobTest(TestCase):
+    """?async=1 / Prefer: respond-async answer 202 with the job, whose Location tells how it ended"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.company = Company.objects.create(company_name='Fleet')
+        cls.admin = MyUser.objects.create(email='admin@fleet.example', is_staff=True, company=cls.company)
+        cls.office = Office.objects.create(office_name='Depot', address='1 Main st.', country='Ukraine',
+                                           city='Kyiv', region='Центр', company=cls.company)
+        cls.vehicle = Vehicle.objects.create(licence_plate='AA0000BC', name='Ford', model='Transit',
+                                             company=cls.company)
+        cls.token = Token.objects.create(user=cls.admin).key
+
+    def setUp(self):
+        for cache in caches.all():
+            cache.clear()
+        token_cache.clear()
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {self.token}')
+
+    def reassign(self, changes, **headers):
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.client.post('/api/vehicle/reassign/', {'changes': changes}, format='json', **headers)
+
+    def test_accepted_with_location(self):
+        response = self.reassign([{'vehicle': self.vehicle.pk, 'office': self.office.pk}],
+                                 HTTP_PREFER='respond-async')
+        self.assertEqual((response.status_code, response.data['status']), (202, Job.QUEUED))
+        self.assertTrue(response['Location'].endswith(f'/api/jobs/{response.data["id"]}/'))
+
+        status = self.client.get(response['Location'])
+        self.assertEqual(status.data['status'], Job.SUCCEEDED)
+        self.vehicle.refresh_from_db()
+        self.assertEqual(self.vehicle.office_id, self.office.pk)
+
+    def test_job_failing_validation_keeps_the_errors(self):
+        other = Vehicle.objects.create(licence_plate='ZZ0000ZZ', name='Ford', model='Transit',
+                                       company=Company.objects.create(company_name='Other'))
+        response = self.reassign([{'vehicle': other.pk, 'office': self.office.pk}], QUERY_STRING='async=1')
+        self.assertEqual(response.status_code, 202)
+        status = self.client.get(response['Location']).data
+        self.assertEqual((status['status'], status['attempts']), (Job.FAILED, 1))
+        self.assertTrue(status['result'])
+
+    def export(self, query):
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.get(f'/api/vehicle/export/?async=1&{query}')
+        self.assertEqual(response.status_code, 202)
+        return Job.objects.get(pk=response.data['id'])
+
+    def test_export(self):
+        Vehicle.objects.create(licence_plate='BB0000BC', name='Volvo', model='Truck', company=self.company,
+                               office=self.office)
+        job = self.export(f'format=csv&office={self.office.pk}')
+        self.assertEqual(job.status, Job.SUCCEEDED)
+        response = self.client.get(f'/api/jobs/{job.pk}/download/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'text/csv; charset=utf-8')
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual(len(lines), 2)
+        self.assertEqual(lines[1].split(',')[1], 'BB0000BC')
+
+        with override_settings(JOB_EXPORT_KEEP_SECONDS=60):
+            Job.objects.filter(pk=job.pk).update(finished_at=timezone.now() - timedelta(minutes=5))
+            second = self.export('format=ndjson')
+        download = self.client.get(f'/api/jobs/{second.pk}/download/')
+        self.assertEqual(b''.join(download.streaming_content).count(b'\n'), 2)
+        # the next export of the company dropped the old file
+        self.assertEqual(self.client.get(f'/api/jobs/{job.pk}/download/').status_code, 404)
+        self.assertEqual(Upload.objects.count(), 1)
+
+
+class TokenRevocationTest(TestCase):
+    """A deleted token, user or company stops authenticating, in this process and, through the shared
+    cache, in the others"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.company = Company.objects.create(company_name='Fleet')
+        cls.admin = MyUser.objects.create(email='admin@fleet.example', is_staff=True, company=cls.company)
+        cls.token = Token.objects.create(user=cls.admin).key
+
+    def setUp(self):
+        for cache in caches.all():
+            cache.clear()
+        token_cache.clear()
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {self.token}')
+
+    def status(self):
+        return self.client.get('/api/profile/').status_code
+
+    def test_delete_token(self):
+        self.assertEqual(self.status(), 200)
+        Token.objects.filter(key=self.token).delete()
+        self.assertEqual(self.status(), 401)
+
+    def test_delete_user(self):
+        self.assertEqual(self.status(), 200)
+        self.admin.delete()
+        self.assertEqual(self.status(), 401)
+
+    def test_deactivate_user(self):
+        self.assertEqual(self.status(), 200)
+        self.admin.is_active = False
+        self.admin.save()
+        self.assertEqual(self.status(), 401)
+
+    def test_delete_company(self):
+        self.assertEqual(self.status(), 200)
+        self.company.delete()
+        self.assertEqual(self.status(), 401)
+
+    def test_new_employee_keeps_the_tokens(self):
+        self.assertEqual(self.status(), 200)
+        response = self.client.post('/api/employee/', {
+            'email': 'driver@fleet.example', 'first_name': 'Taras', 'last_name': 'Melnyk',
+            'password': 'secret-1', 'confirm_password': 'secret-1',
+        }, format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertIsNotNone(token_cache.get(self.token))
+
+    @override_settings(TOKEN_CACHE_BACKEND='default', TOKEN_CACHE_LOCAL_TTL=1)
+    def test_revoked_in_another_process(self):
+        self.assertEqual(self.status(), 200)
+        # the signals of another process clear the shared cache, not the LRU of this one
+        with mock.patch.object(token_cache.local, 'delete_many'):
+            Token.objects.filter(key=self.token).delete()
+        later = time.monotonic() + 2
+        with mock.patch('service.cache.time.monotonic', return_value=later):
+            self.assertEqual(self.status(), 401)
+
+
+@override_settings(METRICS_ALLOWED_IPS=['10.0.0.9'], METRICS_TOKEN='scrape-secret')
+class MetricsAccessTest(TestCase):
+    def test_access(self):
+        outsider = {'REMOTE_ADDR': '203.0.113.5'}
+        self.assertEqual(self.client.get('/metrics', **outsider).status_code, 403)
+        self.assertEqual(self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer wrong', **outsider).status_code, 403)
+        self.assertEqual(self.client.get('/metrics', REMOTE_ADDR='10.0.0.9').status_code, 200)
+        self.assertEqual(
+            self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer scrape-secret', **outsider).status_code, 200)
+        # a company admin is staff too: a signup must not open the metrics of every tenant
+        self.client.force_login(MyUser.objects.create(email='admin@fleet.example', is_staff=True))
+        self.assertEqual(self.client.get('/metrics', **outsider).status_code, 403)
+        self.client.force_login(MyUser.objects.create(email='ops@fleet.example', is_staff=True, is_superuser=True))
+        self.assertEqual(self.client.get('/metrics', **outsider).status_code, 200)
+
+
+class TenantVersionTest(TestCase):
+    """Cached pages and ETags follow the version in the database, whichever process bumped it"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.company = Company.objects.create(company_name='Fleet')
+        cls.admin = MyUser.objects.create(email='admin@fleet.example', is_staff=True, company=cls.company)
+        cls.office = Office.objects.create(office_name='Depot', address='1 Main st.', country='Ukraine',
+                                           city='Kyiv', region='Центр', company=cls.company)
+        cls.token = Token.objects.create(user=cls.admin).key
+
+    def setUp(self):
+        for cache in caches.all():
+            cache.clear()
+        token_cache.clear()
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {self.token}')
+
+    def test_bump_from_another_process(self):
+        first = self.client.get('/api/office/')
+        self.assertEqual(self.client.get('/api/office/', HTTP_IF_NONE_MATCH=first['ETag']).status_code, 304)
+
+        # what another process does on a write: a raw UPDATE, nothing in this process' caches changes
+        Office.objects.filter(pk=self.office.pk).update(office_name='Garage')
+        TenantVersion.objects.update_or_create(pk=self.company.pk, defaults={'version': F('version') + 1})
+
+        second = self.client.get('/api/office/', HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(second.status_code, 200)
+        self.assertEqual(second.data['results'][0]['office_name'], 'Garage')
+
+    def test_if_modified_since_in_the_second_of_a_change(self):
+        TenantVersion.objects.update_or_create(pk=self.company.pk, defaults={'version': 1, 'modified': 1000})
+        with mock.patch('service.api.conditional.time') as clock:
+            clock.time.return_value = 1000.5
+            response = self.client.get('/api/office/')
+            # the second is not over, another change may still come in it
+            self.assertNotIn('Last-Modified', response)
+            self.assertEqual(self.client.get('/api/office/', HTTP_IF_MODIFIED_SINCE=http_date(1000)).status_code, 200)
+
+            clock.time.return_value = 1001.2
+            last_modified = self.client.get('/api/office/')['Last-Modified']
+            self.assertEqual(last_modified, http_date(1000))
+            self.assertEqual(self.client.get('/api/office/', HTTP_IF_MODIFIED_SINCE=last_modified).status_code, 304)
+
+            TenantVersion.objects.filter(pk=self.company.pk).update(modified=1001)
+            clock.time.return_value = 1002
+            self.assertEqual(self.client.get('/api/office/', HTTP_IF_MODIFIED_SINCE=last_modified).status_code, 200)
+
+    def test_rolled_back_write_keeps_the_version(self):
+        version = TenantVersion.objects.filter(pk=self.company.pk).values_list('version', flat=True).first()
+        with self.assertRaises(RuntimeError), transaction.atomic():
+            self.office.save()
+            raise RuntimeError
+        self.assertEqual(TenantVersion.objects.filter(pk=self.company.pk).values_list('version', flat=True).first(),
+                         version)
+
+
+@override_settings(EVENTS_QUEUE_SIZE=2)
+class BrokerTest(TestCase):
+    """Fan-out of service.events: per-company queues, RESYNC for a subscriber that falls behind"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.company = Company.objects.create(company_name='Fleet')
+        cls.other = Company.objects.create(company_name='Other')
+
+    async def test_publish_and_overflow(self):
+        broker = Broker()
+        subscription = await broker.subscribe(1)
+        other = await broker.subscribe(2)
+        broker.publish(1, 7, 'vehicle', {'id': 3})
+        self.assertEqual(subscription.queue.get_nowait(), b'id: 7\nevent: vehicle\ndata: {"id":3}\n\n')
+        self.assertTrue(other.queue.empty())
+
+        for event_id in range(3):
+            broker.publish(1, event_id, 'vehicle', {'id': event_id})
+        self.assertEqual(subscription.queue.get_nowait(), RESYNC)
+        self.assertTrue(subscription.queue.empty())
+        # dropped with the RESYNC, the next events go nowhere
+        broker.publish(1, 9, 'vehicle', {'id': 9})
+        self.assertTrue(subscription.queue.empty())
+        self.assertEqual((broker.stats()['subscribers'], broker.stats()['overflowed']), (1, 1))
+
+    def test_change_log_poll(self):
+        broker = ChangeLogBroker()
+        position = broker.last_change()
+        vehicle = Vehicle.objects.create(licence_plate='AA0000BC', name='Ford', model='Transit', company=self.company)
+        Vehicle.objects.create(licence_plate='ZZ0000ZZ', name='Ford', model='Transit', company=self.other)
+        events, position, more = broker.poll(position, {self.company.pk})
+        self.assertEqual([(company_id, name, data['id']) for company_id, _, name, data in events],
+                         [(self.company.pk, 'vehicle', vehicle.pk)])
+        self.assertFalse(more)
+
+        pk = vehicle.pk
+        vehicle.delete()
+        events, _, _ = broker.poll(position, {self.company.pk})
+        self.assertEqual([(name, data) for _, _, name, data in events], [('deleted', {'kind': 'vehicle', 'id': pk})])
+
+
+@override_settings(EVENTS_BROKER='service.events.Broker', EVENTS_KEEPALIVE=0.05)
+class EventStreamTest(TestCase):
+    """/api/events/: token header or stream ticket, rechecked while the stream is open"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.company = Company.objects.create(company_name='Fleet')
+        cls.admin = MyUser.objects.create(email='admin@fleet.example', is_staff=True, company=cls.company)
+        cls.employee = MyUser.objects.create(email='driver@fleet.example', company=cls.company)
+        cls.token = Token.objects.create(user=cls.admin)
+        cls.employee_token = Token.objects.create(user=cls.employee)
+
+    def setUp(self):
+        for cache in caches.all():
+            cache.clear()
+        token_cache.clear()
+        patcher = mock.patch('service.events._broker', None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def open(self, query_string=b'', headers=()):
+        """(stream task, queue of the ASGI messages it sends, event that disconnects the client)"""
+        sent, gone = asyncio.Queue(), asyncio.Event()
+
+        async def receive():
+            await gone.wait()
+            return {'type': 'http.disconnect'}
+
+        scope = {'type': 'http', 'method': 'GET', 'path': '/api/events/', 'headers': list(headers),
+                 'query_string': query_string}
+        return asyncio.ensure_future(event_stream(scope, receive, sent.put)), sent, gone
+
+    async def status_of(self, query_string=b'', headers=()):
+        task, sent, _ = self.open(query_string, headers)
+        await asyncio.wait_for(task, 5)
+        return sent.get_nowait()['status']
+
+    async def body(self, sent):
+        """The next message that is not a keepalive, within about 40 keepalives"""
+        for _ in range(40):
+            message = await asyncio.wait_for(sent.get(), 5)
+            if message['body'] != b': keepalive\n\n':
+                return message
+        self.fail('only keepalives')
+
+    def test_ticket(self):
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION=f'Token {self.token.key}')
+        response = client.post('/api/events/ticket/')
+        self.assertEqual(response.status_code, 201)
+        ticket = response.data['ticket']
+        self.assertNotIn(self.token.key, ticket)
+        self.assertEqual(redeem_ticket(ticket), self.token.key)
+        with override_settings(EVENTS_TICKET_MAX_AGE=-1), self.assertRaises(AuthenticationFailed):
+            redeem_ticket(ticket)
+        # a new token voids the tickets of the old one
+        self.token.delete()
+        Token.objects.create(user=self.admin)
+        with self.assertRaises(AuthenticationFailed):
+            redeem_ticket(ticket)
+
+        client.credentials(HTTP_AUTHORIZATION=f'Token {self.employee_token.key}')
+        self.assertEqual(client.post('/api/events/ticket/').status_code, 403)
+
+    async def test_auth(self):
+        self.assertEqual(await self.status_of(), 401)
+        # long-lived tokens are not taken from the URL
+        self.assertEqual(await self.status_of(f'token={self.token.key}'.encode()), 401)
+        self.assertEqual(await self.status_of(b'ticket=forged'), 401)
+        header = [(b'authorization', f'Token {self.employee_token.key}'.encode())]
+        self.assertEqual(await self.status_of(headers=header), 403)
+        ticket = issue_ticket(self.employee_token)
+        self.assertEqual(await self.status_of(f'ticket={ticket}'.encode()), 403)
+
+    async def test_stream_until_token_revoked(self):
+        task, sent, gone = self.open(f'ticket={issue_ticket(self.token)}'.encode())
+        self.addCleanup(gone.set)
+        self.assertEqual((await asyncio.wait_for(sent.get(), 5))['status'], 200)
+        self.assertEqual((await self.body(sent))['body'], b'retry: 3000\n\n')
+
+        get_broker().publish(self.company.pk, 1, 'vehicle', {'id': 1})
+        self.assertEqual((await self.body(sent))['body'], b'id: 1\nevent: vehicle\ndata: {"id":1}\n\n')
+
+        await sync_to_async(Token.objects.filter(pk=self.token.pk).delete)()
+        last = await self.body(sent)
+        self.assertEqual((last['body'], last.get('more_body', False)), (b'', False))
+        await asyncio.wait_for(task, 5)
+
+    @override_settings(EVENTS_QUEUE_SIZE=1)
+    async def test_overflow_ends_with_resync(self):
+        task, sent, gone = self.open(headers=[(b'authorization', f'Token {self.token.key}'.encode())])
+        self.addCleanup(gone.set)
+        self.assertEqual((await asyncio.wait_for(sent.get(), 5))['status'], 200)
+        await self.body(sent)
+        for event_id in range(3):
+            get_broker().publish(self.company.pk, event_id, 'vehicle', {'id': event_id})
+        last = await self.body(sent)
+        self.assertEqual((last['body'], last['more_body']), (RESYNC, False))
+        await asyncio.wait_for(task, 5)
+
+
+@override_settings(DATABASE_REPLICAS=['replica'], REPLICA_MAX_LAG=30, REPLICA_STICKY_SECONDS=5)
+class ReplicaRoutingTest(TransactionTestCase):
+    """ReplicaRouter and ReplicaRoutingMiddleware; the 'replica' alias is the primary's own connection,
+    so the test follows where the router sends the reads"""
+
+    def setUp(self):
+        connections['replica'] = connections['default']
+        self.addCleanup(connections.__delitem__, 'replica')
+        replica_status.reset()
+        self.addCleanup(replica_status.reset)
+        for cache in caches.all():
+            cache.clear()
+        token_cache.clear()
+        self.company = Company.objects.create(company_name='Fleet')
+        self.admin = MyUser.objects.create(email='admin@fleet.example', is_staff=True, is_superuser=True,
+                                           company=self.company)
+        self.token = Token.objects.create(user=self.admin).key
+        self.client = self.api_client()
+        self.heartbeat = ReplicaHeartbeat.objects.create(beat=time.time() + 60)
+
+        self.routed = []
+        db_for_read = ReplicaRouter.db_for_read
+
+        def record(router, model, **hints):
+            alias = db_for_read(router, model, **hints)
+            self.routed.append(alias)
+            return alias
+
+        patcher = mock.patch.object(ReplicaRouter, 'db_for_read', record)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def api_client(self):
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION=f'Token {self.token}')
+        return client
+
+    def read_from(self, url, client=None):
+        """The aliases the reads of a GET went to"""
+        self.routed = []
+        response = (client or self.client).get(url)
+        self.assertEqual(response.status_code, 200)
+        return set(self.routed)
+
+    def test_get_reads_the_replica(self):
+        self.assertIn('replica', self.read_from('/api/office/'))
+
+    def test_pin_cookie(self):
+        response = self.client.post('/api/office/', {
+            'office_name': 'Office', 'address': 'Main st.', 'country': 'Ukraine', 'city': 'Kyiv', 'region': 'Kyiv',
+        }, format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertIn('replica_pin', response.cookies)
+        self.assertEqual(self.read_from('/api/vehicle/'), {'default'})
+
+        self.client.cookies.clear()
+        self.assertIn('replica', self.read_from('/api/vehicle/'))
+
+    def test_lagging_replica(self):
+        self.heartbeat.beat = time.time() - 3600
+        self.heartbeat.save()
+        self.assertEqual(self.read_from('/api/office/'), {'default'})
+
+    def test_replica_older_than_the_company(self):
+        self.heartbeat.beat = time.time() - 5
+        self.heartbeat.save()
+        Office.objects.create(office_name='Office', company=self.company)
+        # another client without the pin cookie still reads the change
+        self.assertEqual(self.read_from('/api/office/', self.api_client()), {'default'})
+
+    def test_session_user(self):
+        client = Client(REMOTE_ADDR='192.0.2.1')
+        client.force_login(self.admin)
+        self.assertEqual(client.get('/metrics').status_code, 200)
+
+    def test_in_atomic_block(self):
+        router = ReplicaRouter()
+        with use_replicas():
+            self.assertEqual(router.db_for_read(Company), 'replica')
+            with transaction.atomic():
+                self.assertEqual(router.db_for_read(Company), 'default')
+
+
+class SqliteBackendTest(TestCase):
+    """synchronous follows the journal mode: NORMAL only with WAL"""
+
+    def synchronous(self, pragmas):
+        with tempfile.TemporaryDirectory() as directory:
+            wrapper = SqliteDatabaseWrapper({
+                **connections['default'].settings_dict,
+                'NAME': os.path.join(directory, 'probe.sqlite3'),
+                'OPTIONS': {'pragmas': pragmas},
+            }, alias='probe')
+            conn = wrapper.get_new_connection(wrapper.get_connection_params())
+            try:
+                return conn.execute('PRAGMA synchronous').fetchone()[0]
+            finally:
+                conn.close()
+
+    def test_synchronous(self):
+        normal, full = 1, 2
+        self.assertEqual(self.synchronous({}), full)
+        self.assertEqual(self.synchronous({'journal_mode': 'wal'}), normal)
+        self.assertEqual(self.synchronous({'synchronous': 'normal'}), normal)
+
+
+class ReassignmentTest(TestCase):
+    """POST /api/vehicle/reassign/: all or nothing, rollups and change log kept, constant statements"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.company = Company.objects.create(company_name='Fleet')
+        cls.other = Company.objects.create(company_name='Other')
+        cls.admin = MyUser.objects.create(email='admin@fleet.example', is_staff=True, company=cls.company)
+        cls.token = Token.objects.create(user=cls.admin).key
+        cls.first, cls.second = [
+            MyUser.objects.create(email=f'driver{i}@fleet.example', company=cls.company) for i in range(2)
+        ]
+        cls.north = Office.objects.create(office_name='North', company=cls.company, employee=cls.first)
+        cls.south = Office.objects.create(office_name='South', company=cls.company, employee=cls.second)
+        cls.stranger = MyUser.objects.create(email='driver@other.example', company=cls.other)
+        cls.foreign_office = Office.objects.create(office_name='Abroad', company=cls.other, employee=cls.stranger)
+        cls.foreign_vehicle = Vehicle.objects.create(licence_plate='ZZ0000ZZ', name='Ford', model='Transit',
+                                                     company=cls.other)
+
+    def setUp(self):
+        for cache in caches.all():
+            cache.clear()
+        token_cache.clear()
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {self.token}')
+        self.vehicles = self.create_vehicles(4, office=self.north, driver=self.first)
+
+    def create_vehicles(self, count, office=None, driver=None):
+        start = Vehicle.objects.count()
+        return [
+            Vehicle.objects.create(licence_plate=f'AA{start + i:04d}BC', name='Ford', model='Transit',
+                                   year_of_manufacture=2000 + i % 3, company=self.company, office=office,
+                                   driver=driver)
+            for i in range(count)
+        ]
+
+    def reassign(self, data, status_code=200):
+        response = self.client.post('/api/vehicle/reassign/', data, format='json')
+        self.assertEqual(response.status_code, status_code, response.data)
+        return response.data
+
+    def placement(self, vehicle):
+        vehicle.refresh_from_db()
+        return vehicle.office_id, vehicle.driver_id
+
+    def assertRollupsMatchRecount(self):
+        self.assertEqual(rollups.differences(self.company.pk), {})
+
+    def test_changes(self):
+        moved, unassigned, kept = self.vehicles[0], self.vehicles[1], self.vehicles[2]
+        last_change = Change.objects.aggregate(last=Max('id'))['last']
+        report = self.reassign({'changes': [
+            {'vehicle': moved.pk, 'office': self.south.pk, 'driver': self.second.pk},
+            {'vehicle': unassigned.pk},
+        ]})
+        self.assertEqual(report, {'updated': 2})
+        self.assertEqual(self.placement(moved), (self.south.pk, self.second.pk))
+        self.assertEqual(self.placement(unassigned), (None, None))
+        self.assertEqual(self.placement(kept), (self.north.pk, self.first.pk))
+        self.assertRollupsMatchRecount()
+        # the moved vehicles are at the end of the change log, for /api/sync/
+        logged = Change.objects.filter(id__gt=last_change).values_list('company', 'kind', 'object_id', 'deleted')
+        self.assertEqual(sorted(logged), sorted([(self.company.pk, Change.VEHICLE, moved.pk, False),
+                                                 (self.company.pk, Change.VEHICLE, unassigned.pk, False)]))
+
+    def test_filter_and_target(self):
+        elsewhere = self.create_vehicles(2)
+        report = self.reassign({'filter': {'office': self.north.pk},
+                                'target': {'office': self.south.pk, 'driver': self.second.pk}})
+        self.assertEqual(report, {'updated': 4})
+        self.assertEqual({self.placement(vehicle) for vehicle in self.vehicles}, {(self.south.pk, self.second.pk)})
+        self.assertEqual({self.placement(vehicle) for vehicle in elsewhere}, {(None, None)})
+        self.assertRollupsMatchRecount()
+        self.assertEqual(Change.objects.filter(kind=Change.VEHICLE, object_id__in=[v.pk for v in self.vehicles])
+                         .count(), 4)
+
+        # vehicles already there are not counted, nor moved again
+        self.assertEqual(self.reassign({'filter': {}, 'target': {'office': self.south.pk,
+                                                                 'driver': self.second.pk}}), {'updated': 2})
+        self.assertRollupsMatchRecount()
+
+    def test_other_company_and_unknown_ids(self):
+        valid = {'vehicle': self.vehicles[0].pk, 'office': self.south.pk, 'driver': self.second.pk}
+        for change in ({'vehicle': self.foreign_vehicle.pk},
+                       {'vehicle': self.vehicles[1].pk, 'office': self.foreign_office.pk},
+                       {'vehicle': self.vehicles[1].pk, 'driver': self.stranger.pk},
+                       {'vehicle': 999999}):
+            errors = self.reassign({'changes': [valid, change]}, 400)['changes']
+            self.assertEqual(list(errors), [1], change)
+        for target in ({'office': self.foreign_office.pk}, {'driver': 999999}):
+            self.assertIn('target', self.reassign({'filter': {}, 'target': target}, 400))
+        # all or nothing: the valid change was not applied either
+        self.assertEqual(self.placement(self.vehicles[0]), (self.north.pk, self.first.pk))
+        self.assertEqual(self.placement(self.foreign_vehicle), (None, None))
+
+    def test_office_and_driver_mismatch(self):
+        errors = self.reassign({'changes': [
+            {'vehicle': self.vehicles[0].pk, 'office': self.south.pk, 'driver': self.first.pk},
+        ]}, 400)['changes']
+        self.assertEqual(errors[0]['non_field_errors'], ['The Employee work in another office'])
+        target = {'office': self.north.pk, 'driver': self.second.pk}
+        self.assertIn('non_field_errors', self.reassign({'filter': {}, 'target': target}, 400)['target'])
+
+    def test_last_change_wins(self):
+        vehicle = self.vehicles[0]
+        report = self.reassign({'changes': [
+            {'vehicle': vehicle.pk},
+            {'vehicle': vehicle.pk, 'office': self.south.pk, 'driver': self.second.pk},
+        ]})
+        self.assertEqual(report, {'updated': 1})
+        self.assertEqual(self.placement(vehicle), (self.south.pk, self.second.pk))
+        self.assertRollupsMatchRecount()
+
+    def test_no_op(self):
+        before = (rollups.stored(self.company.pk), list(Change.objects.values_list('id', flat=True)))
+        report = self.reassign({'changes': [
+            {'vehicle': self.vehicles[0].pk, 'office': self.north.pk, 'driver': self.first.pk},
+        ]})
+        self.assertEqual(report, {'updated': 0})
+        self.assertEqual(self.reassign({'filter': {'office': self.north.pk},
+                                        'target': {'office': self.north.pk, 'driver': self.first.pk}}),
+                         {'updated': 0})
+        self.assertEqual((rollups.stored(self.company.pk), list(Change.objects.values_list('id', flat=True))),
+                         before)
+
+    def count_statements(self, data):
+        with CaptureQueriesContext(connection) as queries:
+            self.reassign(data)
+        return len(queries)
+
+    def test_statements_do_not_grow_with_the_vehicles(self):
+        def changes(vehicles, office, driver):
+            return {'changes': [{'vehicle': vehicle.pk, 'office': office.pk, 'driver': driver.pk}
+                                for vehicle in vehicles]}
+
+        small = self.create_vehicles(5)
+        large = self.create_vehicles(10)
+        # the token is cached by the first request
+        self.client.get('/api/profile/')
+        self.assertEqual(self.count_statements(changes(small, self.north, self.first)),
+                         self.count_statements(changes(large, self.north, self.first)))
+
+        moves = {'filter': {'office': None}, 'target': {'office': self.north.pk, 'driver': self.first.pk}}
+        self.create_vehicles(5)
+        statements = self.count_statements(moves)
+        self.create_vehicles(10)
+        self.assertEqual(self.count_statements(moves), statements)
+        self.assertRollupsMatchRecount()
+
+
+class DeletionTest(TestCase):
+    """Deletions go in batches that each save the progress, resume after a crash and can archive the rows"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.company = Company.objects.create(company_name='Fleet')
+        cls.driver = MyUser.objects.create(email='driver@fleet.example', company=cls.company)
+
+    def setUp(self):
+        self.office = Office.objects.create(office_name='Depot', address='1 Main st.', country='Ukraine',
+                                            city='Kyiv', region='Центр', company=self.company, employee=self.driver)
+        self.vehicles = [
+            Vehicle.objects.create(licence_plate=f'AA{i:04d}BC', name='Ford', model='Transit',
+                                   year_of_manufacture=2000 + i % 2, company=self.company, office=self.office,
+                                   driver=self.driver)
+            for i in range(5)
+        ]
+
+    def runner(self, target, instance, archive=False):
+        return deletions.DeletionRunner(deletions.create(target, instance, archive), batch_size=2)
+
+    def test_batches(self):
+        runner = self.runner(Deletion.OFFICE, self.office)
+        with mock.patch.object(runner, 'delete_batch', wraps=runner.delete_batch) as delete_batch:
+            self.assertFalse(runner.run(max_rows=2))
+            self.assertEqual(delete_batch.call_count, 1)
+            self.assertEqual(runner.deletion.deleted, {'service.Vehicle': 2})
+            self.assertEqual(Vehicle.objects.count(), 3)
+
+            self.assertTrue(runner.run())
+        # three batches of vehicles, one with the office, and an empty one for each step
+        self.assertEqual(delete_batch.call_count, 1 + 4 + 1)
+        deletion = Deletion.objects.get(pk=runner.deletion.pk)
+        self.assertEqual(deletion.status, Deletion.DONE)
+        self.assertEqual(deletion.planned, {'service.Vehicle': 5, 'service.Office': 1})
+        self.assertEqual(deletion.deleted, deletion.planned)
+        self.assertFalse(Office.objects.filter(pk=self.office.pk).exists())
+
+    def test_resume_after_interruption(self):
+        runner = self.runner(Deletion.OFFICE, self.office)
+        delete_batch = deletions.DeletionRunner.delete_batch
+        done = []
+
+        def crash_after_one(runner, model, queryset):
+            if done:
+                raise RuntimeError('worker killed')
+            done.append(model)
+            return delete_batch(runner, model, queryset)
+
+        with mock.patch.object(deletions.DeletionRunner, 'delete_batch', crash_after_one):
+            with self.assertRaises(RuntimeError):
+                runner.run()
+        deletion = Deletion.objects.get(pk=runner.deletion.pk)
+        self.assertEqual(deletion.status, Deletion.FAILED)
+        self.assertEqual(deletion.deleted, {'service.Vehicle': 2})
+        self.assertEqual(Vehicle.objects.count(), 3)
+
+        result = tasks.run_deletion(Job(kind='deletion', payload={'deletion': deletion.pk}))
+        self.assertEqual(result['deleted'], {'service.Vehicle': 5, 'service.Office': 1})
+        self.assertEqual(Deletion.objects.get(pk=deletion.pk).status, Deletion.DONE)
+        self.assertEqual(Vehicle.objects.count(), 0)
+
+    def test_archive(self):
+        self.runner(Deletion.EMPLOYEE, self.driver, archive=True).run()
+        archived = ArchivedRow.objects.order_by('model', 'object_id')
+        self.assertEqual([(row.model, row.object_id) for row in archived],
+                         [('service.MyUser', self.driver.pk), ('service.Office', self.office.pk)]
+                         + [('service.Vehicle', vehicle.pk) for vehicle in self.vehicles])
+        self.assertEqual({row.company_id for row in archived}, {self.company.pk})
+        self.assertEqual(archived.get(object_id=self.vehicles[0].pk, model='service.Vehicle').data['licence_plate'],
+                         'AA0000BC')
+        self.assertFalse(MyUser.objects.filter(pk=self.driver.pk).exists())
+
+    def test_vehicle_batches_do_what_the_receivers_do(self):
+        # _raw_delete cascades to nothing: no model may refer to Vehicle
+        self.assertEqual(Vehicle._meta.related_objects, ())
+        version = TenantVersion.objects.filter(pk=self.company.pk).values_list('version', flat=True).first() or 0
+        with self.captureOnCommitCallbacks(execute=True):
+            self.runner(Deletion.OFFICE, self.office).run()
+        self.assertEqual(rollups.differences(self.company.pk), {})
+        self.assertEqual(search.search(self.company.pk, 'Transit', ['vehicle']), [])
+        self.assertEqual(
+            sorted(Change.objects.filter(kind=Change.VEHICLE).values_list('object_id', 'deleted')),
+            [(vehicle.pk, True) for vehicle in self.vehicles])
+        self.assertGreater(TenantVersion.objects.get(pk=self.company.pk).version, version)
+
+
+class FleetRollupTest(TestCase):
+    """The signals keep the rollups equal to a rebuild, without a query per row for deferred fields"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.company = Company.objects.create(company_name='Fleet')
+        cls.first = MyUser.objects.create(email='first@fleet.example', company=cls.company)
+        cls.second = MyUser.objects.create(email='second@fleet.example', company=cls.company)
+
+    def setUp(self):
+        self.north = Office.objects.create(office_name='North', address='1 Main st.', country='Ukraine',
+                                           city='Kyiv', region='Центр', company=self.company, employee=self.first)
+        self.south = Office.objects.create(office_name='South', address='2 Main st.', country='Ukraine',
+                                           city='Odesa', region='Південь', company=self.company,
+                                           employee=self.second)
+        self.vehicles = [
+            Vehicle.objects.create(licence_plate=f'AA{i:04d}BC', name='Ford', model='Transit',
+                                   year_of_manufacture=2000 + i % 2, company=self.company, office=self.north,
+                                   driver=self.first)
+            for i in range(4)
+        ]
+
+    def counts(self):
+        return {key: count for key, count in rollups.stored(self.company.pk).items() if count}
+
+    def assertMatchesRebuild(self):
+        counts = self.counts()
+        rollups.rebuild(self.company.pk)
+        self.assertEqual(counts, self.counts())
+
+    def test_move_between_offices(self):
+        vehicle = self.vehicles[0]
+        vehicle.office = self.south
+        vehicle.save()
+        self.assertEqual(self.counts()[(FleetRollup.OFFICE, self.north.pk)], 3)
+        self.assertEqual(self.counts()[(FleetRollup.OFFICE, self.south.pk)], 1)
+        self.assertMatchesRebuild()
+
+    def test_change_driver(self):
+        vehicle = Vehicle.objects.get(pk=self.vehicles[0].pk)
+        vehicle.driver = self.second
+        vehicle.save()
+        vehicle.driver = None
+        vehicle.save()
+        self.assertEqual(self.counts()[(FleetRollup.DRIVER, self.first.pk)], 3)
+        self.assertEqual(self.counts()[(FleetRollup.DRIVER, rollups.NONE_KEY)], 1)
+        self.assertNotIn((FleetRollup.DRIVER, self.second.pk), self.counts())
+        self.assertMatchesRebuild()
+
+    def test_cascaded_deletes(self):
+        Vehicle.objects.create(licence_plate='KK0000KK', name='Volvo', model='Truck', year_of_manufacture=2010,
+                               company=self.company, office=self.south, driver=self.second)
+        self.north.delete()
+        self.assertEqual(self.counts(), {(FleetRollup.OFFICE, self.south.pk): 1,
+                                         (FleetRollup.DRIVER, self.second.pk): 1, (FleetRollup.YEAR, 2010): 1})
+        self.second.delete()
+        self.assertEqual(self.counts(), {})
+        self.assertMatchesRebuild()
+
+    def test_deferred_fields(self):
+        with self.assertNumQueries(1):
+            vehicles = list(Vehicle.objects.only('name').order_by('pk'))
+        # the office was deferred: its old value is read from the row before the save
+        vehicles[0].office = self.south
+        with CaptureQueriesContext(connection) as queries:
+            vehicles[0].save()
+        self.assertEqual(len([query for query in queries if query['sql'].startswith('SELECT')]), 1)
+        vehicles[1].name = 'Focus'
+        with CaptureQueriesContext(connection) as queries:
+            vehicles[1].save()
+        self.assertFalse(any('service_fleetrollup' in query['sql'] for query in queries))
+        Vehicle.objects.only('name').filter(pk=vehicles[2].pk).delete()
+        self.assertEqual(self.counts()[(FleetRollup.OFFICE, self.north.pk)], 2)
+        self.assertEqual(self.counts()[(FleetRollup.OFFICE, self.south.pk)], 1)
+        self.assertEqual(self.counts()[(FleetRollup.DRIVER, self.first.pk)], 3)
+        self.assertMatchesRebuild()
+
+
+class RendererTest(TestCase):
+    """The orjson and MessagePack renderers and parsers give back what they were given"""
+
+    data = {'name': 'Офіс', 'count': 3, 'ratio': 0.5, 'none': None, 'ids': [1, 2], 'nested': {'ok': True}}
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.company = Company.objects.create(company_name='Fleet')
+        cls.admin = MyUser.objects.create(email='admin@fleet.example', is_staff=True, company=cls.company)
+        cls.token = Token.objects.create(user=cls.admin).key
+
+    def setUp(self):
+        for cache in caches.all():
+            cache.clear()
+        token_cache.clear()
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {self.token}')
+
+    def round_trip(self, renderer, parser, data):
+        return parser.parse(io.BytesIO(renderer.render(data)))
+
+    def test_json(self):
+        self.assertEqual(self.round_trip(ORJSONRenderer(), ORJSONParser(), self.data), self.data)
+        # what only DRF's encoder knows, and the int keys of fleet_stats
+        self.assertEqual(
+            self.round_trip(ORJSONRenderer(), ORJSONParser(), {'price': Decimal('1.5'), 'years': {2020: 1}}),
+            {'price': 1.5, 'years': {'2020': 1}})
+        with self.assertRaises(ParseError):
+            ORJSONParser().parse(io.BytesIO(b'{"name": '))
+
+    @skipIf(msgpack is None, 'msgpack is not installed')
+    def test_msgpack(self):
+        self.assertEqual(self.round_trip(MessagePackRenderer(), MessagePackParser(), self.data), self.data)
+        self.assertEqual(self.round_trip(MessagePackRenderer(), MessagePackParser(), {'price': Decimal('1.5')}),
+                         {'price': 1.5})
+        for body in (b'\xc1', b'\x92\x01', b'\x81\x90\x01', b'\x01\x02'):
+            with self.assertRaises(ParseError, msg=body):
+                MessagePackParser().parse(io.BytesIO(body))
+
+    @skipIf(msgpack is None, 'msgpack is not installed')
+    def test_msgpack_api(self):
+        body = msgpack.packb({'licence_plate': 'AA0000BC', 'name': 'Ford', 'model': 'Transit'})
+        response = self.client.post('/api/vehicle/', body, content_type='application/msgpack',
+                                    HTTP_ACCEPT='application/msgpack')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response['Content-Type'], 'application/msgpack')
+        self.assertEqual(msgpack.unpackb(response.content), {'success': 'You create the Vehicle Successfully'})
+
+        response = self.client.post('/api/vehicle/', b'\x92\x01', content_type='application/msgpack',
+                                    HTTP_ACCEPT='application/msgpack')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('MessagePack parse error', msgpack.unpackb(response.content)['detail'])
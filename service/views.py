@@ -0,0 +1,23 @@
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseForbidden
+from django.utils.crypto import constant_time_compare
+
+from service.metrics import registry
+
+
+def metrics_allowed(request):
+    """Scrapers from METRICS_ALLOWED_IPS, or with `Authorization: Bearer <METRICS_TOKEN>`, or superuser sessions.
+    Not staff: every company admin is staff, and the metrics cover all the tenants"""
+    if request.META.get('REMOTE_ADDR') in getattr(settings, 'METRICS_ALLOWED_IPS', ()):
+        return True
+    token = getattr(settings, 'METRICS_TOKEN', None)
+    if token and constant_time_compare(request.headers.get('Authorization', ''), f'Bearer {token}'):
+        return True
+    return request.user.is_authenticated and request.user.is_superuser
+
+
+def metrics(request):
+    """Prometheus scrape endpoint: route, query, job and event counters are not for the public"""
+    if not metrics_allowed(request):
+        return HttpResponseForbidden()
+    return HttpResponse(registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')